@@ -0,0 +1,128 @@
+import os
+from email.utils import formatdate
+from time import time
+
+import pytest
+from scrapy import Spider
+from scrapy.downloadermiddlewares.httpcache import HttpCacheMiddleware
+from scrapy.exceptions import UsageError
+from scrapy.http import HtmlResponse, Request
+from scrapy.settings import Settings
+from scrapy.utils.test import get_crawler
+
+from tfmkt.commands.httpcache import Command
+from tfmkt.httpcache import RevalidatingCacheMiddleware, SqliteCache, SqliteCacheStorage, apply_replay_settings
+
+URL = 'https://www.transfermarkt.co.uk/arsenal/startseite/verein/11'
+
+
+def middleware(tmp_path):
+    crawler = get_crawler(Spider, {
+        'HTTPCACHE_ENABLED': True,
+        'HTTPCACHE_DIR': str(tmp_path),
+        'HTTPCACHE_STORAGE': 'tfmkt.httpcache.SqliteCacheStorage',
+        'HTTPCACHE_COMPRESSION': None,
+        'HTTPCACHE_POLICY': 'tfmkt.httpcache.RevalidatingPolicy',
+        'HTTPCACHE_REVALIDATE_SECS': 3600,
+    })
+    spider = crawler.spider = Spider.from_crawler(crawler, 'clubs')
+    mw = RevalidatingCacheMiddleware.from_crawler(crawler)
+    mw.spider_opened(spider)
+    return mw, spider
+
+
+def test_revalidated_response_is_stored_fresh(tmp_path):
+    mw, spider = middleware(tmp_path)
+    stale = formatdate(time() - 24 * 3600, usegmt=True)
+
+    request = Request(URL)
+    assert mw.process_request(request, spider) is None
+    response = HtmlResponse(URL, body=b'<html>arsenal</html>', headers={'Date': stale, 'ETag': '"v1"'})
+    mw.process_response(request, response, spider)
+
+    # the stale entry is revalidated, and the server answers that it has not changed
+    request = Request(URL)
+    assert mw.process_request(request, spider) is None
+    assert request.headers[b'If-None-Match'] == b'"v1"'
+    now = formatdate(usegmt=True)
+    not_modified = HtmlResponse(URL, status=304, headers={'Date': now, 'ETag': '"v1"'})
+    served = mw.process_response(request, not_modified, spider)
+    assert served.body == b'<html>arsenal</html>'
+
+    stored = mw.storage.retrieve_response(spider, Request(URL))
+    assert stored.headers[b'Date'] == now.encode()
+    assert stored.body == b'<html>arsenal</html>'
+
+    # and is served from the cache, without revalidation, from then on
+    request = Request(URL)
+    cached = mw.process_request(request, spider)
+    assert cached is not None and b'If-None-Match' not in request.headers
+    mw.spider_closed(spider)
+
+
+def test_revalidated_response_is_stored_by_the_middleware(tmp_path, monkeypatch):
+    # as with the Scrapy versions whose HttpCacheMiddleware does not store revalidated responses itself
+    def cache_response(self, response, request):
+        if 'cached' not in response.flags:
+            HttpCacheMiddleware._cache_response(self, response, request)
+
+    monkeypatch.setattr(RevalidatingCacheMiddleware, 'STORES_REVALIDATED', False)
+    if hasattr(HttpCacheMiddleware, '_freshen_cached_response'):
+        monkeypatch.setattr(RevalidatingCacheMiddleware, '_cache_response', cache_response)
+    test_revalidated_response_is_stored_fresh(tmp_path)
+
+
+def test_maintenance_of_a_missing_cache(tmp_path):
+    settings = Settings({
+        'HTTPCACHE_DIR': str(tmp_path),
+        'HTTPCACHE_STORAGE': 'tfmkt.httpcache.SqliteCacheStorage',
+    })
+    cache = SqliteCache(settings)
+    with pytest.raises(FileNotFoundError):
+        list(cache.scan('clubs'))
+    with pytest.raises(FileNotFoundError):
+        cache.evict('clubs', lambda entry: True)
+
+    command = Command()
+    command.settings = settings
+    with pytest.raises(UsageError):
+        command.run(['stats', 'clubs'], None)
+    assert not os.path.exists(tmp_path / 'clubs.sqlite3')
+
+
+def test_eviction_commits_once_per_batch(tmp_path, monkeypatch):
+    mw, spider = middleware(tmp_path)
+    for i in range(5):
+        request = Request(f'{URL}/saison_id/{2000 + i}')
+        mw.process_response(request, HtmlResponse(request.url, body=b'<html></html>'), spider)
+    mw.spider_closed(spider)
+
+    statements = []
+    connect = SqliteCacheStorage.connect.__func__
+
+    def traced_connect(cls, path):
+        connection = connect(cls, path)
+        connection.set_trace_callback(statements.append)
+        return connection
+
+    monkeypatch.setattr(SqliteCacheStorage, 'connect', classmethod(traced_connect))
+    cache = SqliteCache(Settings({'HTTPCACHE_DIR': str(tmp_path)}))
+    evicted = [entry for entry in cache.scan('clubs') if not entry.url.endswith(('2003', '2004'))]
+    assert cache.evict('clubs', lambda entry: entry in evicted, batch_size=2) == (
+        3, sum(entry.stored_size for entry in evicted)
+    )
+    # a batch of two entries and one of the last entry, with no empty batch after it
+    assert statements.count('BEGIN') == statements.count('COMMIT') == 2
+    assert sorted(entry.url[-4:] for entry in cache.scan('clubs')) == ['2003', '2004']
+
+
+@pytest.mark.parametrize('priority, concurrency', [
+    ('default', 100), ('project', 100), ('spider', 4), ('cmdline', 4),
+])
+def test_replay_concurrency_keeps_the_one_of_the_user(priority, concurrency):
+    settings = Settings()
+    settings.set('HTTPCACHE_REPLAY_CONCURRENT_REQUESTS', 100, priority='project')
+    settings.set('CONCURRENT_REQUESTS', 4, priority=priority)
+    apply_replay_settings(settings)
+    assert settings.getint('CONCURRENT_REQUESTS') == concurrency
+    assert settings.getint('CONCURRENT_REQUESTS_PER_DOMAIN') == 100
@@ -0,0 +1,286 @@
+import sqlite3
+
+import pytest
+from scrapy.utils.test import get_crawler
+from twisted.internet.task import Clock, LoopingCall
+
+from tfmkt import pipelines
+from tfmkt.pipelines import DatabasePipeline, ParquetPipeline, SqliteBackend
+
+
+class Spider:
+    def __init__(self, name):
+        self.name = name
+
+
+COMPETITION = {
+    'type': 'competition',
+    'href': '/premier-league/startseite/wettbewerb/GB1',
+    'tag': 'Domestic leagues & cups',
+    'country_id': '189',
+    'country_name': 'England',
+    'country_code': 'england',
+    'competition_type': 'first_tier',
+}
+
+
+def club(code, number):
+    return {
+        'type': 'club',
+        'href': f'/{code}/startseite/verein/{number}',
+        'parent': {'href': COMPETITION['href']},
+        'code': code,
+        'name': code.title(),
+        'coach_name': None,
+        'average_age': '26.4',
+        'foreigners_number': '14',
+        'foreigners_percentage': '56%',
+        'national_team_players': '17',
+        'net_transfer_record': '-10m',
+        'squad_size': '25',
+        'stadium_name': None,
+        'stadium_seats': '60000',
+        'total_market_value': '1bn',
+    }
+
+
+@pytest.fixture(autouse=True)
+def clock(monkeypatch):
+    clock = Clock()
+
+    class ClockLoopingCall(LoopingCall):
+        def __init__(self, f):
+            super().__init__(f)
+            self.clock = clock
+
+    monkeypatch.setattr(pipelines, 'LoopingCall', ClockLoopingCall)
+    return clock
+
+
+def pipeline(path, **kwargs):
+    stats = get_crawler().stats
+    return DatabasePipeline(SqliteBackend(str(path), stats=stats), stats, **kwargs)
+
+
+def game(events):
+    return {
+        'type': 'game',
+        'href': '/spielbericht/index/spielbericht/3098550',
+        'parent': {'href': COMPETITION['href']},
+        'game_id': 3098550,
+        'home_club': {'type': 'club', 'href': '/arsenal/startseite/verein/11'},
+        'away_club': {'type': 'club', 'href': '/chelsea/startseite/verein/631'},
+        'home_club_position': '1',
+        'away_club_position': '2',
+        'result': '2:1',
+        'matchday': '1. Matchday',
+        'date': 'Sat, 8/1/20',
+        'stadium': None,
+        'attendance': None,
+        'referee': None,
+        'home_manager': None,
+        'away_manager': None,
+        'events': events,
+    }
+
+
+def write_competition(path):
+    competitions = Spider('competitions')
+    p = pipeline(path)
+    p.open_spider(competitions)
+    p.process_item(COMPETITION, competitions)
+    p.close_spider(competitions)
+
+
+def club_codes(path):
+    connection = sqlite3.connect(path)
+    codes = [code for code, in connection.execute("SELECT code FROM club ORDER BY code")]
+    connection.close()
+    return codes
+
+
+def test_flush_drops_only_the_failing_item(tmp_path):
+    path = tmp_path / 'tfmkt.sqlite3'
+    write_competition(path)
+
+    clubs = Spider('clubs')
+    p = pipeline(path)
+    p.open_spider(clubs)
+    p.backend.connection.execute(
+        "CREATE TRIGGER reject_club BEFORE INSERT ON club WHEN NEW.code = 'rejected' "
+        "BEGIN SELECT RAISE(ABORT, 'club rejected'); END"
+    )
+    p.backend.commit()
+    for item in [club('arsenal', 11), club('rejected', 1), club('chelsea', 631)]:
+        p.process_item(item, clubs)
+    p.close_spider(clubs)
+
+    assert club_codes(path) == ['arsenal', 'chelsea']
+    assert p.stats.get_value('database/dropped_items') == 1
+    assert p.stats.get_value('database/failed_batches') == 1
+
+
+def test_unchanged_rows_are_not_rewritten(tmp_path):
+    path = tmp_path / 'tfmkt.sqlite3'
+    write_competition(path)
+    clubs = Spider('clubs')
+
+    def write(items):
+        p = pipeline(path)
+        p.open_spider(clubs)
+        for item in items:
+            p.process_item(item, clubs)
+        p.close_spider(clubs)
+        connection = sqlite3.connect(path)
+        updated = dict(connection.execute("SELECT code, updated_at FROM club"))
+        connection.close()
+        return p.stats, updated
+
+    stats, first = write([club('arsenal', 11), club('chelsea', 631)])
+    # the items of a flush are upserted with one statement per table
+    assert stats.get_value('database/upsert/club/count') == 1
+    assert stats.get_value('database/upsert/club/rows') == 2
+
+    stats, second = write([club('arsenal', 11), dict(club('chelsea', 631), squad_size='26')])
+    assert stats.get_value('database/skipped/club') == 1
+    assert stats.get_value('database/upsert/club/rows') == 1
+    assert second['arsenal'] == first['arsenal']
+    assert second['chelsea'] > first['chelsea']
+
+
+def test_flush_keeps_the_buffer_until_it_is_committed(tmp_path, monkeypatch):
+    path = tmp_path / 'tfmkt.sqlite3'
+    write_competition(path)
+
+    clubs = Spider('clubs')
+    p = pipeline(path)
+    p.open_spider(clubs)
+    p.process_item(club('arsenal', 11), clubs)
+    commit = p.backend.commit
+    failures = [sqlite3.OperationalError('database is locked')] * 2
+
+    def failing_commit():
+        if failures:
+            raise failures.pop()
+        commit()
+
+    monkeypatch.setattr(p.backend, 'commit', failing_commit)
+    with pytest.raises(sqlite3.OperationalError):
+        p.flush()
+    assert p.stats.get_value('database/reconnects') == 1
+    assert len(p.items) == 1
+    assert club_codes(path) == []
+
+    p.close_spider(clubs)
+    assert club_codes(path) == ['arsenal']
+
+
+def test_game_without_events_loses_its_stored_events(tmp_path):
+    path = tmp_path / 'tfmkt.sqlite3'
+    games = Spider('games')
+    goal = {'type': 'Goals', 'minute': 10, 'action': {'result': '1:0'}}
+    for events, stored in [([goal, goal], 2), ([], 0), ([], 0)]:
+        # the ids of the clubs, which are not stored, are left to be resolved later
+        p = pipeline(path, defer_foreign_keys=True)
+        p.open_spider(games)
+        p.process_item(game(events), games)
+        p.close_spider(games)
+        connection = sqlite3.connect(path)
+        assert connection.execute("SELECT count(*) FROM game_event").fetchone() == (stored,)
+        connection.close()
+
+
+def test_sqlite_connection_errors_are_lock_and_io_errors(tmp_path):
+    path = tmp_path / 'tfmkt.sqlite3'
+    backend = SqliteBackend(str(path))
+    backend.connect()
+    backend.cursor.execute("CREATE TABLE t (x INT)")
+    backend.commit()
+    backend.cursor.execute("INSERT INTO t VALUES (1)")
+
+    other = sqlite3.connect(path, timeout=0)
+    with pytest.raises(sqlite3.OperationalError) as locked:
+        other.execute("INSERT INTO t VALUES (2)")
+    with pytest.raises(sqlite3.OperationalError) as missing:
+        other.execute("SELECT * FROM missing")
+    other.close()
+    backend.close()
+
+    assert backend.is_connection_error(locked.value)
+    assert backend.is_connection_error(sqlite3.OperationalError('disk I/O error'))
+    assert not backend.is_connection_error(missing.value)
+    assert not backend.is_connection_error(sqlite3.OperationalError('no such column: x'))
+
+
+def test_buffered_items_are_flushed_without_new_items(tmp_path, clock):
+    path = tmp_path / 'tfmkt.sqlite3'
+    write_competition(path)
+
+    clubs = Spider('clubs')
+    p = pipeline(path, flush_interval=5.0)
+    p.open_spider(clubs)
+    p.process_item(club('arsenal', 11), clubs)
+    assert club_codes(path) == []
+    clock.advance(5.0)
+    assert club_codes(path) == ['arsenal']
+    assert p.items == []
+    p.close_spider(clubs)
+
+
+def test_parquet_tables_load_as_hive_datasets(tmp_path):
+    ds = pytest.importorskip('pyarrow.dataset')
+    spider = Spider('parquet')
+    p = ParquetPipeline(get_crawler().stats, parquet_dir=str(tmp_path))
+    p.open_spider(spider)
+    club_href = '/arsenal/startseite/verein/11/saison_id/2020'
+    for item in [
+        {'type': 'confederation', 'href': '/wettbewerbe/europa', 'parent': None},
+        COMPETITION,
+        {
+            'type': 'game_lineups',
+            'href': '/spielbericht/aufstellung/spielbericht/3426916',
+            'parent': {'type': 'game', 'href': '/spielbericht/index/spielbericht/3426916'},
+            'game_id': 3426916,
+            'home_club': {'href': club_href, 'formation': '4-4-2', 'starting_lineup': [{'href': '/p/1'}]},
+            'away_club': {'href': '/chelsea/startseite/verein/631/saison_id/2020', 'substitutes': [{'href': '/p/2'}]},
+        },
+        {
+            'type': 'appearance',
+            'href': '/joel-matip/leistungsdaten/spieler/82105',
+            'seasoned_href': 'https://www.transfermarkt.co.uk/joel-matip/leistungsdaten/spieler/82105/plus/0?saison=2020',
+            'parent': {'type': 'player', 'href': '/joel-matip/profil/spieler/82105'},
+            'result': '0:2',
+        },
+    ]:
+        p.process_item(item, spider)
+    p.close_spider(spider)
+
+    for table, seasons in [
+        ('confederations', None), ('competitions', None), ('game_lineups', [2020, 2020]), ('appearances', [2020])
+    ]:
+        data = ds.dataset(str(tmp_path / table), partitioning='hive').to_table()
+        if seasons is None:
+            assert 'crawl_season' not in data.column_names
+            assert data.num_rows == 1
+        else:
+            assert data.column('crawl_season').to_pylist() == seasons
+
+
+def test_parquet_open_files_and_buffered_rows_are_bounded(tmp_path):
+    ds = pytest.importorskip('pyarrow.dataset')
+    spider = Spider('clubs')
+    p = ParquetPipeline(get_crawler().stats, parquet_dir=str(tmp_path), max_open_files=2, max_buffered_rows=5)
+    p.open_spider(spider)
+    for i in range(40):
+        season = 2000 + i % 4
+        item = dict(club('arsenal', i), parent={
+            'href': COMPETITION['href'], 'seasoned_href': f"{COMPETITION['href']}/plus/0?saison_id={season}",
+        })
+        p.process_item(item, spider)
+        assert len(p.writers) <= 2
+        assert p.buffered < 5
+    p.close_spider(spider)
+
+    data = ds.dataset(str(tmp_path / 'clubs'), partitioning='hive').to_table()
+    assert sorted(data.column('crawl_season').to_pylist()) == sorted(2000 + i % 4 for i in range(40))
+    assert p.stats.get_value('parquet/evicted_files') > 0
@@ -0,0 +1,161 @@
+import json
+import os
+import sys
+import threading
+import time
+
+import pytest
+from scrapy.crawler import Crawler
+from scrapy.exceptions import DontCloseSpider
+from scrapy.settings import Settings
+from twisted.internet.task import Clock, LoopingCall
+
+from tfmkt.spiders import common
+from tfmkt.spiders.clubs import ClubsSpider
+from tfmkt.spiders.players import PlayersSpider
+
+
+def parents_file(tmp_path, count=5):
+  path = tmp_path / 'competitions.json'
+  path.write_text('\n'.join(
+    json.dumps({'type': 'competition', 'href': f'/x/startseite/wettbewerb/C{i}'}) for i in range(count)
+  ))
+  return str(path)
+
+
+def test_shard_jobdir_given_in_command_line(tmp_path):
+  settings = Settings()
+  settings.set('JOBDIR', str(tmp_path / 'jobs'), priority='cmdline')
+  crawler = Crawler(ClubsSpider, settings)
+  crawler._create_spider(parents=parents_file(tmp_path), shard='1/4')
+  assert crawler.settings['JOBDIR'] == str(tmp_path / 'jobs' / 'shard-1-of-4')
+
+
+def test_shards_split_season_discovery(tmp_path):
+  # players are crawled from clubs, whose seasons are discovered without "-a seasons"
+  path = tmp_path / 'clubs.json'
+  path.write_text('\n'.join(json.dumps({'type': 'club', 'href': f'/x/startseite/verein/{i}'}) for i in range(20)))
+  requested = []
+  for i in range(4):
+    spider = PlayersSpider(parents=str(path), shard=f'{i}/4')
+    requested.append([
+      request.cb_kwargs['parent']['href']
+      for parent in spider.entrypoints for request in spider.parent_requests(parent)
+    ])
+  hrefs = [href for shard in requested for href in shard]
+  assert sorted(hrefs) == sorted(f'/x/startseite/verein/{i}' for i in range(20))
+
+
+class Engine:
+  """Collects the requests a spider schedules, always having room for more."""
+
+  def __init__(self):
+    self.requests = []
+    self.scheduler = self
+
+  def needs_backout(self):
+    return False
+
+  def has_pending_requests(self):
+    return False
+
+  def crawl(self, request):
+    self.requests.append(request)
+
+
+def test_parents_piped_slowly(monkeypatch):
+  clock = Clock()
+
+  class ClockLoopingCall(LoopingCall):
+    def __init__(self, f):
+      super().__init__(f)
+      self.clock = clock
+
+  monkeypatch.setattr(common, 'LoopingCall', ClockLoopingCall)
+  read_fd, write_fd = os.pipe()
+  monkeypatch.setattr(sys, 'stdin', os.fdopen(read_fd))
+
+  def upstream():
+    with os.fdopen(write_fd, 'w') as pipe:
+      for i in range(3):
+        pipe.write(json.dumps({'type': 'club', 'href': f'/x/startseite/verein/{i}'}) + '\n')
+        pipe.flush()
+        time.sleep(0.5)
+
+  writer = threading.Thread(target=upstream)
+  writer.start()
+  crawler = Crawler(ClubsSpider, Settings())
+  spider = crawler._create_spider(seasons='2020')
+  crawler.engine = Engine()
+  assert list(spider.start_requests()) == []
+
+  requested_while_writing, slowest_feed = 0, 0
+  deadline = time.monotonic() + 10
+  while spider.feeder.running and time.monotonic() < deadline:
+    with pytest.raises(DontCloseSpider):
+      spider.keep_feeding(spider)
+    started = time.monotonic()
+    clock.advance(spider.FEED_INTERVAL)
+    slowest_feed = max(slowest_feed, time.monotonic() - started)
+    if writer.is_alive():
+      requested_while_writing = len(crawler.engine.requests)
+    time.sleep(0.02)
+  writer.join()
+
+  # the first parents were crawled while upstream was still writing, and the reactor never waited for it
+  assert requested_while_writing >= 1
+  assert slowest_feed < 0.1
+  assert [request.url for request in crawler.engine.requests] == [
+    f'https://www.transfermarkt.co.uk/x/startseite/verein/{i}/saison_id/2020' for i in range(3)
+  ]
+  spider.keep_feeding(spider)
+
+
+def test_read_files_streams_in_file_order(tmp_path):
+  import gzip
+  names = []
+  for i in range(5):
+    name = tmp_path / f'part-{i}.json.gz'
+    with gzip.open(name, 'wt') as f:
+      f.write(''.join(json.dumps({'file': i, 'line': j}) + '\n' for j in range(50)))
+    names.append(str(name))
+
+  lines = list(common.read_files(names, workers=3, window=4))
+  assert [(line['file'], line['line']) for line in lines] == [(i, j) for i in range(5) for j in range(50)]
+
+  # a reading stopped early lets the workers go
+  reading = common.read_files(names, workers=3, window=4)
+  assert next(reading) == {'file': 0, 'line': 0}
+  reading.close()
+
+
+def test_dedupe_store_skips_the_hrefs_fetched_recently(tmp_path, monkeypatch):
+  path = str(tmp_path / 'players.sqlite3')
+  now = [1000.0]
+  monkeypatch.setattr(common.time, 'time', lambda: now[0])
+
+  store = common.DedupeStore(path, freshness_secs=500)
+  store.fetched('/old')
+  now[0] = 1900.0
+  store.fetched('/new')
+  # followed in this run only, and not persisted
+  store.add('/followed')
+  assert {'/old', '/new', '/followed'} <= set(store.keys)
+  store.close()
+
+  now[0] = 2000.0
+  store = common.DedupeStore(path, freshness_secs=500)
+  assert '/new' in store and '/old' not in store and '/followed' not in store
+  # fetching again makes an href fresh again
+  store.fetched('/old')
+  store.close()
+
+  now[0] = 2200.0
+  store = common.DedupeStore(path, freshness_secs=500)
+  assert '/old' in store and '/new' in store
+  store.close()
+
+  now[0] = 10 ** 9
+  store = common.DedupeStore(path, freshness_secs=0)
+  assert len(store) == 2
+  store.close()
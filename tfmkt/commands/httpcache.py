@@ -0,0 +1,110 @@
+import re
+from collections import defaultdict
+from time import time
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+from tfmkt.httpcache import CACHES, PAGE_TYPES, page_type
+from tfmkt.utils import url_season
+
+
+class Command(ScrapyCommand):
+  """Report on and prune the HTTP cache (HTTPCACHE_DIR) of the spiders, or of all spiders with a cache.
+
+    scrapy httpcache stats [spider ...]
+    scrapy httpcache evict [--older-than DAYS] [--page-type TYPE] [--url REGEX] [--season SEASON] [--dry-run] [spider ...]
+    scrapy httpcache compact [spider ...]
+
+  "stats" counts the entries and bytes per spider, page type (see tfmkt.httpcache.PAGE_TYPES) and season,
+  "evict" deletes the entries matching all the options given and "compact" gives the space of the deleted entries
+  back. Entries are scanned one at a time, reading their metadata only, so it works on caches of any size.
+  """
+
+  requires_project = True
+
+  def syntax(self):
+    return "stats|evict|compact [options] [spider ...]"
+
+  def short_desc(self):
+    return "Show HTTP cache statistics, evict entries by age or url and compact the cache"
+
+  def add_options(self, parser):
+    super().add_options(parser)
+    parser.add_argument("--older-than", type=float, metavar="DAYS", help="evict entries stored more than DAYS ago")
+    parser.add_argument(
+      "--page-type", action="append", default=[], metavar="TYPE",
+      help=f"evict entries of a page type: {', '.join(name for name, _ in PAGE_TYPES)} or other"
+    )
+    parser.add_argument("--url", metavar="REGEX", help="evict entries whose url matches REGEX")
+    parser.add_argument("--season", type=int, action="append", default=[], help="evict entries of a season")
+    parser.add_argument("--dry-run", action="store_true", help="only count the entries that would be evicted")
+
+  def run(self, args, opts):
+    if not args or args[0] not in ('stats', 'evict', 'compact'):
+      raise UsageError()
+    action, spiders = args[0], args[1:]
+
+    storage = self.settings['HTTPCACHE_STORAGE']
+    if storage not in CACHES:
+      raise UsageError(f"HTTPCACHE_STORAGE {storage} is not supported, expected one of: {', '.join(CACHES)}")
+    cache = CACHES[storage](self.settings)
+    missing = [spider for spider in spiders if not cache.exists(spider)]
+    if missing:
+      raise UsageError(f"No HTTP cache in {cache.cachedir} for: {', '.join(missing)}")
+    spiders = spiders or cache.spiders()
+
+    if action == 'stats':
+      self.stats(cache, spiders)
+    elif action == 'evict':
+      self.evict(cache, spiders, opts)
+    else:
+      for spider in spiders:
+        cache.compact(spider)
+        print(f"{spider}: compacted")
+
+  def stats(self, cache, spiders):
+    groups = {
+      'spider': defaultdict(lambda: [0, 0, 0]),
+      'page type': defaultdict(lambda: [0, 0, 0]),
+      'season': defaultdict(lambda: [0, 0, 0]),
+    }
+    for spider in spiders:
+      for entry in cache.scan(spider):
+        season = url_season(entry.url)
+        for group, key in (('spider', spider), ('page type', page_type(entry.url)), ('season', season or '-')):
+          counts = groups[group][key]
+          counts[0] += 1
+          counts[1] += entry.stored_size
+          counts[2] += entry.size or 0
+
+    for group, counts in groups.items():
+      print(f"{group:<16} {'entries':>10} {'stored bytes':>16} {'body bytes':>16}")
+      for key, (entries, stored_size, size) in sorted(counts.items(), key=lambda item: str(item[0])):
+        print(f"{key:<16} {entries:>10} {stored_size:>16} {size:>16}")
+      print()
+
+  def evict(self, cache, spiders, opts):
+    if opts.older_than is None and not opts.page_type and opts.url is None and not opts.season:
+      raise UsageError("evict needs at least one of --older-than, --page-type, --url or --season")
+
+    before = time() - opts.older_than * 24 * 3600 if opts.older_than is not None else None
+    url_pattern = re.compile(opts.url) if opts.url is not None else None
+
+    def predicate(entry):
+      return (
+        (before is None or entry.timestamp < before)
+        and (not opts.page_type or page_type(entry.url) in opts.page_type)
+        and (url_pattern is None or url_pattern.search(entry.url))
+        and (not opts.season or url_season(entry.url) in opts.season)
+      )
+
+    for spider in spiders:
+      if opts.dry_run:
+        count, size = 0, 0
+        for entry in cache.scan(spider):
+          if predicate(entry):
+            count, size = count + 1, size + entry.stored_size
+      else:
+        count, size = cache.evict(spider, predicate)
+      print(f"{spider}: {count} entries ({size} bytes) {'would be ' if opts.dry_run else ''}evicted")
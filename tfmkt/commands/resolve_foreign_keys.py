@@ -0,0 +1,35 @@
+from scrapy.commands import ScrapyCommand
+
+from tfmkt.pipelines import FOREIGN_KEYS, backend_from_settings
+
+
+class Command(ScrapyCommand):
+  """Fill the foreign key id columns of the database tables from their href columns.
+
+  This is the standalone version of what DatabasePipeline does when the spider closes with
+  DATABASE_DEFER_FOREIGN_KEYS enabled, and can be run once all crawls are done.
+
+    scrapy resolve_foreign_keys [table ...]
+  """
+
+  requires_project = True
+
+  def syntax(self):
+    return "[table ...]"
+
+  def short_desc(self):
+    return "Fill foreign key ids (competition_id, club ids, ...) from the stored hrefs"
+
+  def run(self, args, opts):
+    tables = args or list(FOREIGN_KEYS.keys())
+
+    backend = backend_from_settings(self.settings)
+    backend.connect()
+    try:
+      updated = backend.resolve_foreign_keys(tables)
+      backend.commit()
+    finally:
+      backend.close()
+
+    for column, count in updated.items():
+      print(f"{column}: {count} rows updated")
@@ -0,0 +1,651 @@
+import calendar
+import gzip
+import json
+import logging
+import os
+import socket
+import pickle
+import re
+import sqlite3
+from collections import namedtuple
+from time import time
+
+from scrapy.downloadermiddlewares.httpcache import HttpCacheMiddleware
+from scrapy.exceptions import IgnoreRequest
+from scrapy.extensions.httpcache import DummyPolicy, rfc1123_to_epoch
+from scrapy.http import Headers, TextResponse
+from scrapy.responsetypes import responsetypes
+from scrapy.settings import SETTINGS_PRIORITIES
+from scrapy.utils.project import data_path
+from w3lib.http import headers_dict_to_raw, headers_raw_to_dict
+
+from tfmkt.utils import current_season, url_season
+
+logger = logging.getLogger(__name__)
+
+# the kinds of page in the cache, for the "httpcache" command. The first pattern matching the url wins
+PAGE_TYPES = [
+    ('ceapi', re.compile(r'/ceapi/')),
+    ('spielbericht', re.compile(r'/spielbericht/')),
+    ('gesamtspielplan', re.compile(r'/gesamtspielplan/')),
+    ('kader', re.compile(r'/(kader|startseite)/verein/')),
+    ('profil', re.compile(r'/profil/spieler/')),
+    ('leistungsdaten', re.compile(r'/leistungsdaten/')),
+    ('wettbewerb', re.compile(r'wettbewerb')),
+]
+
+
+def page_type(url):
+    """The kind of page an url is for (see PAGE_TYPES), "other" if it is none of them.
+    """
+    return next((name for name, pattern in PAGE_TYPES if pattern.search(url)), 'other')
+
+
+# an entry of the HTTP cache, as scanned by the "httpcache" command: its key in the storage, the url of the
+# response, the bytes it takes in the storage, the size of the (uncompressed) body and when it was stored
+CacheEntry = namedtuple('CacheEntry', ['key', 'url', 'stored_size', 'size', 'timestamp'])
+
+
+class RevalidatingPolicy(DummyPolicy):
+    """An HTTP cache policy that stores every response, like the default DummyPolicy, but only serves it without
+    asking the server for HTTPCACHE_REVALIDATE_SECS after it was fetched. Once it is older, the request is sent
+    with the validators of the cached response (`If-None-Match` for its ETag, `If-Modified-Since` for its
+    Last-Modified) and a 304 Not Modified answer is served from the cache, so refreshing unchanged pages (and
+    the ceapi JSON endpoints) only moves headers. Responses without validators are fetched in full.
+
+    Transfermarkt does not send freshness information (Cache-Control / Expires) that RFC2616Policy could use, so
+    the age of an entry is taken from its Date header instead, which HttpCacheMiddleware sets if missing.
+    Entries must not expire in the storage (HTTPCACHE_EXPIRATION_SECS = 0), as expired entries are not given to
+    the policy and cannot be revalidated. The refreshed headers of a revalidated entry only reach the storage
+    with RevalidatingCacheMiddleware.
+    """
+
+    def __init__(self, settings):
+        super().__init__(settings)
+        self.revalidate_secs = settings.getint('HTTPCACHE_REVALIDATE_SECS', 0)
+
+    def should_cache_response(self, response, request):
+        # a 304 is the answer to a revalidation, the cached response is stored instead
+        return response.status != 304 and super().should_cache_response(response, request)
+
+    def max_age(self, cachedresponse, request):
+        """For how many seconds a cached response is served without revalidation, 0 for ever.
+        """
+        return self.revalidate_secs
+
+    def response_age(self, cachedresponse):
+        date = rfc1123_to_epoch(cachedresponse.headers.get(b'Date'))
+        if date is None:
+            return None
+        return max(0, time() - date)
+
+    def is_cached_response_fresh(self, cachedresponse, request):
+        max_age = self.max_age(cachedresponse, request)
+        if not max_age:
+            return True
+
+        age = self.response_age(cachedresponse)
+        if age is not None and age < max_age:
+            return True
+
+        self.set_conditional_validators(request, cachedresponse)
+        return False
+
+    def is_cached_response_valid(self, cachedresponse, response, request):
+        # keep serving the cached response if the server says it has not changed, or is failing
+        if response.status == 304:
+            # the revalidated entry is fresh again from the date of the 304
+            for header in (b'Date', b'ETag', b'Last-Modified'):
+                if header in response.headers:
+                    cachedresponse.headers[header] = response.headers[header]
+            return True
+        return response.status >= 500
+
+    def set_conditional_validators(self, request, cachedresponse):
+        if b'ETag' in cachedresponse.headers:
+            request.headers[b'If-None-Match'] = cachedresponse.headers[b'ETag']
+        if b'Last-Modified' in cachedresponse.headers:
+            request.headers[b'If-Modified-Since'] = cachedresponse.headers[b'Last-Modified']
+
+
+class UrlRulesPolicy(RevalidatingPolicy):
+    """A RevalidatingPolicy that tells for how long a cached page is served without revalidation from its url,
+    as most of what is crawled is history that does not change any more:
+
+    - the first of the HTTPCACHE_REVALIDATE_RULES (a mapping of url regular expressions to seconds) that matches
+      the url decides, if any
+    - game pages (/spielbericht/) never expire once the game was played, i.e. once the cached page has a result
+    - pages of a past season (from the saison_id in their url) never expire, as long as they were cached after
+      the season was over
+    - pages of the current season are revalidated after HTTPCACHE_CURRENT_SEASON_REVALIDATE_SECS
+    - any other page (player profiles, ceapi endpoints, ...) after HTTPCACHE_REVALIDATE_SECS
+
+    A rule of 0 or None means that the matching pages never expire.
+    """
+
+    GAME_PATTERN = re.compile(r'/spielbericht/')
+    RESULT_PATTERN = re.compile(r'\d+\s*:\s*\d+')
+
+    def __init__(self, settings):
+        super().__init__(settings)
+        self.current_season_secs = settings.getint('HTTPCACHE_CURRENT_SEASON_REVALIDATE_SECS', self.revalidate_secs)
+        self.rules = [
+            (re.compile(pattern), secs)
+            for pattern, secs in settings.getdict('HTTPCACHE_REVALIDATE_RULES').items()
+        ]
+
+    def max_age(self, cachedresponse, request):
+        for pattern, secs in self.rules:
+            if pattern.search(request.url):
+                return secs or 0
+
+        if self.GAME_PATTERN.search(request.url):
+            return 0 if self.is_played_game(cachedresponse) else self.current_season_secs
+
+        season = url_season(request.url)
+        if season is None:
+            return self.revalidate_secs
+        if season < current_season() and self.cached_after_season(cachedresponse, season):
+            return 0
+        return self.current_season_secs
+
+    def is_played_game(self, cachedresponse):
+        if not isinstance(cachedresponse, TextResponse):
+            return False
+        result = cachedresponse.css('div.sb-endstand::text').get()
+        return bool(result and self.RESULT_PATTERN.search(result))
+
+    def cached_after_season(self, cachedresponse, season):
+        # seasons end by July of the following year
+        date = rfc1123_to_epoch(cachedresponse.headers.get(b'Date'))
+        return date is not None and date >= calendar.timegm((season + 1, 7, 1, 0, 0, 0))
+
+
+class BodyCodec:
+    """Compression of the bodies stored by SqliteCacheStorage and SharedCacheStorage: zstd (it needs the
+    zstandard package, which is only imported when used) unless HTTPCACHE_COMPRESSION is empty. Storages record
+    the compression of each entry, so the setting can be changed on an existing cache.
+    """
+
+    def __init__(self, settings):
+        self.compression = settings.get('HTTPCACHE_COMPRESSION', 'zstd') or None
+        self.level = settings.getint('HTTPCACHE_COMPRESSION_LEVEL', 3)
+        self.compressor = None
+        self.decompressor = None
+
+    def compress(self, body):
+        if self.compression is None:
+            return body
+        if self.compressor is None:
+            import zstandard
+            self.compressor = zstandard.ZstdCompressor(level=self.level)
+        return self.compressor.compress(body)
+
+    def decompress(self, body, compression):
+        if compression is None:
+            return body
+        if self.decompressor is None:
+            import zstandard
+            self.decompressor = zstandard.ZstdDecompressor()
+        return self.decompressor.decompress(body)
+
+
+class SqliteCacheStorage:
+    """An HTTP cache storage that keeps all the responses of a spider in a single SQLite file,
+    HTTPCACHE_DIR/<spider>.sqlite3, keyed by request fingerprint, instead of several files per response like
+    FilesystemCacheStorage. Bodies are compressed with zstd, see BodyCodec.
+
+    The url, status, size and time of every entry are stored as plain columns, so that the cache can be inspected
+    and pruned without reading the bodies (see the "httpcache" command).
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS response (
+            fingerprint BLOB PRIMARY KEY,
+            url TEXT NOT NULL,
+            status INTEGER NOT NULL,
+            headers BLOB NOT NULL,
+            body BLOB NOT NULL,
+            compression TEXT,
+            size INTEGER NOT NULL,
+            timestamp REAL NOT NULL
+        ) WITHOUT ROWID
+    """
+
+    def __init__(self, settings):
+        self.cachedir = data_path(settings['HTTPCACHE_DIR'], createdir=True)
+        self.expiration_secs = settings.getint('HTTPCACHE_EXPIRATION_SECS')
+        self.codec = BodyCodec(settings)
+        self.connection = None
+
+    @classmethod
+    def path(cls, cachedir, spider_name):
+        return os.path.join(cachedir, f"{spider_name}.sqlite3")
+
+    @classmethod
+    def connect(cls, path):
+        connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=wal')
+        connection.execute('PRAGMA synchronous=normal')
+        connection.execute(cls.SCHEMA)
+        return connection
+
+    def open_spider(self, spider):
+        path = self.path(self.cachedir, spider.name)
+        self.connection = self.connect(path)
+        logger.debug("Using SQLite cache storage in %(cachepath)s", {'cachepath': path}, extra={'spider': spider})
+
+        self._fingerprinter = spider.crawler.request_fingerprinter
+
+    def close_spider(self, spider):
+        self.connection.close()
+
+    def retrieve_response(self, spider, request):
+        row = self.connection.execute(
+            'select url, status, headers, body, compression, timestamp from response where fingerprint = ?',
+            (self._fingerprinter.fingerprint(request),)
+        ).fetchone()
+        if row is None:
+            return None  # not cached
+
+        url, status, raw_headers, body, compression, timestamp = row
+        if 0 < self.expiration_secs < time() - timestamp:
+            return None  # expired
+
+        body = self.codec.decompress(body, compression)
+        headers = Headers(headers_raw_to_dict(raw_headers))
+        request.meta['cache_timestamp'] = timestamp
+        respcls = responsetypes.from_args(headers=headers, url=url, body=body)
+        return respcls(url=url, headers=headers, status=status, body=body)
+
+    def store_response(self, spider, request, response):
+        body = self.codec.compress(response.body)
+        self.connection.execute(
+            'insert or replace into response (fingerprint, url, status, headers, body, compression, size, timestamp) '
+            'values (?, ?, ?, ?, ?, ?, ?, ?)',
+            (
+                self._fingerprinter.fingerprint(request), response.url, response.status,
+                headers_dict_to_raw(response.headers), body, self.codec.compression, len(response.body), time()
+            )
+        )
+
+
+class SharedCacheStorage:
+    """An HTTP cache storage that keeps each response in its own file, HTTPCACHE_DIR/objects/ab/cd/abcd..., named
+    after the request fingerprint (and not the spider), so that a directory shared by several scraper nodes (e.g.
+    on NFS) lets a page fetched by any of them be reused by all.
+
+    Files are written to a temporary name and renamed into place, which is atomic, so readers never take locks and
+    only ever see complete entries, the latest one if several nodes stored the same page. A file is a JSON line
+    of metadata, followed by the raw headers and the (compressed, see BodyCodec) body.
+    """
+
+    def __init__(self, settings):
+        self.cachedir = data_path(settings['HTTPCACHE_DIR'], createdir=True)
+        self.expiration_secs = settings.getint('HTTPCACHE_EXPIRATION_SECS')
+        self.codec = BodyCodec(settings)
+        # temporary files are unique to each node and process
+        self.temp_suffix = f".{socket.gethostname()}.{os.getpid()}.tmp"
+
+    @classmethod
+    def path(cls, cachedir, key):
+        return os.path.join(cachedir, 'objects', key[0:2], key[2:4], key)
+
+    @classmethod
+    def read_meta(cls, f):
+        return json.loads(f.readline())
+
+    def open_spider(self, spider):
+        logger.debug("Using shared cache storage in %(cachepath)s", {'cachepath': self.cachedir}, extra={'spider': spider})
+        self._fingerprinter = spider.crawler.request_fingerprinter
+
+    def close_spider(self, spider):
+        pass
+
+    def retrieve_response(self, spider, request):
+        path = self.path(self.cachedir, self._fingerprinter.fingerprint(request).hex())
+        try:
+            with open(path, 'rb') as f:
+                meta = self.read_meta(f)
+                if 0 < self.expiration_secs < time() - meta['timestamp']:
+                    return None  # expired
+                raw_headers = f.read(meta['headers_size'])
+                body = f.read()
+        except FileNotFoundError:
+            return None  # not cached
+
+        body = self.codec.decompress(body, meta['compression'])
+        headers = Headers(headers_raw_to_dict(raw_headers))
+        request.meta['cache_timestamp'] = meta['timestamp']
+        url = meta['url']
+        respcls = responsetypes.from_args(headers=headers, url=url, body=body)
+        return respcls(url=url, headers=headers, status=meta['status'], body=body)
+
+    def store_response(self, spider, request, response):
+        path = self.path(self.cachedir, self._fingerprinter.fingerprint(request).hex())
+        raw_headers = headers_dict_to_raw(response.headers)
+        meta = {
+            'url': response.url,
+            'status': response.status,
+            'compression': self.codec.compression,
+            'size': len(response.body),
+            'headers_size': len(raw_headers),
+            'timestamp': time(),
+        }
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = path + self.temp_suffix
+        with open(temp_path, 'wb') as f:
+            f.write(json.dumps(meta).encode('utf-8') + b'\n')
+            f.write(raw_headers)
+            f.write(self.codec.compress(response.body))
+        os.replace(temp_path, path)
+
+
+class SqliteCache:
+    """Maintenance of the files of SqliteCacheStorage: scan, eviction and compaction.
+    """
+
+    def __init__(self, settings):
+        self.cachedir = data_path(settings['HTTPCACHE_DIR'])
+
+    def spiders(self):
+        if not os.path.isdir(self.cachedir):
+            return []
+        return sorted(name[:-len('.sqlite3')] for name in os.listdir(self.cachedir) if name.endswith('.sqlite3'))
+
+    def exists(self, spider_name):
+        return os.path.isfile(SqliteCacheStorage.path(self.cachedir, spider_name))
+
+    def connect(self, spider_name):
+        """Connect to the file of a spider's cache, which is never created here, unlike by the storage.
+        """
+        path = SqliteCacheStorage.path(self.cachedir, spider_name)
+        if not self.exists(spider_name):
+            raise FileNotFoundError(f"No HTTP cache for spider {spider_name}: {path} does not exist")
+        return SqliteCacheStorage.connect(path)
+
+    def scan(self, spider_name):
+        """Iterate over the entries of a spider's cache, without reading the bodies.
+        """
+        connection = self.connect(spider_name)
+        try:
+            cursor = connection.execute(
+                'select fingerprint, url, length(headers) + length(body), size, timestamp from response'
+            )
+            for row in cursor:
+                yield CacheEntry(*row)
+        finally:
+            connection.close()
+
+    def evict(self, spider_name, predicate, batch_size=1000):
+        """Delete the entries for which `predicate(entry)` is true, in batches while scanning.
+
+        :return: The entries and bytes evicted
+        :rtype: typing.Tuple[int, int]
+        """
+        connection = self.connect(spider_name)
+        count, size, batch = 0, 0, []
+
+        def delete(batch):
+            # the connection is in autocommit mode, in which every deleted row would be a transaction of its own
+            connection.execute('BEGIN')
+            connection.executemany('delete from response where fingerprint = ?', batch)
+            connection.execute('COMMIT')
+
+        try:
+            for entry in self.scan(spider_name):
+                if predicate(entry):
+                    count, size = count + 1, size + entry.stored_size
+                    batch.append((entry.key,))
+                if len(batch) >= batch_size:
+                    delete(batch)
+                    batch = []
+            if batch:
+                delete(batch)
+        finally:
+            connection.close()
+        return count, size
+
+    def compact(self, spider_name):
+        connection = self.connect(spider_name)
+        try:
+            connection.execute('VACUUM')
+            connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        finally:
+            connection.close()
+
+
+class FilesystemCache:
+    """Maintenance of the directories of scrapy's FilesystemCacheStorage (HTTPCACHE_DIR/<spider>/<fingerprint
+    prefix>/<fingerprint>/): scan, eviction and compaction.
+    """
+
+    def __init__(self, settings):
+        self.cachedir = data_path(settings['HTTPCACHE_DIR'])
+        self.use_gzip = settings.getbool('HTTPCACHE_GZIP')
+
+    def spiders(self):
+        if not os.path.isdir(self.cachedir):
+            return []
+        return sorted(entry.name for entry in os.scandir(self.cachedir) if entry.is_dir())
+
+    def exists(self, spider_name):
+        return os.path.isdir(os.path.join(self.cachedir, spider_name))
+
+    def scan(self, spider_name):
+        """Iterate over the entries of a spider's cache, reading only their metadata.
+        """
+        spider_dir = os.path.join(self.cachedir, spider_name)
+        for prefix in os.scandir(spider_dir):
+            if not prefix.is_dir():
+                continue
+            for entry in os.scandir(prefix.path):
+                meta_path = os.path.join(entry.path, 'pickled_meta')
+                try:
+                    files = { f.name: f.stat().st_size for f in os.scandir(entry.path) }
+                    timestamp = os.stat(meta_path).st_mtime
+                    with (gzip.open if self.use_gzip else open)(meta_path, 'rb') as f:
+                        meta = pickle.load(f)
+                except (OSError, EOFError, pickle.UnpicklingError):
+                    continue  # being written or removed
+                yield CacheEntry(
+                    entry.path, meta.get('response_url') or meta['url'], sum(files.values()),
+                    None if self.use_gzip else files.get('response_body'), timestamp
+                )
+
+    def evict(self, spider_name, predicate):
+        count, size = 0, 0
+        for entry in self.scan(spider_name):
+            if predicate(entry):
+                for name in os.listdir(entry.key):
+                    os.remove(os.path.join(entry.key, name))
+                os.rmdir(entry.key)
+                count, size = count + 1, size + entry.stored_size
+        return count, size
+
+    def compact(self, spider_name):
+        # there is nothing to compact but the fingerprint prefix directories left empty by evictions
+        spider_dir = os.path.join(self.cachedir, spider_name)
+        for prefix in os.scandir(spider_dir):
+            if prefix.is_dir() and not os.listdir(prefix.path):
+                os.rmdir(prefix.path)
+
+
+class SharedCache:
+    """Maintenance of the directory of SharedCacheStorage: scan, eviction and compaction. As entries are not
+    kept per spider, it has a single "spider", named "shared".
+    """
+
+    # temporary files older than this were left by writers that died
+    STALE_TEMP_SECS = 3600
+
+    def __init__(self, settings):
+        self.cachedir = data_path(settings['HTTPCACHE_DIR'])
+
+    def spiders(self):
+        return ['shared'] if os.path.isdir(os.path.join(self.cachedir, 'objects')) else []
+
+    def exists(self, spider_name):
+        # the cache is shared by all spiders
+        return os.path.isdir(os.path.join(self.cachedir, 'objects'))
+
+    def directories(self):
+        objects = os.path.join(self.cachedir, 'objects')
+        for prefix in os.scandir(objects):
+            if prefix.is_dir():
+                for subprefix in os.scandir(prefix.path):
+                    if subprefix.is_dir():
+                        yield subprefix.path
+
+    def scan(self, spider_name):
+        """Iterate over the entries of the cache, reading only their metadata line.
+        """
+        for directory in self.directories():
+            for entry in os.scandir(directory):
+                if entry.name.endswith('.tmp'):
+                    continue
+                try:
+                    stored_size = entry.stat().st_size
+                    with open(entry.path, 'rb') as f:
+                        meta = SharedCacheStorage.read_meta(f)
+                except (OSError, ValueError):
+                    continue  # replaced or removed meanwhile
+                yield CacheEntry(entry.path, meta['url'], stored_size, meta['size'], meta['timestamp'])
+
+    def evict(self, spider_name, predicate):
+        count, size = 0, 0
+        for entry in self.scan(spider_name):
+            if predicate(entry):
+                try:
+                    os.remove(entry.key)
+                except FileNotFoundError:
+                    continue
+                count, size = count + 1, size + entry.stored_size
+        return count, size
+
+    def compact(self, spider_name):
+        # remove the temporary files of dead writers and the directories left empty by evictions
+        for directory in list(self.directories()):
+            for entry in os.scandir(directory):
+                if entry.name.endswith('.tmp') and time() - entry.stat().st_mtime > self.STALE_TEMP_SECS:
+                    os.remove(entry.path)
+            if not os.listdir(directory):
+                os.rmdir(directory)
+        objects = os.path.join(self.cachedir, 'objects')
+        for prefix in os.scandir(objects):
+            if prefix.is_dir() and not os.listdir(prefix.path):
+                os.rmdir(prefix.path)
+
+
+# the maintenance class of each HTTPCACHE_STORAGE supported by the "httpcache" command
+CACHES = {
+    'tfmkt.httpcache.SqliteCacheStorage': SqliteCache,
+    'tfmkt.httpcache.SharedCacheStorage': SharedCache,
+    'scrapy.extensions.httpcache.FilesystemCacheStorage': FilesystemCache,
+}
+
+
+class RevalidatingCacheMiddleware(HttpCacheMiddleware):
+    """The HttpCacheMiddleware of revalidating policies (see RevalidatingPolicy): a cached response that a 304
+    revalidated is stored again, with the headers the policy refreshed, so that it is served as fresh from then on
+    rather than revalidated on every request. Scrapy versions whose HttpCacheMiddleware stores it themselves are
+    left to do it.
+    """
+
+    STORES_REVALIDATED = hasattr(HttpCacheMiddleware, '_freshen_cached_response')
+
+    def spider_opened(self, spider):
+        super().spider_opened(spider)
+        self.spider = spider
+
+    def process_response(self, request, response, *args, **kwargs):
+        cachedresponse = request.meta.get('cached_response')
+        result = super().process_response(request, response, *args, **kwargs)
+        if (
+            not self.STORES_REVALIDATED and response.status == 304
+            and cachedresponse is not None and result is cachedresponse
+        ):
+            self.stats.inc_value('httpcache/store')
+            self.storage.store_response(self.spider, request, cachedresponse)
+        return result
+
+
+def apply_replay_settings(settings):
+    """Switch a crawl to replay mode (HTTPCACHE_REPLAY), where every response comes from the HTTP cache as it is
+    and nothing is downloaded: ReplayCacheMiddleware takes the place of the cache middleware, and the politeness
+    settings (robots.txt, delays, autothrottle, per domain limits) are lifted, since the only limit left is the
+    CPU spent parsing. Settings given in the command line still take precedence.
+
+    Concurrency is raised to HTTPCACHE_REPLAY_CONCURRENT_REQUESTS, unless CONCURRENT_REQUESTS or
+    CONCURRENT_REQUESTS_PER_DOMAIN were set by the spider or in the command line. Cached responses are read without
+    waiting on the network, so it only needs to be high enough for the engine to never wait for a free slot: all
+    the parsing happens in the reactor thread, and more requests in flight would only hold more responses in memory.
+
+    :param settings: The crawler settings, before they are frozen
+    :type settings: scrapy.settings.Settings
+    """
+    concurrency = settings.getint('HTTPCACHE_REPLAY_CONCURRENT_REQUESTS', 100)
+    middlewares = settings.getdict('DOWNLOADER_MIDDLEWARES')
+    cache_middlewares = (
+        'scrapy.downloadermiddlewares.httpcache.HttpCacheMiddleware',
+        'tfmkt.httpcache.RevalidatingCacheMiddleware',
+    )
+    order = next(filter(None, (middlewares.get(name) for name in cache_middlewares)), 900)
+    middlewares.update({name: None for name in cache_middlewares})
+    middlewares['tfmkt.httpcache.ReplayCacheMiddleware'] = order
+    for name, value in {
+        'DOWNLOADER_MIDDLEWARES': middlewares,
+        'HTTPCACHE_ENABLED': True,
+        'HTTPCACHE_IGNORE_MISSING': True,
+        # cached responses are served however old they are
+        'HTTPCACHE_POLICY': 'scrapy.extensions.httpcache.DummyPolicy',
+        'HTTPCACHE_EXPIRATION_SECS': 0,
+        'ROBOTSTXT_OBEY': False,
+        'DOWNLOAD_DELAY': 0,
+        'AUTOTHROTTLE_ENABLED': False,
+        'RETRY_ENABLED': False,
+    }.items():
+        settings.set(name, value, priority='spider')
+    for name in ('CONCURRENT_REQUESTS', 'CONCURRENT_REQUESTS_PER_DOMAIN'):
+        if settings.getpriority(name) <= SETTINGS_PRIORITIES['project']:
+            settings.set(name, concurrency, priority='spider')
+
+
+class ReplayCacheMiddleware(HttpCacheMiddleware):
+    """The HttpCacheMiddleware of replay mode (see apply_replay_settings): requests missing from the cache, or that
+    cannot be cached, are dropped instead of downloaded, and their urls are appended to HTTPCACHE_REPLAY_MISSES so
+    they can be fetched by a later, regular, crawl.
+    """
+
+    def __init__(self, settings, stats):
+        super().__init__(settings, stats)
+        self.misses_path = settings.get('HTTPCACHE_REPLAY_MISSES')
+        self.misses = None
+
+    def spider_opened(self, spider):
+        super().spider_opened(spider)
+        if self.misses_path:
+            self.misses = open(self.misses_path, 'a')
+
+    def spider_closed(self, spider):
+        super().spider_closed(spider)
+        if self.misses is not None:
+            self.misses.close()
+
+    def record_miss(self, request):
+        self.stats.inc_value('httpcache/replay_miss')
+        if self.misses is not None:
+            self.misses.write(request.url + '\n')
+
+    def process_request(self, request, *args, **kwargs):
+        try:
+            response = super().process_request(request, *args, **kwargs)
+        except IgnoreRequest:
+            self.record_miss(request)
+            raise
+        if response is None:
+            # not cacheable (dont_cache, ignored scheme, ...), it would otherwise be downloaded
+            self.record_miss(request)
+            raise IgnoreRequest(f"Ignored request that cannot be replayed: {request}")
+        return response
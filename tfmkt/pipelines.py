@@ -1,631 +1,2438 @@
+import hashlib
+import io
 import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple, OrderedDict
+from datetime import datetime
 
 import psycopg2
 from itemadapter import ItemAdapter
+from scrapy.exceptions import UsageError
+from scrapy.utils.defer import deferred_from_coro
+from scrapy.utils.reactor import is_asyncio_reactor_installed
+from twisted.internet import threads
+from twisted.internet.task import LoopingCall
 
+from tfmkt.utils import SEASON_PATTERN, url_season
 
-def quote(s):
+logger = logging.getLogger(__name__)
+
+# upper bounds (in seconds) of the statement latency histogram buckets kept in the stats
+LATENCY_BUCKETS = [(0.01, '10ms'), (0.1, '100ms'), (1.0, '1s'), (10.0, '10s')]
+
+
+def text(s):
     if s:
-        return str(s).replace("'", "''")
+        return str(s)
     else:
         return ''
 
 
+def item_season(item_dic):
+    """The season an item was scraped for, taken from the first seasoned_href found up its parent chain.
+
+    :param item_dic: The item
+    :type item_dic: dict
+    :return: The season, or None if it cannot be told
+    :rtype: int
+    """
+    while isinstance(item_dic, dict):
+        match = SEASON_PATTERN.search(item_dic.get('seasoned_href') or '')
+        if match:
+            return int(match.group(1))
+        item_dic = item_dic.get('parent')
+    return None
+
+
+def date_season(date):
+    """The season of a date such as "Jan 1, 2020". Seasons start in July.
+
+    :param date: The date
+    :type date: str
+    :return: The season, or None if the date cannot be parsed
+    :rtype: int
+    """
+    try:
+        parsed = datetime.strptime(date, '%b %d, %Y')
+    except (TypeError, ValueError):
+        return None
+    return parsed.year if parsed.month >= 7 else parsed.year - 1
+
+
+Table = namedtuple('Table', ['name', 'columns', 'key'])
+
+# upsertable columns of each table (besides created_at/updated_at) and their conflict key.
+# tables are listed in flush order: parents go before the rows that reference them
+TABLES = [
+    Table('competition',
+          ('href', 'tag', 'country_id', 'country_name', 'country_code', 'competition_type', 'content_hash'),
+          ('href',)),
+    Table('club',
+          ('href', 'competition_id', 'competition_href', 'code', 'name', 'coach_name', 'average_age',
+           'foreigners_number', 'foreigners_percentage', 'national_team_players', 'net_transfer_record', 'squad_size', 'stadium_name',
+           'stadium_seats', 'total_market_value', 'content_hash'),
+          ('href',)),
+    Table('game',
+          ('href', 'tm_game_id', 'home_club_href', 'home_club_id', 'home_club_type', 'home_club_position',
+           'home_manager_name', 'away_club_href', 'away_club_id', 'away_club_type', 'away_club_position',
+           'away_manager_name', 'result', 'matchday', 'date', 'stadium', 'attendance', 'referee', 'season',
+           'content_hash'),
+          ('href',)),
+    Table('player',
+          ('href', 'code', 'current_club_id', 'current_club_href', 'name', 'last_name', 'number',
+           'name_in_home_country', 'date_of_birth', 'place_of_birth__country', 'place_of_birth__city', 'age', 'height', 'citizenship',
+           'position', 'image_url', 'player_agent__href', 'player_agent__name', 'foot', 'joined',
+           'contract_expires', 'day_of_last_contract_extension', 'outfitter', 'current_market_value',
+           'highest_market_value', 'highest_market_value_date', 'market_value_last_change',
+           'market_value_details_url', 'social_media', 'transfer_history__fee_sum',
+           'transfer_history__formatted_fee_sum', 'career_stats__total_appearances', 'career_stats__total_goals',
+           'career_stats__total_assists', 'career_stats__total_minutes_per_goal',
+           'career_stats__total_minutes_played', 'content_hash'),
+          ('href',)),
+    Table('player_valuations',
+          ('player_id', 'x', 'y', 'mw', 'datum_mw', 'verein', 'age', 'wappen', 'season', 'content_hash'),
+          ('player_id', 'datum_mw')),
+    Table('player_transfer_history',
+          ('player_id', 'url', 'from_club_emblem_1x', 'from_club_emblem_2x', 'from_club_emblem_mobile',
+           'from_club_name', 'from_country_flag', 'from_href', 'from_is_special', 'from_latitude', 'from_longitude',
+           'to_club_emblem_1x', 'to_club_emblem_2x', 'to_club_emblem_mobile', 'to_club_name', 'to_country_flag',
+           'to_href', 'to_is_special', 'to_latitude', 'to_longitude', 'future_transfer', 'date',
+           'date_unformatted', 'upcoming', 'season', 'market_value', 'fee', 'show_upcoming_header',
+           'show_reset_header', 'content_hash'),
+          ('player_id', 'url')),
+    Table('player_career_stats',
+          ('player_id', 'competition_id', 'competition_href', 'appearances_href', 'appearances_number', 'goals',
+           'assists', 'minutes_per_goal', 'minutes_played', 'content_hash'),
+          ('player_id', 'competition_href')),
+    Table('player_national_team_career',
+          ('player_id', 'club_id', 'club_href', 'country_name', 'country_flag_url', 'debut_date', 'debut_href',
+           'matches_number', 'matches_href', 'tore_number', 'tore_href', 'content_hash'),
+          ('player_id', 'club_href')),
+    Table('game_event',
+          ('game_id', 'ordinal', 'type', 'minute', 'extra_minute', 'player_href', 'club_href', 'club_name', 'result',
+           'description', 'player_in_href', 'player_assist_href', 'content_hash'),
+          ('game_id', 'ordinal')),
+    Table('game_lineup',
+          ('game_id', 'ordinal', 'side', 'club_href', 'formation', 'lineup', 'number', 'player_href', 'player_name',
+           'team_captain', 'position', 'content_hash'),
+          ('game_id', 'ordinal')),
+]
+
+# child tables of "player", whose rows reference it through "player_id"
+PLAYER_TABLES = ['player_valuations', 'player_transfer_history', 'player_career_stats', 'player_national_team_career']
+
+# tables holding the rows of a game, keyed by "game_id" (the transfermarkt id of the game) and their order in it.
+# the rows of a game are written all at once, replacing the ones stored for it
+GAME_TABLES = ['game_event', 'game_lineup']
+# the table of GAME_TABLES whose rows each item of a spider replaces for its game, even when it has none
+SPIDER_GAME_TABLES = {'games': 'game_event', 'game_lineups': 'game_lineup'}
+
+TABLES_BY_NAME = {table.name: table for table in TABLES}
+
+# tables written with the items of each spider
+SPIDER_TABLES = {
+    'competitions': ['competition'],
+    'clubs': ['club'],
+    'games': ['game', 'game_event'],
+    'game_lineups': ['game_lineup'],
+    'players': ['player'] + PLAYER_TABLES,
+}
+
+# tables that other rows reference by href, and whose ids are kept in the lookup cache
+LOOKUP_TABLES = ['competition', 'club']
+
+# tables whose ids are read back after upserting them
+ID_TABLES = LOOKUP_TABLES + ['player']
+
+
+# tables created for the items of each spider
+SCHEMA = {
+    'competitions': [
+        "CREATE TABLE IF NOT EXISTS competition "
+        "(id SERIAL PRIMARY KEY,"
+        "href VARCHAR(255) UNIQUE,"
+        "tag VARCHAR(255),"
+        "country_id VARCHAR(255),"
+        "country_name VARCHAR(255),"
+        "country_code VARCHAR(255),"
+        "competition_type VARCHAR(255),"
+        "content_hash VARCHAR(32),"
+        "created_at TIMESTAMPTZ,"
+        "updated_at TIMESTAMPTZ )",
+        "ALTER TABLE competition ADD COLUMN IF NOT EXISTS content_hash VARCHAR(32)",
+        # the lookup cache is preloaded with the most recently updated rows
+        "CREATE INDEX IF NOT EXISTS competition_updated_at_idx ON competition (updated_at DESC NULLS LAST)",
+    ],
+    'clubs': [
+        "CREATE TABLE IF NOT EXISTS club "
+        "(id SERIAL PRIMARY KEY,"
+        "href VARCHAR(255) UNIQUE,"
+        "competition_id INT,"
+        "competition_href VARCHAR(255),"
+        "code VARCHAR(255),"
+        "name VARCHAR(255),"
+        "coach_name VARCHAR(255),"
+        "average_age FLOAT,"
+        "foreigners_number INT,"
+        "foreigners_percentage VARCHAR(255),"
+        "national_team_players VARCHAR(255),"
+        "net_transfer_record VARCHAR(255),"
+        "squad_size VARCHAR(255),"
+        "stadium_name VARCHAR(255),"
+        "stadium_seats VARCHAR(255),"
+        "total_market_value VARCHAR(255),"
+        "content_hash VARCHAR(32),"
+        "created_at TIMESTAMPTZ,"
+        "updated_at TIMESTAMPTZ )",
+        "ALTER TABLE club ADD COLUMN IF NOT EXISTS content_hash VARCHAR(32)",
+        "ALTER TABLE club ADD COLUMN IF NOT EXISTS competition_href VARCHAR(255)",
+        "CREATE INDEX IF NOT EXISTS club_updated_at_idx ON club (updated_at DESC NULLS LAST)",
+    ],
+    'games': [
+        "CREATE TABLE IF NOT EXISTS game "
+        "(id SERIAL PRIMARY KEY,"
+        "href VARCHAR(255) UNIQUE,"
+        "tm_game_id VARCHAR(255),"
+        "home_club_href VARCHAR(255),"
+        "home_club_id INT,"
+        "home_club_type VARCHAR(255),"
+        "home_club_position VARCHAR(255),"
+        "home_manager_name VARCHAR(255),"
+        "away_club_href VARCHAR(255),"
+        "away_club_id INT,"
+        "away_club_type VARCHAR(255),"
+        "away_club_position VARCHAR(255),"
+        "away_manager_name VARCHAR(255),"
+        "result VARCHAR(255),"
+        "matchday VARCHAR(255),"
+        "date VARCHAR(255),"
+        "stadium VARCHAR(512),"
+        "attendance VARCHAR(255),"
+        "referee VARCHAR(255),"
+        "season INT,"
+        "content_hash VARCHAR(32),"
+        "created_at TIMESTAMPTZ,"
+        "updated_at TIMESTAMPTZ )",
+        "ALTER TABLE game ADD COLUMN IF NOT EXISTS content_hash VARCHAR(32)",
+        "ALTER TABLE game ADD COLUMN IF NOT EXISTS season INT",
+        "CREATE TABLE IF NOT EXISTS game_event "
+        "(id SERIAL PRIMARY KEY,"
+        "game_id INT,"
+        "ordinal INT,"
+        "type VARCHAR(255),"
+        "minute INT,"
+        "extra_minute INT,"
+        "player_href VARCHAR(255),"
+        "club_href VARCHAR(255),"
+        "club_name VARCHAR(255),"
+        "result VARCHAR(255),"
+        "description VARCHAR(1024),"
+        "player_in_href VARCHAR(255),"
+        "player_assist_href VARCHAR(255),"
+        "content_hash VARCHAR(32),"
+        "created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,"
+        "updated_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,"
+        "UNIQUE (game_id, ordinal) )",
+    ],
+    'game_lineups': [
+        "CREATE TABLE IF NOT EXISTS game_lineup "
+        "(id SERIAL PRIMARY KEY,"
+        "game_id INT,"
+        "ordinal INT,"
+        "side VARCHAR(255),"
+        "club_href VARCHAR(255),"
+        "formation VARCHAR(255),"
+        "lineup VARCHAR(255),"
+        "number VARCHAR(255),"
+        "player_href VARCHAR(255),"
+        "player_name VARCHAR(255),"
+        "team_captain INT,"
+        "position VARCHAR(255),"
+        "content_hash VARCHAR(32),"
+        "created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,"
+        "updated_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,"
+        "UNIQUE (game_id, ordinal) )",
+    ],
+    'players': [
+        "CREATE TABLE IF NOT EXISTS player "
+        "(id SERIAL PRIMARY KEY,"
+        "href VARCHAR(255) UNIQUE,"
+        "code VARCHAR(255),"
+        "current_club_id INT,"
+        "current_club_href VARCHAR(255),"
+        "name VARCHAR(255),"
+        "last_name VARCHAR(255),"
+        "number VARCHAR(255),"
+        "name_in_home_country VARCHAR(255),"
+        "date_of_birth VARCHAR(255),"
+        "place_of_birth__country VARCHAR(255),"
+        "place_of_birth__city VARCHAR(255),"
+        "age VARCHAR(255),"
+        "height VARCHAR(255),"
+        "citizenship VARCHAR(255),"
+        "position VARCHAR(255),"
+        "image_url VARCHAR(255),"
+        "player_agent__href VARCHAR(255),"
+        "player_agent__name VARCHAR(255),"
+        "foot VARCHAR(255),"
+        "joined VARCHAR(255),"
+        "contract_expires VARCHAR(255),"
+        "day_of_last_contract_extension VARCHAR(255),"
+        "outfitter VARCHAR(255),"
+        "current_market_value VARCHAR(255),"
+        "highest_market_value VARCHAR(255),"
+        "highest_market_value_date VARCHAR(255),"
+        "market_value_last_change VARCHAR(255),"
+        "market_value_details_url VARCHAR(255),"
+        "social_media VARCHAR(1024),"
+        "transfer_history__fee_sum VARCHAR(255),"
+        "transfer_history__formatted_fee_sum VARCHAR(255),"
+        "career_stats__total_appearances VARCHAR(255),"
+        "career_stats__total_goals VARCHAR(255),"
+        "career_stats__total_assists VARCHAR(255),"
+        "career_stats__total_minutes_per_goal VARCHAR(255),"
+        "career_stats__total_minutes_played VARCHAR(255),"
+        "content_hash VARCHAR(32),"
+        "created_at TIMESTAMPTZ,"
+        "updated_at TIMESTAMPTZ )",
+        "ALTER TABLE player ADD COLUMN IF NOT EXISTS content_hash VARCHAR(32)",
+        "ALTER TABLE player ADD COLUMN IF NOT EXISTS current_club_href VARCHAR(255)",
+        "CREATE TABLE IF NOT EXISTS player_valuations "
+        "(id SERIAL PRIMARY KEY,"
+        "player_id INT,"
+        "x VARCHAR(255),"
+        "y VARCHAR(255),"
+        "mw VARCHAR(255),"
+        "datum_mw VARCHAR(255),"
+        "verein VARCHAR(255),"
+        "age VARCHAR(255),"
+        "wappen VARCHAR(255),"
+        "season INT,"
+        "content_hash VARCHAR(32),"
+        "created_at TIMESTAMPTZ,"
+        "updated_at TIMESTAMPTZ, "
+        "UNIQUE (player_id, datum_mw))",
+        "ALTER TABLE player_valuations ADD COLUMN IF NOT EXISTS content_hash VARCHAR(32)",
+        "ALTER TABLE player_valuations ADD COLUMN IF NOT EXISTS season INT",
+        "CREATE TABLE IF NOT EXISTS player_transfer_history "
+        "(id SERIAL PRIMARY KEY,"
+        "player_id INT,"
+        "url VARCHAR(255),"
+        "from_club_emblem_1x VARCHAR(255),"
+        "from_club_emblem_2x VARCHAR(255),"
+        "from_club_emblem_mobile VARCHAR(255),"
+        "from_club_name VARCHAR(255),"
+        "from_country_flag VARCHAR(255),"
+        "from_href VARCHAR(255),"
+        "from_is_special VARCHAR(255),"
+        "from_latitude VARCHAR(255),"
+        "from_longitude VARCHAR(255),"
+        "to_club_emblem_1x VARCHAR(255),"
+        "to_club_emblem_2x VARCHAR(255),"
+        "to_club_emblem_mobile VARCHAR(255),"
+        "to_club_name VARCHAR(255),"
+        "to_country_flag VARCHAR(255),"
+        "to_href VARCHAR(255),"
+        "to_is_special VARCHAR(255),"
+        "to_latitude VARCHAR(255),"
+        "to_longitude VARCHAR(255),"
+        "future_transfer VARCHAR(255),"
+        "date VARCHAR(255),"
+        "date_unformatted VARCHAR(255),"
+        "upcoming VARCHAR(255),"
+        "season VARCHAR(255),"
+        "market_value VARCHAR(255),"
+        "fee VARCHAR(255),"
+        "show_upcoming_header VARCHAR(255),"
+        "show_reset_header VARCHAR(255),"
+        "content_hash VARCHAR(32),"
+        "created_at TIMESTAMPTZ,"
+        "updated_at TIMESTAMPTZ,"
+        "UNIQUE (player_id, url) )",
+        "ALTER TABLE player_transfer_history ADD COLUMN IF NOT EXISTS content_hash VARCHAR(32)",
+        "CREATE TABLE IF NOT EXISTS player_career_stats "
+        "(id SERIAL PRIMARY KEY,"
+        "player_id INT,"
+        "competition_id INT,"
+        "competition_href VARCHAR(255),"
+        "appearances_href VARCHAR(255),"
+        "appearances_number VARCHAR(255),"
+        "goals VARCHAR(255),"
+        "assists VARCHAR(255),"
+        "minutes_per_goal VARCHAR(255),"
+        "minutes_played VARCHAR(255),"
+        "content_hash VARCHAR(32),"
+        "created_at TIMESTAMPTZ,"
+        "updated_at TIMESTAMPTZ,"
+        "UNIQUE (player_id, competition_href) )",
+        "ALTER TABLE player_career_stats ADD COLUMN IF NOT EXISTS content_hash VARCHAR(32)",
+        "CREATE TABLE IF NOT EXISTS player_national_team_career "
+        "(id SERIAL PRIMARY KEY,"
+        "player_id INT,"
+        "club_id INT,"
+        "club_href VARCHAR(255),"
+        "country_name VARCHAR(255),"
+        "country_flag_url VARCHAR(255),"
+        "debut_date VARCHAR(255),"
+        "debut_href VARCHAR(255),"
+        "matches_number VARCHAR(255),"
+        "matches_href VARCHAR(255),"
+        "tore_number VARCHAR(255),"
+        "tore_href VARCHAR(255),"
+        "content_hash VARCHAR(32),"
+        "created_at TIMESTAMPTZ,"
+        "updated_at TIMESTAMPTZ,"
+        "UNIQUE (player_id, club_href) )",
+        "ALTER TABLE player_national_team_career ADD COLUMN IF NOT EXISTS content_hash VARCHAR(32)",
+    ],
+}
+
+# range partitioned versions of the largest tables, created instead of the ones in SCHEMA with DATABASE_PARTITIONING.
+# the unique keys of partitioned tables must include "season", so rows whose season is unknown are stored with
+# UNKNOWN_SEASON, which goes to the "<table>_default" partition, and the pipeline deletes the rows that a new row
+# moves to another season, so that the key without season stays unique. partitions have their own id primary key
+PARTITIONED_SCHEMA = {
+    'games': [
+        "CREATE TABLE IF NOT EXISTS game "
+        "(id SERIAL,"
+        "href VARCHAR(255),"
+        "tm_game_id VARCHAR(255),"
+        "home_club_href VARCHAR(255),"
+        "home_club_id INT,"
+        "home_club_type VARCHAR(255),"
+        "home_club_position VARCHAR(255),"
+        "home_manager_name VARCHAR(255),"
+        "away_club_href VARCHAR(255),"
+        "away_club_id INT,"
+        "away_club_type VARCHAR(255),"
+        "away_club_position VARCHAR(255),"
+        "away_manager_name VARCHAR(255),"
+        "result VARCHAR(255),"
+        "matchday VARCHAR(255),"
+        "date VARCHAR(255),"
+        "stadium VARCHAR(512),"
+        "attendance VARCHAR(255),"
+        "referee VARCHAR(255),"
+        "season INT NOT NULL,"
+        "content_hash VARCHAR(32),"
+        "created_at TIMESTAMPTZ,"
+        "updated_at TIMESTAMPTZ,"
+        "UNIQUE (href, season) ) "
+        "PARTITION BY RANGE (season)",
+        "CREATE TABLE IF NOT EXISTS game_default PARTITION OF game (PRIMARY KEY (id)) DEFAULT",
+        "CREATE INDEX IF NOT EXISTS game_href_idx ON game (href)",
+    ],
+    'players': [
+        "CREATE TABLE IF NOT EXISTS player_valuations "
+        "(id SERIAL,"
+        "player_id INT,"
+        "x VARCHAR(255),"
+        "y VARCHAR(255),"
+        "mw VARCHAR(255),"
+        "datum_mw VARCHAR(255),"
+        "verein VARCHAR(255),"
+        "age VARCHAR(255),"
+        "wappen VARCHAR(255),"
+        "season INT NOT NULL,"
+        "content_hash VARCHAR(32),"
+        "created_at TIMESTAMPTZ,"
+        "updated_at TIMESTAMPTZ, "
+        "UNIQUE (player_id, datum_mw, season) ) "
+        "PARTITION BY RANGE (season)",
+        "CREATE TABLE IF NOT EXISTS player_valuations_default PARTITION OF player_valuations (PRIMARY KEY (id)) DEFAULT",
+        "CREATE INDEX IF NOT EXISTS player_valuations_player_id_datum_mw_idx ON player_valuations (player_id, datum_mw)",
+    ],
+}
+
+# conflict keys of the tables in PARTITIONED_SCHEMA, when they are partitioned
+PARTITION_KEYS = {
+    'game': ('href', 'season'),
+    'player_valuations': ('player_id', 'datum_mw', 'season'),
+}
+
+# the season stored in partitioned tables for the rows whose season is unknown
+UNKNOWN_SEASON = 0
+
+# the same tables in SQLite, where only "INTEGER PRIMARY KEY" makes an auto-incremented id column, and nulls
+# already sort last in descending indexes. tables are created with all their columns there, so the ALTER TABLE
+# statements that upgrade older tables are left out
+SQLITE_SCHEMA = {
+    spider_name: [
+        statement.replace('SERIAL PRIMARY KEY', 'INTEGER PRIMARY KEY').replace(' NULLS LAST', '')
+        for statement in statements if not statement.startswith('ALTER TABLE')
+    ]
+    for spider_name, statements in SCHEMA.items()
+}
+
+
+
+def upsert_sql(table, rows, now="now()"):
+    """Build an "insert ... on conflict do update" statement for a table.
+
+    :param table: The table definition
+    :type table: Table
+    :param rows: The clause producing the inserted rows, which must end with the created_at and updated_at values
+    :type rows: str
+    :param now: The SQL expression of the current time
+    :type now: str
+    :return: The statement
+    :rtype: str
+    """
+    return "insert into {0} ({1}, created_at, updated_at) {2} " \
+           "on conflict ({3}) do update " \
+           "set {4}, updated_at = {5}".format(
+             table.name,
+             ", ".join(table.columns),
+             rows,
+             ", ".join(table.key),
+             ", ".join(
+                 "{0} = excluded.{0}".format(column)
+                 for column in table.columns if column not in table.key
+             ),
+             now
+           )
+
+
+def row_hash(table, row):
+    """Hash the content of a row, so that rows that did not change since they were stored can be told apart.
+    The "player_id" of child rows is left out, as it is only resolved when the rows are written.
+
+    :param table: The table definition
+    :type table: Table
+    :param row: The row, with its foreign keys resolved
+    :type row: dict
+    :return: The hex digest of the row content
+    :rtype: str
+    """
+    content = [row[column] for column in table.columns if column not in ('player_id', 'content_hash')]
+    return hashlib.md5(json.dumps(content).encode()).hexdigest()
+
+
+def game_hash(table, rows):
+    """Hash the content of all the rows of a game in one of GAME_TABLES, which all of them carry, as the rows of a
+    game are replaced together rather than upserted one by one.
+
+    :param table: The table definition
+    :type table: Table
+    :param rows: The rows of the game
+    :type rows: typing.List[dict]
+    :return: The hex digest of the game content
+    :rtype: str
+    """
+    return hashlib.md5("".join(row_hash(table, row) for row in rows).encode()).hexdigest()
+
+
+def staging_columns(table):
+    """The columns of the staging table of a table. Child rows of "player" are staged with the href of
+    their player, which is resolved into "player_id" when the staged rows are merged.
+    """
+    if table.name in PLAYER_TABLES:
+        return ('player_href',) + tuple(column for column in table.columns if column != 'player_id')
+    return table.columns
+
+
+def copy_value(value):
+    """Encode a value for the text format of COPY."""
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def placeholders(table):
+    return ", ".join("${0}".format(i + 1) for i in range(len(table.columns)))
+
+
+def async_upsert_sql(table, count, skip_unchanged):
+    """Build the upsert of `count` rows of a table with the numbered placeholders of asyncpg. It returns the href
+    and id of the rows written to the tables in ID_TABLES, and the first key column of the others.
+
+    :param table: The table definition
+    :type table: Table
+    :param count: The number of rows
+    :type count: int
+    :param skip_unchanged: Whether rows whose content hash did not change are left untouched
+    :type skip_unchanged: bool
+    :return: The statement
+    :rtype: str
+    """
+    width = len(table.columns)
+    sql = upsert_sql(table, "values " + ", ".join(
+        "({0}, now(), now())".format(", ".join("${0}".format(i * width + j + 1) for j in range(width)))
+        for i in range(count)
+    ))
+    if skip_unchanged:
+        sql += " where {0}.content_hash is distinct from excluded.content_hash".format(table.name)
+    return sql + (" returning href, id" if table.name in ID_TABLES else " returning " + table.key[0])
+
+
+# the largest number of placeholders in a statement of PostgreSQL
+ASYNC_MAX_ARGUMENTS = 32767
+
+# single row statements with the numbered placeholders of asyncpg, which prepares and caches them per connection
+ASYNC_GAME_INSERTS = {
+    name: "insert into {0} ({1}) values ({2})".format(
+        name, ", ".join(TABLES_BY_NAME[name].columns), placeholders(TABLES_BY_NAME[name])
+    )
+    for name in GAME_TABLES
+}
+
+# columns holding the id of another row, as (id column, referenced table, column with the referenced href)
+FOREIGN_KEYS = {
+    'club': [('competition_id', 'competition', 'competition_href')],
+    'game': [('home_club_id', 'club', 'home_club_href'), ('away_club_id', 'club', 'away_club_href')],
+    'player': [('current_club_id', 'club', 'current_club_href')],
+    'player_career_stats': [('competition_id', 'competition', 'competition_href')],
+    'player_national_team_career': [('club_id', 'club', 'club_href')],
+}
+
+
+def resolve_foreign_keys(cursor, tables, record=None):
+    """Fill the foreign key id columns of some tables from their href columns, with one UPDATE ... FROM
+    join per column. Rows whose referenced row does not exist keep a NULL id, and tables that have not been
+    created yet are skipped.
+
+    :param cursor: A database cursor
+    :type cursor: psycopg2.extensions.cursor
+    :param tables: The names of the tables to resolve
+    :type tables: typing.List[str]
+    :param record: An optional function to report each statement to, like `Backend.record`
+    :type record: typing.Callable
+    :return: The number of updated rows per "<table>.<id column>"
+    :rtype: dict
+    """
+    cursor.execute("select relname from pg_class where relkind in ('r', 'p')")
+    existing = {name for (name,) in cursor.fetchall()}
+
+    updated = {}
+    for table in tables:
+        for id_column, parent, href_column in FOREIGN_KEYS.get(table, []):
+            if table not in existing or parent not in existing:
+                continue
+            started = time.monotonic()
+            cursor.execute(
+                "update {0} t set {1} = r.id from {2} r "
+                "where r.href = t.{3} and t.{1} is distinct from r.id".format(table, id_column, parent, href_column)
+            )
+            if record:
+                record('resolve', table, cursor.rowcount, started)
+            updated["{0}.{1}".format(table, id_column)] = cursor.rowcount
+    return updated
+
+
+def item_rows(spider_name, item_dic):
+    """Map a scraped item to the table rows that store it.
+
+    Rows of the "player_*" tables carry the href of their player in "player_href", since the
+    player id is only known once the player row has been written.
+
+    :param spider_name: The name of the spider that scraped the item
+    :type spider_name: str
+    :param item_dic: The item
+    :type item_dic: dict
+    :return: A generator of (table name, conflict key, row) tuples
+    :rtype: typing.Iterator[tuple]
+    """
+    if spider_name == 'competitions':
+        yield 'competition', (item_dic['href'],), {
+            'href': item_dic['href'],
+            'tag': text(item_dic['tag']),
+            'country_id': text(item_dic.get('country_id')),
+            'country_name': text(item_dic.get('country_name')),
+            'country_code': text(item_dic.get('country_code')),
+            'competition_type': text(item_dic['competition_type']),
+        }
+    elif spider_name == 'clubs':
+        yield 'club', (item_dic['href'],), {
+            'href': item_dic['href'],
+            'competition_href': item_dic['parent']['href'],
+            'code': text(item_dic['code']),
+            'name': text(item_dic['name']),
+            'coach_name': text(item_dic['coach_name']),
+            'average_age': float(item_dic['average_age']) if item_dic['average_age'] else None,
+            'foreigners_number': int(item_dic['foreigners_number']) if item_dic['foreigners_number'] else None,
+            'foreigners_percentage': text(item_dic['foreigners_percentage']),
+            'national_team_players': text(item_dic['national_team_players']),
+            'net_transfer_record': text(item_dic['net_transfer_record']),
+            'squad_size': text(item_dic['squad_size']),
+            'stadium_name': text(item_dic['stadium_name']),
+            'stadium_seats': text(item_dic['stadium_seats']),
+            'total_market_value': text(item_dic['total_market_value']),
+        }
+    elif spider_name == 'games':
+        home_club = item_dic.get('home_club') or {}
+        away_club = item_dic.get('away_club') or {}
+        yield 'game', (item_dic['href'],), {
+            'href': item_dic['href'],
+            'tm_game_id': text(item_dic['game_id']),
+            'home_club_href': text(home_club.get('href')),
+            'home_club_type': text(home_club.get('type')),
+            'home_club_position': text(item_dic['home_club_position']),
+            'home_manager_name': text((item_dic.get('home_manager') or {}).get('name')),
+            'away_club_href': text(away_club.get('href')),
+            'away_club_type': text(away_club.get('type')),
+            'away_club_position': text(item_dic['away_club_position']),
+            'away_manager_name': text((item_dic.get('away_manager') or {}).get('name')),
+            'result': text(item_dic['result']),
+            'matchday': text(item_dic['matchday']),
+            'date': text(item_dic['date']),
+            'stadium': text(item_dic['stadium']),
+            'attendance': text(item_dic['attendance']),
+            'referee': text(item_dic['referee']),
+            'season': item_season(item_dic),
+        }
+
+        for ordinal, event in enumerate(item_dic.get('events') or []):
+            club = event.get('club') or {}
+            action = event.get('action') or {}
+            yield 'game_event', (item_dic['game_id'], ordinal), {
+                'game_id': item_dic['game_id'],
+                'ordinal': ordinal,
+                'type': text(event.get('type')),
+                'minute': event.get('minute'),
+                'extra_minute': event.get('extra'),
+                'player_href': text((event.get('player') or {}).get('href')),
+                'club_href': text(club.get('href')),
+                'club_name': text(club.get('name')),
+                'result': text(action.get('result')),
+                'description': text(action.get('description')),
+                'player_in_href': text((action.get('player_in') or {}).get('href')),
+                'player_assist_href': text((action.get('player_assist') or {}).get('href')),
+            }
+    elif spider_name == 'game_lineups':
+        ordinal = 0
+        for side in ('home', 'away'):
+            club = item_dic.get(side + '_club') or {}
+            for lineup in ('starting_lineup', 'substitutes'):
+                for player in club.get(lineup) or []:
+                    yield 'game_lineup', (item_dic['game_id'], ordinal), {
+                        'game_id': item_dic['game_id'],
+                        'ordinal': ordinal,
+                        'side': side,
+                        'club_href': text(club.get('href')),
+                        'formation': text(club.get('formation')),
+                        'lineup': lineup,
+                        'number': text(player.get('number')),
+                        'player_href': text(player.get('href')),
+                        'player_name': text(player.get('name')),
+                        'team_captain': player.get('team_captain'),
+                        'position': text(player.get('position')),
+                    }
+                    ordinal += 1
+    elif spider_name == 'players':
+        href = item_dic['href']
+        market_value_history = item_dic['market_value_history']
+        transfer_history = item_dic['transfer_history']
+        career_stats_total = item_dic['career_stats'].get('total') or {}
+        yield 'player', (href,), {
+            'href': href,
+            'code': text(item_dic['code']),
+            'current_club_href': item_dic['current_club']['href'],
+            'name': text(item_dic['name']),
+            'last_name': text(item_dic['last_name']),
+            'number': text(item_dic['number']),
+            'name_in_home_country': text(item_dic['name_in_home_country']),
+            'date_of_birth': text(item_dic['date_of_birth']),
+            'place_of_birth__country': text(item_dic['place_of_birth']['country']),
+            'place_of_birth__city': text(item_dic['place_of_birth']['city']),
+            'age': text(item_dic['age']),
+            'height': text(item_dic['height']),
+            'citizenship': text(item_dic['citizenship']),
+            'position': text(item_dic['position']),
+            'image_url': text(item_dic['image_url']),
+            'player_agent__href': text(item_dic['player_agent']['href']),
+            'player_agent__name': text(item_dic['player_agent']['name']),
+            'foot': text(item_dic['foot']),
+            'joined': text(item_dic['joined']),
+            'contract_expires': text(item_dic['contract_expires']),
+            'day_of_last_contract_extension': text(item_dic['day_of_last_contract_extension']),
+            'outfitter': text(item_dic['outfitter']),
+            'current_market_value': text(market_value_history.get('current')),
+            'highest_market_value': text(market_value_history.get('highest')),
+            'highest_market_value_date': text(market_value_history.get('highest_date')),
+            'market_value_last_change': text(market_value_history.get('last_change')),
+            'market_value_details_url': text(market_value_history.get('details_url')),
+            'social_media': json.dumps(item_dic['social_media']) if item_dic.get('social_media') else '',
+            'transfer_history__fee_sum': text(transfer_history.get('feeSum')),
+            'transfer_history__formatted_fee_sum': text(transfer_history.get('formattedFeeSum')),
+            'career_stats__total_appearances': text(career_stats_total.get('appearances')),
+            'career_stats__total_goals': text(career_stats_total.get('goals')),
+            'career_stats__total_assists': text(career_stats_total.get('assists')),
+            'career_stats__total_minutes_per_goal': text(career_stats_total.get('minutes_per_goal')),
+            'career_stats__total_minutes_played': text(career_stats_total.get('minutes_played')),
+        }
+
+        for entry in market_value_history.get('list', []):
+            datum_mw = text(entry.get('datum_mw'))
+            yield 'player_valuations', (href, datum_mw), {
+                'player_href': href,
+                'x': text(entry.get('x')),
+                'y': text(entry.get('y')),
+                'mw': text(entry.get('mw')),
+                'datum_mw': datum_mw,
+                'verein': text(entry.get('verein')),
+                'age': text(entry.get('age')),
+                'wappen': text(entry.get('wappen')),
+                'season': date_season(datum_mw),
+            }
+
+        for entry in transfer_history.get('transfers', []):
+            url = text(entry.get('url'))
+            transfer_from = entry.get('from') or {}
+            transfer_to = entry.get('to') or {}
+            yield 'player_transfer_history', (href, url), {
+                'player_href': href,
+                'url': url,
+                'from_club_emblem_1x': text(transfer_from.get('clubEmblem-1x')),
+                'from_club_emblem_2x': text(transfer_from.get('clubEmblem-2x')),
+                'from_club_emblem_mobile': text(transfer_from.get('clubEmblemMobile')),
+                'from_club_name': text(transfer_from.get('clubName')),
+                'from_country_flag': text(transfer_from.get('countryFlag')),
+                'from_href': text(transfer_from.get('href')),
+                'from_is_special': text(transfer_from.get('isSpecial')),
+                'from_latitude': text(transfer_from.get('latitude')),
+                'from_longitude': text(transfer_from.get('longitude')),
+                'to_club_emblem_1x': text(transfer_to.get('clubEmblem-1x')),
+                'to_club_emblem_2x': text(transfer_to.get('clubEmblem-2x')),
+                'to_club_emblem_mobile': text(transfer_to.get('clubEmblemMobile')),
+                'to_club_name': text(transfer_to.get('clubName')),
+                'to_country_flag': text(transfer_to.get('countryFlag')),
+                'to_href': text(transfer_to.get('href')),
+                'to_is_special': text(transfer_to.get('isSpecial')),
+                'to_latitude': text(transfer_to.get('latitude')),
+                'to_longitude': text(transfer_to.get('longitude')),
+                'future_transfer': text(entry.get('futureTransfer')),
+                'date': text(entry.get('date')),
+                'date_unformatted': text(entry.get('dateUnformatted')),
+                'upcoming': text(entry.get('upcoming')),
+                'season': text(entry.get('season')),
+                'market_value': text(entry.get('marketValue')),
+                'fee': text(entry.get('fee')),
+                'show_upcoming_header': text(entry.get('showUpcomingHeader')),
+                'show_reset_header': text(entry.get('showResetHeader')),
+            }
+
+        for entry in item_dic['career_stats'].get('list', []):
+            competition = entry.get('competition') or {}
+            appearances = entry.get('appearances') or {}
+            competition_href = text(competition.get('href'))
+            yield 'player_career_stats', (href, competition_href), {
+                'player_href': href,
+                'competition_href': competition_href,
+                'appearances_href': text(appearances.get('href')),
+                'appearances_number': text(appearances.get('number')),
+                'goals': text(entry.get('goals')),
+                'assists': text(entry.get('assists')),
+                'minutes_per_goal': text(entry.get('minutes_per_goal')),
+                'minutes_played': text(entry.get('minutes_played')),
+            }
+
+        for entry in item_dic.get('national_team_career', []):
+            national_team = entry.get('nationtal_team') or {}
+            debut = entry.get('debut') or {}
+            matches = entry.get('matches') or {}
+            tore = entry.get('tore') or {}
+            club_href = text(national_team.get('club_href'))
+            yield 'player_national_team_career', (href, club_href), {
+                'player_href': href,
+                'club_href': club_href,
+                'country_name': text(national_team.get('country_name')),
+                'country_flag_url': text(national_team.get('country_flag_url')),
+                'debut_date': text(debut.get('date')),
+                'debut_href': text(debut.get('href')),
+                'matches_number': text(matches.get('number')),
+                'matches_href': text(matches.get('href')),
+                'tore_number': text(tore.get('number')),
+                'tore_href': text(tore.get('href')),
+            }
+
+
+class LookupCache:
+    """A size capped href to id mapping that evicts the least recently used entries first."""
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+
+    def get(self, table, href):
+        row_id = self.entries.get((table, href))
+        if row_id is not None:
+            self.entries.move_to_end((table, href))
+        return row_id
+
+    def put(self, table, href, row_id):
+        self.entries[(table, href)] = row_id
+        self.entries.move_to_end((table, href))
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def record_statement(stats, slow_statement_secs, statement, table, rows, started):
+    """Add a statement to the stats of its kind and table: number of statements, rows, largest batch, total
+    time and a latency histogram. Statements slower than DATABASE_SLOW_STATEMENT_SECS are logged.
+
+    :param stats: The stats collector, if any
+    :type stats: scrapy.statscollectors.StatsCollector
+    :param slow_statement_secs: The time above which the statement is logged
+    :type slow_statement_secs: float
+    :param statement: The kind of statement ("upsert", "lookup", "hashes", "copy", "delete", "merge", "resolve",
+        "commit")
+    :type statement: str
+    :param table: The table the statement writes to or reads from, if any
+    :type table: str
+    :param rows: The number of rows the statement handled
+    :type rows: int
+    :param started: The `time.monotonic()` at which the statement started
+    :type started: float
+    """
+    elapsed = time.monotonic() - started
+    if stats is not None:
+        prefix = 'database/{0}/{1}'.format(statement, table) if table else 'database/{0}'.format(statement)
+        stats.inc_value(prefix + '/count')
+        stats.inc_value(prefix + '/rows', rows)
+        stats.max_value(prefix + '/max_rows', rows)
+        stats.inc_value(prefix + '/seconds', elapsed, start=0.0)
+        bucket = next((name for bound, name in LATENCY_BUCKETS if elapsed <= bound), None)
+        stats.inc_value(prefix + ('/latency_le_' + bucket if bucket else '/latency_gt_' + LATENCY_BUCKETS[-1][1]))
+
+    if elapsed >= slow_statement_secs:
+        logger.warning("Slow %s statement on %s: %d rows in %.3fs", statement, table or 'the database', rows, elapsed)
+
+
+class Backend:
+    """The driver specific part of DatabasePipeline: it runs the statements that create, read and upsert the
+    rows of the tables, while the pipeline takes care of batching, hashing and the lookup cache. Statements are
+    run in the current transaction, which the pipeline ends with `commit` or `rollback`.
+    """
+
+    # whether rows can be copied into staging tables and merged when the spider closes (see DATABASE_STAGING)
+    can_stage = False
+    # the errors that may come from the connection or the database as a whole rather than from the rows written
+    # (see `is_connection_error`)
+    connection_errors = ()
+
+    def __init__(self, stats=None, slow_statement_secs=1.0):
+        self.stats = stats
+        self.slow_statement_secs = slow_statement_secs
+
+    def conflict_table(self, table):
+        """The table definition to upsert with, whose key is the one that the upserts conflict on."""
+        return table
+
+    def fill_partition_keys(self, buffer):
+        """Give the buffered rows of partitioned tables whose season is unknown UNKNOWN_SEASON."""
+
+    def record(self, statement, table, rows, started):
+        """Add a statement to the stats of its kind and table (see `record_statement`)."""
+        record_statement(self.stats, self.slow_statement_secs, statement, table, rows, started)
+
+    def commit(self):
+        started = time.monotonic()
+        self.connection.commit()
+        self.record('commit', None, 0, started)
+
+    def rollback(self):
+        self.connection.rollback()
+
+    def close(self):
+        self.connection.close()
+
+    def is_connection_error(self, error):
+        """Whether an error comes from the connection or the database as a whole rather than from the rows
+        written, so that writing the items of a failed batch one at a time would not help.
+        """
+        return isinstance(error, self.connection_errors)
+
+    def reconnect(self):
+        """Replace a connection that failed with a new one. The statements of the failed transaction are lost."""
+        try:
+            self.close()
+        except Exception as e:
+            if not self.is_connection_error(e):
+                raise
+        self.connect()
+
+
+class PostgresBackend(Backend):
+    """Write to PostgreSQL through psycopg2, upserting each batch with one execution of a server-side
+    prepared statement per table.
+    """
+
+    can_stage = True
+    connection_errors = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+    def __init__(self, db_host, db_port, db_user, db_password, db_db, partitioning=False, **kwargs):
+        super().__init__(**kwargs)
+        self.db_host = db_host
+        self.db_port = db_port
+        self.db_user = db_user
+        self.db_password = db_password
+        self.db_db = db_db
+        self.partitioning = partitioning
+
+    def connect(self):
+        self.connection = psycopg2.connect(
+            database=self.db_db,
+            user=self.db_user,
+            password=self.db_password,
+            host=self.db_host,
+            port=self.db_port
+        )
+        self.cursor = self.connection.cursor()
+        # cast placeholders of the statements prepared in this session, per table
+        self.prepared = {}
+        # the partitioned tables, and the (table, season) partitions known to exist. the partitions created in
+        # the current transaction are only known to exist once it is committed
+        self.partitioned = set()
+        self.partitions = set()
+        self.new_partitions = set()
+
+    def create_tables(self, spider_name):
+        # partitioned tables are created first, which turns the CREATE TABLE IF NOT EXISTS of SCHEMA into no-ops
+        if self.partitioning:
+            for statement in PARTITIONED_SCHEMA.get(spider_name, []):
+                self.cursor.execute(statement)
+        for statement in SCHEMA.get(spider_name, []):
+            self.cursor.execute(statement)
+
+        # tables created partitioned by an earlier run are written as such, whatever DATABASE_PARTITIONING says
+        self.cursor.execute("select relname from pg_class where relkind = 'p'")
+        self.partitioned = {name for (name,) in self.cursor.fetchall()} & set(PARTITION_KEYS)
+
+    def conflict_table(self, table):
+        """The table definition to upsert with, whose key includes "season" when the table is partitioned."""
+        if table.name in self.partitioned:
+            return table._replace(key=PARTITION_KEYS[table.name])
+        return table
+
+    def fill_partition_keys(self, buffer):
+        for table_name in self.partitioned:
+            for row in buffer[table_name].values():
+                if row['season'] is None:
+                    row['season'] = UNKNOWN_SEASON
+
+    def create_partitions(self, table, seasons):
+        """Create the partitions of a partitioned table that hold the rows of some seasons, if they do not
+        exist yet. Rows of UNKNOWN_SEASON are kept by the default partition.
+        """
+        for season in seasons:
+            partition = (table.name, season)
+            if season in (None, UNKNOWN_SEASON) or partition in self.partitions or partition in self.new_partitions:
+                continue
+            self.cursor.execute(
+                "CREATE TABLE IF NOT EXISTS {0}_{1} PARTITION OF {0} (PRIMARY KEY (id)) "
+                "FOR VALUES FROM ({1}) TO ({2})".format(table.name, int(season), int(season) + 1)
+            )
+            self.new_partitions.add(partition)
+
+    def commit(self):
+        super().commit()
+        self.partitions |= self.new_partitions
+        self.new_partitions.clear()
+
+    def rollback(self):
+        super().rollback()
+        self.new_partitions.clear()
+
+    def reconnect(self):
+        # the tables are not created again, so what is known of their partitions is kept
+        partitioned, partitions = self.partitioned, self.partitions
+        super().reconnect()
+        self.partitioned, self.partitions = partitioned, partitions
+
+    def recent_ids(self, table, limit):
+        """The href and id of the most recently updated rows of a table, least recent first.
+
+        :param table: The name of the table, which may not exist yet
+        :type table: str
+        :param limit: The maximum number of rows
+        :type limit: int
+        :rtype: typing.List[tuple]
+        """
+        self.cursor.execute("select to_regclass(%s)", (table,))
+        if self.cursor.fetchone()[0] is None:
+            return []
+        self.cursor.execute(
+            "select href, id from {0} order by updated_at desc nulls last limit %s".format(table), (limit,)
+        )
+        return list(reversed(self.cursor.fetchall()))
+
+    def select_id(self, table, href):
+        started = time.monotonic()
+        self.cursor.execute("select id from {0} where href = %s".format(table), (href,))
+        result = self.cursor.fetchone()
+        self.record('lookup', table, 1, started)
+        return result[0] if result else None
+
+    def stored_rows(self, table, values):
+        """The conflict key, content hash and id of the stored rows whose first key column is in `values`.
+
+        :param table: The table definition
+        :type table: Table
+        :param values: Values of the first key column
+        :type values: typing.List[str]
+        :rtype: typing.List[tuple]
+        """
+        started = time.monotonic()
+        self.cursor.execute(
+            "select {0}, content_hash, id from {1} where {2} = any(%s)".format(
+                ", ".join(table.key), table.name, table.key[0]
+            ),
+            (values,)
+        )
+        records = self.cursor.fetchall()
+        self.record('hashes', table.name, len(values), started)
+        return records
+
+    def column_types(self, table):
+        self.cursor.execute(
+            "select attname, format_type(atttypid, null) from pg_attribute "
+            "where attrelid = %s::regclass and attnum > 0 and not attisdropped",
+            (table.name,)
+        )
+        return dict(self.cursor.fetchall())
+
+    def prepare(self, table):
+        """Create the server-side prepared statement "upsert_<table>", which upserts the rows given as
+        one array per column. Parameter types are taken from the table definition in the database.
+        """
+        types = self.column_types(table)
+        array_types = ["{0}[]".format(types[column]) for column in table.columns]
+
+        sql = upsert_sql(
+            self.conflict_table(table), "select *, now(), now() from unnest({0})".format(placeholders(table))
+        )
+        if table.name in ID_TABLES:
+            sql += " returning href, id"
+        self.cursor.execute("prepare upsert_{0} ({1}) as {2}".format(table.name, ", ".join(array_types), sql))
+        # casting the arguments lets values such as all-null arrays take the parameter type
+        self.prepared[table.name] = ", ".join("%s::{0}".format(array_type) for array_type in array_types)
+
+    def upsert(self, table, rows):
+        """Upsert a batch of rows into a table.
+
+        :param table: The table definition
+        :type table: Table
+        :param rows: The rows, with all the columns of the table
+        :type rows: typing.List[dict]
+        :return: The href to id mapping of the rows, for the tables in ID_TABLES
+        :rtype: dict
+        """
+        if table.name in self.partitioned:
+            self.create_partitions(table, {row['season'] for row in rows})
+            self.delete_moved_rows(table, rows)
+        if table.name not in self.prepared:
+            self.prepare(table)
+        # one array per column, so the whole batch goes in a single execution of the prepared statement
+        started = time.monotonic()
+        self.cursor.execute(
+            "execute upsert_{0} ({1})".format(table.name, self.prepared[table.name]),
+            [[row[column] for row in rows] for column in table.columns]
+        )
+        ids = dict(self.cursor.fetchall()) if table.name in ID_TABLES else {}
+        self.record('upsert', table.name, len(rows), started)
+        return ids
+
+    def delete_moved_rows(self, table, rows):
+        """Delete the stored rows of a partitioned table that have the same key as some new rows but another
+        season, as the unique key of the table includes the season.
+        """
+        types = self.column_types(table)
+        started = time.monotonic()
+        self.cursor.execute(
+            "delete from {0} t using unnest({1}) n({2}) where {3} and t.season <> n.season".format(
+                table.name,
+                ", ".join("%s::{0}[]".format(types[column]) for column in table.key + ('season',)),
+                ", ".join(table.key + ('season',)),
+                " and ".join("t.{0} = n.{0}".format(column) for column in table.key)
+            ),
+            [[row[column] for row in rows] for column in table.key + ('season',)]
+        )
+        self.record('delete', table.name, self.cursor.rowcount, started)
+
+    def resolve_foreign_keys(self, tables):
+        return resolve_foreign_keys(self.cursor, tables, self.record)
+
+    def stream(self, sql, batch_size=1000):
+        """Run a query through a server-side cursor, and yield its rows as dicts while they are fetched in
+        batches, so that large results are never loaded at once.
+
+        :param sql: The query
+        :type sql: str
+        :param batch_size: The number of rows fetched at a time
+        :type batch_size: int
+        :rtype: typing.Iterator[dict]
+        """
+        cursor = self.connection.cursor(name='stream')
+        cursor.itersize = batch_size
+        try:
+            cursor.execute(sql)
+            columns = None
+            for record in cursor:
+                # the description of a server-side cursor is only known once rows have been fetched
+                if columns is None:
+                    columns = [column.name for column in cursor.description]
+                yield dict(zip(columns, record))
+        finally:
+            cursor.close()
+
+    def create_staging_tables(self, tables):
+        """Create the UNLOGGED "<table>_staging" tables that rows are copied into until the spider closes.
+        Rows left over by a crawl that did not finish are kept, and get merged along with the new ones.
+        Staging tables are dropped after merging, so they always match the current table definitions.
+        """
+        for table_name in tables:
+            table = TABLES_BY_NAME[table_name]
+            types = self.column_types(table)
+            types['player_href'] = 'character varying'
+            self.cursor.execute(
+                "CREATE UNLOGGED TABLE IF NOT EXISTS {0}_staging (seq BIGSERIAL, {1})".format(
+                    table.name,
+                    ", ".join("{0} {1}".format(column, types[column]) for column in staging_columns(table))
+                )
+            )
+
+    def copy_to_staging(self, buffer):
+        for table in TABLES:
+            rows = buffer[table.name].values()
+            if not rows or table.name in GAME_TABLES:
+                continue
+            columns = staging_columns(table)
+            data = io.StringIO("".join(
+                "\t".join(copy_value(row[column]) for column in columns) + "\n" for row in rows
+            ))
+            started = time.monotonic()
+            self.cursor.copy_expert(
+                "copy {0}_staging ({1}) from stdin".format(table.name, ", ".join(columns)), data
+            )
+            self.record('copy', table.name, len(rows), started)
+
+    def replace_games(self, table, games):
+        """Replace the stored rows of some games with new ones, deleting the old rows and copying the new ones in
+        with COPY. created_at and updated_at take their default, the time of the write.
+
+        :param table: The table definition, of one of GAME_TABLES
+        :type table: Table
+        :param games: The rows of each game, by game id, which are empty for games that have no rows anymore
+        :type games: typing.Dict[int, typing.List[dict]]
+        """
+        started = time.monotonic()
+        self.cursor.execute("delete from {0} where game_id = any(%s)".format(table.name), (list(games),))
+        self.record('delete', table.name, self.cursor.rowcount, started)
+
+        rows = [row for game_rows in games.values() for row in game_rows]
+        data = io.StringIO("".join(
+            "\t".join(copy_value(row[column]) for column in table.columns) + "\n" for row in rows
+        ))
+        started = time.monotonic()
+        self.cursor.copy_expert("copy {0} ({1}) from stdin".format(table.name, ", ".join(table.columns)), data)
+        self.record('copy', table.name, len(rows), started)
+
+    def merge_staging_tables(self, tables):
+        """Upsert the staged rows into their tables with one statement per table, keeping the latest
+        staged version of each key, and drop the staging tables. Rows whose content hash did not change
+        are left untouched.
+
+        :return: The number of upserted rows per table
+        :rtype: dict
+        """
+        def expression(column):
+            return "p.id" if column == 'player_id' else "s." + column
+
+        merged = {}
+        for table_name in tables:
+            table = TABLES_BY_NAME[table_name]
+            if table.name in PLAYER_TABLES:
+                source = "{0}_staging s join player p on p.href = s.player_href".format(table.name)
+            else:
+                source = "{0}_staging s".format(table.name)
+            # the latest staged row of each key, which for partitioned tables also decides the season
+            latest = "select distinct on ({0}) {1} from {2} order by {0}, s.seq desc".format(
+                ", ".join(expression(column) for column in table.key),
+                ", ".join("{0} as {1}".format(expression(column), column) for column in table.columns),
+                source
+            )
+            if table.name in self.partitioned:
+                self.cursor.execute("select distinct season from {0}_staging".format(table.name))
+                self.create_partitions(table, [season for (season,) in self.cursor.fetchall()])
+                started = time.monotonic()
+                self.cursor.execute(
+                    "delete from {0} t using ({1}) n where {2} and t.season <> n.season".format(
+                        table.name, latest, " and ".join("t.{0} = n.{0}".format(column) for column in table.key)
+                    )
+                )
+                self.record('delete', table.name, self.cursor.rowcount, started)
+            sql = upsert_sql(
+                self.conflict_table(table),
+                "select {0}, now(), now() from ({1}) n".format(", ".join(table.columns), latest)
+            ) + " where {0}.content_hash is distinct from excluded.content_hash".format(table.name)
+            started = time.monotonic()
+            self.cursor.execute(sql)
+            self.record('merge', table.name, self.cursor.rowcount, started)
+            merged[table.name] = self.cursor.rowcount
+            self.cursor.execute("drop table {0}_staging".format(table.name))
+        return merged
+
+
+class SqliteBackend(Backend):
+    """Write to an embedded SQLite database file in WAL mode, so that crawls need no database server.
+    Batches are upserted with one `executemany` per table, using the same ON CONFLICT clauses as PostgreSQL.
+    """
+
+    # the largest number of values bound to a single "in (...)" list
+    MAX_VARIABLES = 500
+    # the current UTC time with milliseconds, as CURRENT_TIMESTAMP only has seconds
+    NOW = "strftime('%Y-%m-%d %H:%M:%f', 'now')"
+
+    connection_errors = (sqlite3.OperationalError,)
+    # the primary result codes of the operational errors that come from locks and IO rather than from the
+    # statements (SQLITE_BUSY, SQLITE_LOCKED and SQLITE_IOERR), and their messages, as errors only carry their
+    # result code from Python 3.11 on
+    CONNECTION_ERROR_CODES = {5, 6, 10}
+    CONNECTION_ERROR_MESSAGES = ('database is locked', 'database table is locked', 'disk I/O error')
+
+    def __init__(self, path, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+
+    def is_connection_error(self, error):
+        if not isinstance(error, self.connection_errors):
+            return False
+        code = getattr(error, 'sqlite_errorcode', None)
+        if code is not None:
+            # extended result codes, such as SQLITE_IOERR_WRITE, keep the primary code in their low byte
+            return code & 0xff in self.CONNECTION_ERROR_CODES
+        return str(error).startswith(self.CONNECTION_ERROR_MESSAGES)
+
+    def connect(self):
+        # the connection is opened in the reactor thread, but SpoolingDatabasePipeline uses it from its drainer
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.cursor = self.connection.cursor()
+        # readers do not block the writer, and commits only sync the write-ahead log at checkpoints
+        self.cursor.execute("pragma journal_mode = wal")
+        self.cursor.execute("pragma synchronous = normal")
+        self.upserts = {}
+
+    def create_tables(self, spider_name):
+        for statement in SQLITE_SCHEMA.get(spider_name, []):
+            self.cursor.execute(statement)
+
+    def select_in(self, sql, values):
+        """Run a query for chunks of `values`, which it binds to the "{0}" placeholder list in `sql`."""
+        records = []
+        for i in range(0, len(values), self.MAX_VARIABLES):
+            chunk = values[i:i + self.MAX_VARIABLES]
+            self.cursor.execute(sql.format(", ".join("?" * len(chunk))), chunk)
+            records.extend(self.cursor.fetchall())
+        return records
+
+    def recent_ids(self, table, limit):
+        self.cursor.execute("select 1 from sqlite_master where type = 'table' and name = ?", (table,))
+        if self.cursor.fetchone() is None:
+            return []
+        # nulls sort first in sqlite, so they come last in descending order
+        self.cursor.execute("select href, id from {0} order by updated_at desc limit ?".format(table), (limit,))
+        return list(reversed(self.cursor.fetchall()))
+
+    def select_id(self, table, href):
+        started = time.monotonic()
+        self.cursor.execute("select id from {0} where href = ?".format(table), (href,))
+        result = self.cursor.fetchone()
+        self.record('lookup', table, 1, started)
+        return result[0] if result else None
+
+    def stored_rows(self, table, values):
+        started = time.monotonic()
+        records = self.select_in(
+            "select {0}, content_hash, id from {1} where {2} in ({{0}})".format(
+                ", ".join(table.key), table.name, table.key[0]
+            ),
+            values
+        )
+        self.record('hashes', table.name, len(values), started)
+        return records
+
+    def upsert(self, table, rows):
+        if table.name not in self.upserts:
+            self.upserts[table.name] = upsert_sql(
+                table,
+                "values ({0}, {1}, {1})".format(", ".join("?" * len(table.columns)), self.NOW),
+                now=self.NOW
+            )
+        started = time.monotonic()
+        self.cursor.executemany(
+            self.upserts[table.name], ([row[column] for column in table.columns] for row in rows)
+        )
+        ids = {}
+        if table.name in ID_TABLES:
+            # executemany cannot return rows, so the ids are read back by href
+            ids = dict(self.select_in(
+                "select href, id from {0} where href in ({{0}})".format(table.name), [row['href'] for row in rows]
+            ))
+        self.record('upsert', table.name, len(rows), started)
+        return ids
+
+    def stream(self, sql, batch_size=1000):
+        # sqlite cursors step through results as they are iterated
+        cursor = self.connection.cursor()
+        cursor.arraysize = batch_size
+        try:
+            cursor.execute(sql)
+            columns = [column[0] for column in cursor.description]
+            for record in cursor:
+                yield dict(zip(columns, record))
+        finally:
+            cursor.close()
+
+    def replace_games(self, table, games):
+        game_ids = list(games)
+        rows = [row for game_rows in games.values() for row in game_rows]
+        started = time.monotonic()
+        deleted = 0
+        for i in range(0, len(game_ids), self.MAX_VARIABLES):
+            chunk = game_ids[i:i + self.MAX_VARIABLES]
+            self.cursor.execute(
+                "delete from {0} where game_id in ({1})".format(table.name, ", ".join("?" * len(chunk))), chunk
+            )
+            deleted += self.cursor.rowcount
+        self.record('delete', table.name, deleted, started)
+
+        started = time.monotonic()
+        self.cursor.executemany(
+            "insert into {0} ({1}) values ({2})".format(
+                table.name, ", ".join(table.columns), ", ".join("?" * len(table.columns))
+            ),
+            ([row[column] for column in table.columns] for row in rows)
+        )
+        self.record('copy', table.name, len(rows), started)
+
+    def resolve_foreign_keys(self, tables):
+        self.cursor.execute("select name from sqlite_master where type = 'table'")
+        existing = {name for (name,) in self.cursor.fetchall()}
+
+        updated = {}
+        for table in tables:
+            for id_column, parent, href_column in FOREIGN_KEYS.get(table, []):
+                if table not in existing or parent not in existing:
+                    continue
+                started = time.monotonic()
+                self.cursor.execute(
+                    "update {0} set {1} = r.id from {2} r "
+                    "where r.href = {0}.{3} and {0}.{1} is not r.id".format(table, id_column, parent, href_column)
+                )
+                self.record('resolve', table, self.cursor.rowcount, started)
+                updated["{0}.{1}".format(table, id_column)] = self.cursor.rowcount
+        return updated
+
+
+def backend_from_settings(settings, stats=None):
+    """Create the backend selected by the DATABASE_BACKEND setting.
+
+    :param settings: The project settings
+    :type settings: scrapy.settings.Settings
+    :param stats: The stats collector that statement metrics are recorded in, if any
+    :type stats: scrapy.statscollectors.StatsCollector
+    :rtype: Backend
+    """
+    name = settings.get("DATABASE_BACKEND", 'postgres')
+    slow_statement_secs = settings.getfloat("DATABASE_SLOW_STATEMENT_SECS", 1.0)
+    if name == 'postgres':
+        return PostgresBackend(
+            db_host=settings.get("DATABASE_HOST"),
+            db_port=settings.get("DATABASE_PORT"),
+            db_user=settings.get("DATABASE_USER"),
+            db_password=settings.get("DATABASE_PASSWORD"),
+            db_db=settings.get("DATABASE_DB"),
+            partitioning=settings.getbool("DATABASE_PARTITIONING", False),
+            stats=stats,
+            slow_statement_secs=slow_statement_secs,
+        )
+    if name == 'sqlite':
+        return SqliteBackend(
+            settings.get("DATABASE_SQLITE_PATH", 'tfmkt.sqlite3'),
+            stats=stats,
+            slow_statement_secs=slow_statement_secs,
+        )
+    raise ValueError("Unknown DATABASE_BACKEND {0!r}, expected 'postgres' or 'sqlite'".format(name))
+
+
 class DatabasePipeline:
 
-    def __init__(self, db_host, db_port, db_user, db_password, db_db):
+    def __init__(self, backend, stats, batch_size=500, flush_interval=5.0, lookup_cache_size=100000,
+                 skip_unchanged=True, staging=False, defer_foreign_keys=False):
+        self.backend = backend
+        self.stats = stats
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.lookup_cache = LookupCache(lookup_cache_size)
+        self.skip_unchanged = skip_unchanged
+        if staging and not backend.can_stage:
+            logger.warning("DATABASE_STAGING is not supported by %s, rows are upserted directly", type(backend).__name__)
+            staging = False
+        self.staging = staging
+        self.defer_foreign_keys = defer_foreign_keys
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(
+            backend=backend_from_settings(crawler.settings, crawler.stats),
+            stats=crawler.stats,
+            batch_size=crawler.settings.getint("DATABASE_BATCH_SIZE", 500),
+            flush_interval=crawler.settings.getfloat("DATABASE_FLUSH_INTERVAL", 5.0),
+            lookup_cache_size=crawler.settings.getint("DATABASE_LOOKUP_CACHE_SIZE", 100000),
+            skip_unchanged=crawler.settings.getbool("DATABASE_SKIP_UNCHANGED", True),
+            staging=crawler.settings.getbool("DATABASE_STAGING", False),
+            defer_foreign_keys=crawler.settings.getbool("DATABASE_DEFER_FOREIGN_KEYS", False),
+        )
+
+    def open_spider(self, spider):
+        # rows waiting to be written, per table and keyed by their conflict key. keying them
+        # makes a later version of a row replace an earlier one, as a statement cannot upsert the same key twice.
+        # the tables in GAME_TABLES hold the list of rows of each game instead, keyed by game id
+        self.buffer = {table.name: {} for table in TABLES}
+        # the items of the buffered rows, to write them one at a time if the batch fails
+        self.items = []
+        self.last_flush = time.monotonic()
+        self.flusher = None
+
+        self.backend.connect()
+        self.backend.create_tables(spider.name)
+        if self.staging:
+            self.backend.create_staging_tables(self.staged_tables(spider))
+        self.backend.commit()
+
+        if not self.defer_foreign_keys:
+            self.preload_lookup_cache()
+        self.start_flusher()
+
+    def start_flusher(self):
+        """Flush the buffered rows every DATABASE_FLUSH_INTERVAL seconds, even when no items arrive."""
+        self.flusher = LoopingCall(self.flush_buffered)
+        self.flusher.start(self.flush_interval, now=False)
+
+    def flush_buffered(self):
+        if not self.items:
+            return
+        try:
+            self.flush()
+        except Exception:
+            # the rows stay buffered, and the next flush writes them
+            logger.exception("Failed to flush %d items to the database", len(self.items))
+
+    def close_spider(self, spider):
+        if self.flusher is not None and self.flusher.running:
+            self.flusher.stop()
+        try:
+            self.flush()
+            if self.staging:
+                try:
+                    merged = self.backend.merge_staging_tables(self.staged_tables(spider))
+                    self.backend.commit()
+                except Exception:
+                    self.backend.rollback()
+                    raise
+                for table, count in merged.items():
+                    self.stats.inc_value('database/merged/{0}'.format(table), count)
+            if self.defer_foreign_keys:
+                # besides the spider's own tables, resolve the ones referencing them, as their rows
+                # may have been written before the rows they reference
+                written = SPIDER_TABLES.get(spider.name, [])
+                tables = [
+                    table for table, foreign_keys in FOREIGN_KEYS.items()
+                    if table in written or any(parent in written for _, parent, _ in foreign_keys)
+                ]
+                for column, count in self.backend.resolve_foreign_keys(tables).items():
+                    self.stats.set_value('database/resolved/{0}'.format(column), count)
+                self.backend.commit()
+        finally:
+            self.backend.close()
+
+    def staged_tables(self, spider):
+        # the rows of games are copied into their tables directly
+        return [table for table in SPIDER_TABLES.get(spider.name, []) if table not in GAME_TABLES]
+
+    def process_item(self, item, spider):
+        self.add_item(spider.name, ItemAdapter(item).asdict())
+        if self.flush_due():
+            self.flush()
+        return item
+
+    def add_item(self, spider_name, item_dic):
+        self.buffer_item(self.buffer, spider_name, item_dic)
+        self.items.append((spider_name, item_dic))
+
+    def buffer_item(self, buffer, spider_name, item_dic):
+        """Add the rows of an item to a buffer of rows per table.
+        """
+        games = {}
+        if spider_name in SPIDER_GAME_TABLES:
+            games[(SPIDER_GAME_TABLES[spider_name], item_dic['game_id'])] = []
+        for table, key, row in item_rows(spider_name, item_dic):
+            if table in GAME_TABLES:
+                games.setdefault((table, key[0]), []).append(row)
+                continue
+            for id_column, parent, href_column in FOREIGN_KEYS.get(table, []):
+                # deferred ids are filled in from the href columns when the spider closes
+                row[id_column] = None if self.defer_foreign_keys else self.select_id(parent, row[href_column])
+            row['content_hash'] = row_hash(TABLES_BY_NAME[table], row)
+            buffer[table][key] = row
+
+        for (table, game_id), rows in games.items():
+            # the rows of game tables are buffered per game, replacing the ones buffered for it, and all carry the
+            # hash of the whole game
+            content_hash = game_hash(TABLES_BY_NAME[table], rows)
+            for row in rows:
+                row['content_hash'] = content_hash
+            buffer[table][game_id] = rows
+
+    def flush_due(self):
+        return (
+            sum(len(rows) for rows in self.buffer.values()) >= self.batch_size or
+            time.monotonic() - self.last_flush >= self.flush_interval
+        )
+
+    def preload_lookup_cache(self):
+        """Fill the lookup cache with the most recently updated rows of each lookup table, using one query per table."""
+        for table in LOOKUP_TABLES:
+            for href, row_id in self.backend.recent_ids(table, self.lookup_cache.size):
+                self.lookup_cache.put(table, href, row_id)
+        self.backend.commit()
+        self.stats.set_value('database/lookup_cache/preloaded', len(self.lookup_cache))
+
+    def select_id(self, table, href):
+        if not href:
+            return None
+        row_id = self.lookup_cache.get(table, href)
+        if row_id is not None:
+            self.stats.inc_value('database/lookup_cache/hits')
+            return row_id
+
+        self.stats.inc_value('database/lookup_cache/misses')
+        row_id = self.backend.select_id(table, href)
+        if row_id is not None:
+            self.lookup_cache.put(table, href, row_id)
+        return row_id
+
+    def changed_rows(self, table, rows, ids):
+        """Leave out the rows whose content hash matches the one stored for their key. The ids of the
+        stored rows are collected into `ids` as well, since rows that are not written return no id.
+
+        :param table: The table definition
+        :type table: Table
+        :param rows: The buffered rows
+        :type rows: typing.List[dict]
+        :param ids: The href to id mappings of the current flush, per table
+        :type ids: dict
+        :return: The rows that are new or changed
+        :rtype: typing.List[dict]
+        """
+        # the rows are matched on the key that they are upserted with, which includes the season of partitioned tables
+        conflict_table = self.backend.conflict_table(table)
+        stored = {}
+        for record in self.backend.stored_rows(conflict_table, list({row[table.key[0]] for row in rows})):
+            key = tuple(record[:len(conflict_table.key)])
+            stored[key] = record[len(conflict_table.key)]
+            if table.name in ID_TABLES:
+                ids.setdefault(table.name, {})[key[0]] = record[-1]
+
+        changed = [
+            row for row in rows if stored.get(tuple(row[column] for column in conflict_table.key)) != row['content_hash']
+        ]
+        if len(changed) < len(rows):
+            self.stats.inc_value('database/skipped/{0}'.format(table.name), len(rows) - len(changed))
+        return changed
+
+    def changed_games(self, table, games):
+        """Leave out the games whose stored rows have the same content hash, and the games with no rows that
+        have none stored either.
+
+        :param table: The table definition, of one of GAME_TABLES
+        :type table: Table
+        :param games: The buffered rows of each game, by game id
+        :type games: typing.Dict[int, typing.List[dict]]
+        :return: The games that are new or changed
+        :rtype: typing.Dict[int, typing.List[dict]]
+        """
+        stored = {record[0]: record[len(table.key)] for record in self.backend.stored_rows(table, list(games))}
+        changed = {
+            game_id: rows for game_id, rows in games.items()
+            if stored.get(game_id) != (rows[0]['content_hash'] if rows else None)
+        }
+        skipped = sum(len(rows) for game_id, rows in games.items() if game_id not in changed)
+        if skipped:
+            self.stats.inc_value('database/skipped/{0}'.format(table.name), skipped)
+        return changed
+
+    def flush(self):
+        """Write all buffered rows with one batch upsert per table, and commit them in a single transaction.
+        If the batch fails because of its rows, its items are written again one at a time, each in its own
+        transaction, and only the items that still fail are logged and dropped. If the connection fails, the
+        backend reconnects and the batch is written once more. The rows stay buffered until they are committed,
+        so nothing is lost when that fails too.
+        """
+        self.last_flush = time.monotonic()
+        try:
+            ids = self.write_batch()
+        except Exception as e:
+            if not self.backend.is_connection_error(e):
+                raise
+            logger.warning("Lost the database connection (%s), reconnecting to write the batch again", e)
+            self.stats.inc_value('database/reconnects')
+            self.backend.reconnect()
+            ids = self.write_batch()
+        self.buffer = {table.name: {} for table in TABLES}
+        self.items = []
+
+        for table in LOOKUP_TABLES:
+            for href, row_id in ids.get(table, {}).items():
+                self.lookup_cache.put(table, href, row_id)
+
+    def write_batch(self):
+        """Write the buffer, or its items one at a time if the batch fails because of its rows.
+
+        :return: The href to id mappings of the rows written, per table
+        :rtype: dict
+        """
+        try:
+            return self.write(self.buffer)
+        except Exception as e:
+            if self.backend.is_connection_error(e):
+                # a connection that failed may not even be able to roll back, which must not hide the first error
+                try:
+                    self.backend.rollback()
+                except Exception as rollback_error:
+                    if not self.backend.is_connection_error(rollback_error):
+                        raise
+                raise
+            self.backend.rollback()
+            if len(self.items) == 1:
+                self.drop_item(*self.items[0], e)
+                return {}
+            logger.warning("Failed to write a batch of %d items (%s), writing them one at a time", len(self.items), e)
+            self.stats.inc_value('database/failed_batches')
+            return self.write_items(self.items)
+
+    def write_items(self, items):
+        """Write items one at a time, each in its own transaction, dropping the ones that fail.
+
+        :return: The href to id mappings of the items written, per table
+        :rtype: dict
+        """
+        ids = {}
+        for spider_name, item_dic in items:
+            buffer = {table.name: {} for table in TABLES}
+            try:
+                self.buffer_item(buffer, spider_name, item_dic)
+                for table, table_ids in self.write(buffer).items():
+                    ids.setdefault(table, {}).update(table_ids)
+            except Exception as e:
+                self.backend.rollback()
+                if self.backend.is_connection_error(e):
+                    raise
+                self.drop_item(spider_name, item_dic, e)
+        return ids
+
+    def drop_item(self, spider_name, item_dic, error):
+        logger.error(
+            "Dropped %s item %s from the database: %s",
+            item_dic.get('type') or spider_name, item_dic.get('href'), error
+        )
+        self.stats.inc_value('database/dropped_items')
+
+    def write(self, buffer):
+        """Write a buffer of rows with one batch upsert per table and commit it. In staging mode, the rows are
+        copied into the staging tables instead. The rows of games replace the ones stored for their games in both
+        modes.
+
+        :return: The href to id mappings of the rows written, per table
+        :rtype: dict
+        """
+        ids = {}
+        self.backend.fill_partition_keys(buffer)
+        if self.staging:
+            self.backend.copy_to_staging(buffer)
+        else:
+            for table in TABLES:
+                rows = list(buffer[table.name].values())
+                if not rows or table.name in GAME_TABLES:
+                    continue
+                if table.name in PLAYER_TABLES:
+                    for row in rows:
+                        row['player_id'] = ids['player'][row['player_href']]
+                if self.skip_unchanged:
+                    rows = self.changed_rows(table, rows, ids)
+                    if not rows:
+                        continue
+                ids.setdefault(table.name, {}).update(self.backend.upsert(table, rows))
+
+        for table_name in GAME_TABLES:
+            table = TABLES_BY_NAME[table_name]
+            games = buffer[table.name]
+            if games and self.skip_unchanged:
+                games = self.changed_games(table, games)
+            if games:
+                self.backend.replace_games(table, games)
+        self.backend.commit()
+        return ids
+
+
+class SpoolingDatabasePipeline(DatabasePipeline):
+    """A DatabasePipeline that appends items to an on-disk spool and loads them into the database from a
+    background thread, so a slow or restarting database neither blocks the crawl nor loses items.
+
+    The spool is a directory per spider (DATABASE_SPOOL_DIR/<spider>) of JSON lines segment files, which
+    are rolled over at DATABASE_SPOOL_SEGMENT_SIZE bytes. The drainer records the position it has loaded up
+    to in an "offset" file after each database commit, so after a crash it resumes from there. Whenever more
+    than DATABASE_SPOOL_HIGH_WATER_MARK bytes are waiting to be loaded the engine is paused, until the
+    backlog gets down to half of that.
+    """
+
+    def __init__(self, *args, spool_dir='spool', segment_size=64 * 1024 * 1024,
+                 high_water_mark=256 * 1024 * 1024, retry_delay=5.0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.spool_dir = spool_dir
+        self.segment_size = segment_size
+        self.high_water_mark = high_water_mark
+        self.retry_delay = retry_delay
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        pipeline = super().from_crawler(crawler)
+        pipeline.crawler = crawler
+        pipeline.spool_dir = crawler.settings.get("DATABASE_SPOOL_DIR", 'spool')
+        pipeline.segment_size = crawler.settings.getint("DATABASE_SPOOL_SEGMENT_SIZE", 64 * 1024 * 1024)
+        pipeline.high_water_mark = crawler.settings.getint("DATABASE_SPOOL_HIGH_WATER_MARK", 256 * 1024 * 1024)
+        pipeline.retry_delay = crawler.settings.getfloat("DATABASE_SPOOL_RETRY_DELAY", 5.0)
+        return pipeline
+
+    def open_spider(self, spider):
+        super().open_spider(spider)
+
+        self.spool_path = os.path.join(self.spool_dir, spider.name)
+        os.makedirs(self.spool_path, exist_ok=True)
+
+        # bytes spooled but not loaded yet, updated by both threads
+        self.lock = threading.Lock()
+        segment, offset = self.read_offset()
+        segments = [n for n in self.segments() if n >= segment]
+        self.backlog = sum(os.path.getsize(self.segment_file(n)) for n in segments) - (offset if segment in segments else 0)
+
+        # always write to a new segment, as the last one may end with a line cut by a crash
+        self.segment = max(segments + [segment]) + 1
+        self.spool = open(self.segment_file(self.segment), 'ab')
+        self.spooled = 0
+        self.paused = False
+
+        self.closing = threading.Event()
+        self.drainer = threading.Thread(target=self.drain, args=(spider,), name='spool-drainer', daemon=True)
+        self.drainer.start()
+
+    def start_flusher(self):
+        # the drainer flushes on its own thread, which is the only one using the connection
+        pass
+
+    def close_spider(self, spider):
+        self.spool.close()
+        self.closing.set()
+        return threads.deferToThread(self.drainer.join)
+
+    def process_item(self, item, spider):
+        line = (json.dumps(ItemAdapter(item).asdict()) + '\n').encode()
+        if self.spooled > 0 and self.spooled + len(line) > self.segment_size:
+            self.spool.close()
+            self.spool = open(self.segment_file(self.segment + 1), 'ab')
+            self.spooled = 0
+            # only move on once the previous segment is complete, as the drainer takes a lower
+            # segment number as a sign that the segment will not grow anymore
+            self.segment += 1
+        self.spool.write(line)
+        self.spool.flush()
+        self.spooled += len(line)
+
+        with self.lock:
+            self.backlog += len(line)
+        self.stats.max_value('database/spool/max_backlog_bytes', self.backlog)
+        self.update_backpressure()
+        return item
+
+    def update_backpressure(self):
+        """Pause or unpause the engine according to the backlog. It always runs in the reactor thread."""
+        if not self.paused and self.backlog > self.high_water_mark:
+            self.paused = True
+            self.crawler.engine.pause()
+            self.stats.inc_value('database/spool/pauses')
+        elif self.paused and self.backlog <= self.high_water_mark // 2:
+            self.paused = False
+            self.crawler.engine.unpause()
+
+    def segments(self):
+        return sorted(
+            int(name.split('.')[0]) for name in os.listdir(self.spool_path) if name.endswith('.jsonl')
+        )
+
+    def segment_file(self, segment):
+        return os.path.join(self.spool_path, "{0:08d}.jsonl".format(segment))
+
+    def read_offset(self):
+        try:
+            with open(os.path.join(self.spool_path, 'offset')) as f:
+                segment, offset = f.read().split()
+                return int(segment), int(offset)
+        except FileNotFoundError:
+            return 0, 0
+
+    def commit(self, segment, offset, loaded):
+        """Flush the buffered rows, then record the spool position they were read up to and drop the
+        segments before it.
+
+        :param segment: The segment of the position
+        :type segment: int
+        :param offset: The byte offset of the position within the segment
+        :type offset: int
+        :param loaded: The number of bytes read since the last commit
+        :type loaded: int
+        """
+        self.flush()
+
+        offset_file = os.path.join(self.spool_path, 'offset')
+        with open(offset_file + '.tmp', 'w') as f:
+            f.write("{0} {1}".format(segment, offset))
+        os.replace(offset_file + '.tmp', offset_file)
+        for n in self.segments():
+            if n < segment:
+                os.remove(self.segment_file(n))
+
+        from twisted.internet import reactor
+
+        with self.lock:
+            self.backlog -= loaded
+        reactor.callFromThread(self.update_backpressure)
+
+    def drain(self, spider):
+        while True:
+            try:
+                self.drain_from(spider, *self.read_offset())
+                break
+            except Exception:
+                spider.logger.exception("Failed to load the spool into the database")
+                if self.closing.is_set():
+                    # the items are kept in the spool, and will be loaded by the next run
+                    break
+                time.sleep(self.retry_delay)
+                # start over from the last committed position with a new connection
+                self.buffer = {table.name: {} for table in TABLES}
+                self.items = []
+                try:
+                    self.backend.reconnect()
+                except Exception:
+                    spider.logger.exception("Failed to reconnect to the database")
+        try:
+            DatabasePipeline.close_spider(self, spider)
+        except Exception:
+            spider.logger.exception("Failed to close the database pipeline")
+
+    def drain_from(self, spider, segment, offset):
+        loaded = 0
+        while True:
+            if segment < self.segment and not os.path.exists(self.segment_file(segment)):
+                segment, offset = segment + 1, 0
+                continue
+
+            with open(self.segment_file(segment), 'rb') as f:
+                f.seek(offset)
+                while True:
+                    # checked before reading, so that everything the writer wrote before is visible
+                    complete = segment < self.segment or self.closing.is_set()
+                    line = f.readline()
+                    if line.endswith(b'\n'):
+                        offset += len(line)
+                        loaded += len(line)
+                        self.add_item(spider.name, json.loads(line))
+                        if self.flush_due():
+                            self.commit(segment, offset, loaded)
+                            loaded = 0
+                    elif complete:
+                        # whatever is left is a line cut by a crash
+                        loaded += len(line)
+                        break
+                    else:
+                        f.seek(offset)
+                        if loaded and self.flush_due():
+                            self.commit(segment, offset, loaded)
+                            loaded = 0
+                        self.closing.wait(0.1)
+
+            # the segment has been read entirely, and is removed once the position moves past it
+            segment, offset = segment + 1, 0
+            self.commit(segment, offset, loaded)
+            loaded = 0
+            if segment > self.segment:
+                return
+
+
+class AsyncDatabasePipeline:
+    """Write items to the same tables as DatabasePipeline through an asyncpg connection pool, so that
+    database latency does not block the reactor.
+
+    It needs the asyncio reactor, set with TWISTED_REACTOR, and the optional asyncpg package. Every item is
+    written in its own transaction, and at most DATABASE_ASYNC_CONCURRENCY items are written at a time. As with
+    DatabasePipeline, rows whose content did not change are not rewritten, the rows of a game replace the ones
+    stored for it, and statements are recorded in the crawl stats. It only writes to PostgreSQL, without
+    partitioning, staging or deferred foreign keys.
+    """
+
+    # the settings that only DatabasePipeline supports
+    UNSUPPORTED_SETTINGS = ('DATABASE_PARTITIONING', 'DATABASE_STAGING', 'DATABASE_DEFER_FOREIGN_KEYS')
+
+    def __init__(self, db_host, db_port, db_user, db_password, db_db, stats, concurrency=10,
+                 lookup_cache_size=100000, skip_unchanged=True, slow_statement_secs=1.0):
         self.db_host = db_host
         self.db_port = db_port
         self.db_user = db_user
         self.db_password = db_password
         self.db_db = db_db
+        self.stats = stats
+        self.concurrency = concurrency
+        self.lookup_cache = LookupCache(lookup_cache_size)
+        self.skip_unchanged = skip_unchanged
+        self.slow_statement_secs = slow_statement_secs
 
     @classmethod
     def from_crawler(cls, crawler):
+        if not is_asyncio_reactor_installed():
+            raise UsageError(
+                "AsyncDatabasePipeline needs the asyncio reactor, run the crawl with "
+                "-s TWISTED_REACTOR=twisted.internet.asyncioreactor.AsyncioSelectorReactor"
+            )
+        unsupported = [name for name in cls.UNSUPPORTED_SETTINGS if crawler.settings.getbool(name, False)]
+        if crawler.settings.get("DATABASE_BACKEND", 'postgres') != 'postgres':
+            unsupported.append("DATABASE_BACKEND={0!r}".format(crawler.settings.get("DATABASE_BACKEND")))
+        if unsupported:
+            raise UsageError(
+                "AsyncDatabasePipeline does not support {0}, use DatabasePipeline instead".format(", ".join(unsupported))
+            )
         return cls(
             db_host=crawler.settings.get("DATABASE_HOST"),
             db_port=crawler.settings.get("DATABASE_PORT"),
             db_user=crawler.settings.get("DATABASE_USER"),
             db_password=crawler.settings.get("DATABASE_PASSWORD"),
             db_db=crawler.settings.get("DATABASE_DB"),
+            stats=crawler.stats,
+            concurrency=crawler.settings.getint("DATABASE_ASYNC_CONCURRENCY", 10),
+            lookup_cache_size=crawler.settings.getint("DATABASE_LOOKUP_CACHE_SIZE", 100000),
+            skip_unchanged=crawler.settings.getbool("DATABASE_SKIP_UNCHANGED", True),
+            slow_statement_secs=crawler.settings.getfloat("DATABASE_SLOW_STATEMENT_SECS", 1.0),
         )
 
     def open_spider(self, spider):
-        self.pgconn = psycopg2.connect(
+        return deferred_from_coro(self._open_spider(spider))
+
+    async def _open_spider(self, spider):
+        import asyncpg
+
+        self.pool = await asyncpg.create_pool(
             database=self.db_db,
             user=self.db_user,
             password=self.db_password,
             host=self.db_host,
-            port=self.db_port
+            port=self.db_port,
+            min_size=1,
+            max_size=self.concurrency
         )
-        self.pgcursor = self.pgconn.cursor()
-
-        if spider.name == 'competitions':
-            self.pgcursor.execute("CREATE TABLE IF NOT EXISTS competition "
-                                  "(id SERIAL PRIMARY KEY,"
-                                  "href VARCHAR(255) UNIQUE,"
-                                  "tag VARCHAR(255),"
-                                  "country_id VARCHAR(255),"
-                                  "country_name VARCHAR(255),"
-                                  "country_code VARCHAR(255),"
-                                  "competition_type VARCHAR(255),"
-                                  "created_at TIMESTAMPTZ,"
-                                  "updated_at TIMESTAMPTZ )")
-            self.pgconn.commit()
-        elif spider.name == 'clubs':
-            self.pgcursor.execute("CREATE TABLE IF NOT EXISTS club "
-                                  "(id SERIAL PRIMARY KEY,"
-                                  "href VARCHAR(255) UNIQUE,"
-                                  "competition_id INT,"
-                                  "code VARCHAR(255),"
-                                  "name VARCHAR(255),"
-                                  "coach_name VARCHAR(255),"
-                                  "average_age FLOAT,"
-                                  "foreigners_number INT,"
-                                  "foreigners_percentage VARCHAR(255),"
-                                  "national_team_players VARCHAR(255),"
-                                  "net_transfer_record VARCHAR(255),"
-                                  "squad_size VARCHAR(255),"
-                                  "stadium_name VARCHAR(255),"
-                                  "stadium_seats VARCHAR(255),"
-                                  "total_market_value VARCHAR(255),"
-                                  "created_at TIMESTAMPTZ,"
-                                  "updated_at TIMESTAMPTZ )")
-            self.pgconn.commit()
-        elif spider.name == 'games':
-            self.pgcursor.execute("CREATE TABLE IF NOT EXISTS game "
-                                  "(id SERIAL PRIMARY KEY,"
-                                  "href VARCHAR(255) UNIQUE,"
-                                  "tm_game_id VARCHAR(255),"
-                                  "home_club_href VARCHAR(255),"
-                                  "home_club_id INT,"
-                                  "home_club_type VARCHAR(255),"
-                                  "home_club_position VARCHAR(255),"
-                                  "home_manager_name VARCHAR(255),"
-                                  "away_club_href VARCHAR(255),"
-                                  "away_club_id INT,"
-                                  "away_club_type VARCHAR(255),"
-                                  "away_club_position VARCHAR(255),"
-                                  "away_manager_name VARCHAR(255),"
-                                  "result VARCHAR(255),"
-                                  "matchday VARCHAR(255),"
-                                  "date VARCHAR(255),"
-                                  "stadium VARCHAR(512),"
-                                  "attendance VARCHAR(255),"
-                                  "referee VARCHAR(255),"
-                                  "created_at TIMESTAMPTZ,"
-                                  "updated_at TIMESTAMPTZ )")
-            self.pgconn.commit()
-        elif spider.name == 'players':
-            self.pgcursor.execute("CREATE TABLE IF NOT EXISTS player "
-                                  "(id SERIAL PRIMARY KEY,"
-                                  "href VARCHAR(255) UNIQUE,"
-                                  "code VARCHAR(255),"
-                                  "current_club_id INT,"
-                                  "name VARCHAR(255),"
-                                  "last_name VARCHAR(255),"
-                                  "number VARCHAR(255),"
-                                  "name_in_home_country VARCHAR(255),"
-                                  "date_of_birth VARCHAR(255),"
-                                  "place_of_birth__country VARCHAR(255),"
-                                  "place_of_birth__city VARCHAR(255),"
-                                  "age VARCHAR(255),"
-                                  "height VARCHAR(255),"
-                                  "citizenship VARCHAR(255),"
-                                  "position VARCHAR(255),"
-                                  "image_url VARCHAR(255),"
-                                  "player_agent__href VARCHAR(255),"
-                                  "player_agent__name VARCHAR(255),"
-                                  "foot VARCHAR(255),"
-                                  "joined VARCHAR(255),"
-                                  "contract_expires VARCHAR(255),"
-                                  "day_of_last_contract_extension VARCHAR(255),"
-                                  "outfitter VARCHAR(255),"
-                                  "current_market_value VARCHAR(255),"
-                                  "highest_market_value VARCHAR(255),"
-                                  "highest_market_value_date VARCHAR(255),"
-                                  "market_value_last_change VARCHAR(255),"
-                                  "market_value_details_url VARCHAR(255),"
-                                  "social_media VARCHAR(1024),"
-                                  "transfer_history__fee_sum VARCHAR(255),"
-                                  "transfer_history__formatted_fee_sum VARCHAR(255),"
-                                  "career_stats__total_appearances VARCHAR(255),"
-                                  "career_stats__total_goals VARCHAR(255),"
-                                  "career_stats__total_assists VARCHAR(255),"
-                                  "career_stats__total_minutes_per_goal VARCHAR(255),"
-                                  "career_stats__total_minutes_played VARCHAR(255),"
-                                  "created_at TIMESTAMPTZ,"
-                                  "updated_at TIMESTAMPTZ )")
-            self.pgconn.commit()
-            self.pgcursor.execute("CREATE TABLE IF NOT EXISTS player_valuations "
-                                  "(id SERIAL PRIMARY KEY,"
-                                  "player_id INT,"
-                                  "x VARCHAR(255),"
-                                  "y VARCHAR(255),"
-                                  "mw VARCHAR(255),"
-                                  "datum_mw VARCHAR(255),"
-                                  "verein VARCHAR(255),"
-                                  "age VARCHAR(255),"
-                                  "wappen VARCHAR(255),"
-                                  "created_at TIMESTAMPTZ,"
-                                  "updated_at TIMESTAMPTZ, "
-                                  "UNIQUE (player_id, datum_mw))")
-            self.pgconn.commit()
-            self.pgcursor.execute("CREATE TABLE IF NOT EXISTS player_transfer_history "
-                                  "(id SERIAL PRIMARY KEY,"
-                                  "player_id INT,"
-                                  "url VARCHAR(255),"
-                                  "from_club_emblem_1x VARCHAR(255),"
-                                  "from_club_emblem_2x VARCHAR(255),"
-                                  "from_club_emblem_mobile VARCHAR(255),"
-                                  "from_club_name VARCHAR(255),"
-                                  "from_country_flag VARCHAR(255),"
-                                  "from_href VARCHAR(255),"
-                                  "from_is_special VARCHAR(255),"
-                                  "from_latitude VARCHAR(255),"
-                                  "from_longitude VARCHAR(255),"
-                                  "to_club_emblem_1x VARCHAR(255),"
-                                  "to_club_emblem_2x VARCHAR(255),"
-                                  "to_club_emblem_mobile VARCHAR(255),"
-                                  "to_club_name VARCHAR(255),"
-                                  "to_country_flag VARCHAR(255),"
-                                  "to_href VARCHAR(255),"
-                                  "to_is_special VARCHAR(255),"
-                                  "to_latitude VARCHAR(255),"
-                                  "to_longitude VARCHAR(255),"
-                                  "future_transfer VARCHAR(255),"
-                                  "date VARCHAR(255),"
-                                  "date_unformatted VARCHAR(255),"
-                                  "upcoming VARCHAR(255),"
-                                  "season VARCHAR(255),"
-                                  "market_value VARCHAR(255),"
-                                  "fee VARCHAR(255),"
-                                  "show_upcoming_header VARCHAR(255),"
-                                  "show_reset_header VARCHAR(255),"
-                                  "created_at TIMESTAMPTZ,"
-                                  "updated_at TIMESTAMPTZ,"
-                                  "UNIQUE (player_id, url) )")
-            self.pgconn.commit()
-            self.pgcursor.execute("CREATE TABLE IF NOT EXISTS player_career_stats "
-                                  "(id SERIAL PRIMARY KEY,"
-                                  "player_id INT,"
-                                  "competition_id INT,"
-                                  "competition_href VARCHAR(255),"
-                                  "appearances_href VARCHAR(255),"
-                                  "appearances_number VARCHAR(255),"
-                                  "goals VARCHAR(255),"
-                                  "assists VARCHAR(255),"
-                                  "minutes_per_goal VARCHAR(255),"
-                                  "minutes_played VARCHAR(255),"
-                                  "created_at TIMESTAMPTZ,"
-                                  "updated_at TIMESTAMPTZ,"
-                                  "UNIQUE (player_id, competition_href) )")
-            self.pgconn.commit()
-            self.pgcursor.execute("CREATE TABLE IF NOT EXISTS player_national_team_career "
-                                  "(id SERIAL PRIMARY KEY,"
-                                  "player_id INT,"
-                                  "club_id INT,"
-                                  "club_href VARCHAR(255),"
-                                  "country_name VARCHAR(255),"
-                                  "country_flag_url VARCHAR(255),"
-                                  "debut_date VARCHAR(255),"
-                                  "debut_href VARCHAR(255),"
-                                  "matches_number VARCHAR(255),"
-                                  "matches_href VARCHAR(255),"
-                                  "tore_number VARCHAR(255),"
-                                  "tore_href VARCHAR(255),"
-                                  "created_at TIMESTAMPTZ,"
-                                  "updated_at TIMESTAMPTZ,"
-                                  "UNIQUE (player_id, club_href) )")
-            self.pgconn.commit()
+
+        async with self.pool.acquire() as connection:
+            for statement in SCHEMA.get(spider.name, []):
+                await connection.execute(statement)
+
+            partitioned = await connection.fetch(
+                "select relname from pg_class where relkind = 'p' and relname = any($1::text[])", list(PARTITION_KEYS)
+            )
+            if partitioned:
+                self.pool.terminate()
+                raise UsageError("AsyncDatabasePipeline cannot write to the partitioned tables {0}".format(
+                    ", ".join(name for (name,) in partitioned)
+                ))
+
+            for table in LOOKUP_TABLES:
+                if await connection.fetchval("select to_regclass($1)", table) is None:
+                    continue
+                records = await connection.fetch(
+                    "select href, id from {0} order by updated_at desc nulls last limit $1".format(table),
+                    self.lookup_cache.size
+                )
+                for href, row_id in reversed(records):
+                    self.lookup_cache.put(table, href, row_id)
+        self.stats.set_value('database/lookup_cache/preloaded', len(self.lookup_cache))
 
     def close_spider(self, spider):
-        self.pgconn.close()
+        return deferred_from_coro(self.pool.close())
 
-    def process_item(self, item, spider):
+    async def process_item(self, item, spider):
         item_dic = ItemAdapter(item).asdict()
-        if spider.name == 'competitions':
-            sql = "insert into competition (href, tag, country_id, country_name, country_code, competition_type, created_at, updated_at) " \
-                  "values('{0}', '{1}', '{2}', '{3}', '{4}', '{5}', now(), now()) " \
-                  "on conflict (href) do update " \
-                  "set tag = excluded.tag, " \
-                  "country_id = excluded.country_id, " \
-                  "country_name = excluded.country_name, " \
-                  "country_code = excluded.country_code, " \
-                  "competition_type = excluded.competition_type, " \
-                  "updated_at = now()".format(
-                    quote(item_dic['href']),
-                    quote(item_dic['tag']),
-                    item_dic.get('country_id') or '',
-                    quote(item_dic.get('country_name')),
-                    quote(item_dic.get('country_code')),
-                    quote(item_dic['competition_type'])
-                  )
-            self.pgcursor.execute(sql)
-            self.pgconn.commit()
-        elif spider.name == 'clubs':
-            self.pgcursor.execute("select id from competition where href='{0}'".format(item_dic['parent']['href']))
-            result = self.pgcursor.fetchone()
-            competition_id = result[0] if result else None
-            
-            sql = "insert into club (href, competition_id, code, name, coach_name, average_age, foreigners_number" \
-                  ", foreigners_percentage, national_team_players, net_transfer_record, squad_size, stadium_name" \
-                  ", stadium_seats, total_market_value, created_at, updated_at) " \
-                  "values('{0}', {1}, '{2}', '{3}', '{4}', {5}, {6}, '{7}', '{8}', '{9}', '{10}', '{11}', '{12}', '{13}', now(), now()) " \
-                  "on conflict (href) do update " \
-                  "set competition_id = excluded.competition_id, " \
-                  "code = excluded.code, " \
-                  "name = excluded.name, " \
-                  "coach_name = excluded.coach_name, " \
-                  "average_age = excluded.average_age, " \
-                  "foreigners_number = excluded.foreigners_number, " \
-                  "foreigners_percentage = excluded.foreigners_percentage, " \
-                  "national_team_players = excluded.national_team_players, " \
-                  "net_transfer_record = excluded.net_transfer_record, " \
-                  "squad_size = excluded.squad_size, " \
-                  "stadium_name = excluded.stadium_name, " \
-                  "stadium_seats = excluded.stadium_seats, " \
-                  "total_market_value = excluded.total_market_value, " \
-                  "updated_at = now()".format(
-                    quote(item_dic['href']),
-                    competition_id if competition_id else 'NULL',
-                    quote(item_dic['code']),
-                    quote(item_dic['name']),
-                    quote(item_dic['coach_name']),
-                    item_dic['average_age'] or 'NULL',
-                    item_dic['foreigners_number'] or 'NULL',
-                    item_dic['foreigners_percentage'] or '',
-                    item_dic['national_team_players'] or '',
-                    quote(item_dic['net_transfer_record']),
-                    item_dic['squad_size'] or '',
-                    quote(item_dic['stadium_name']),
-                    quote(item_dic['stadium_seats']),
-                    quote(item_dic['total_market_value'])
-                  )
-            self.pgcursor.execute(sql)
-            self.pgconn.commit()
-        elif spider.name == 'clubs':
-            self.pgcursor.execute("select id from competition where href='{0}'".format(item_dic['parent']['href']))
-            result = self.pgcursor.fetchone()
-            competition_id = result[0] if result else None
-
-            sql = "insert into club (href, competition_id, code, name, coach_name, average_age, foreigners_number" \
-                  ", foreigners_percentage, national_team_players, net_transfer_record, squad_size, stadium_name" \
-                  ", stadium_seats, total_market_value, created_at, updated_at) " \
-                  "values('{0}', {1}, '{2}', '{3}', '{4}', {5}, {6}, '{7}', '{8}', '{9}', '{10}', '{11}', '{12}', '{13}', now(), now()) " \
-                  "on conflict (href) do update " \
-                  "set competition_id = excluded.competition_id, " \
-                  "code = excluded.code, " \
-                  "name = excluded.name, " \
-                  "coach_name = excluded.coach_name, " \
-                  "average_age = excluded.average_age, " \
-                  "foreigners_number = excluded.foreigners_number, " \
-                  "foreigners_percentage = excluded.foreigners_percentage, " \
-                  "national_team_players = excluded.national_team_players, " \
-                  "net_transfer_record = excluded.net_transfer_record, " \
-                  "squad_size = excluded.squad_size, " \
-                  "stadium_name = excluded.stadium_name, " \
-                  "stadium_seats = excluded.stadium_seats, " \
-                  "total_market_value = excluded.total_market_value, " \
-                  "updated_at = now()".format(
-                    quote(item_dic['href']),
-                    competition_id if competition_id else 'NULL',
-                    quote(item_dic['code']),
-                    quote(item_dic['name']),
-                    quote(item_dic['coach_name']),
-                    item_dic['average_age'] or 'NULL',
-                    item_dic['foreigners_number'] or 'NULL',
-                    item_dic['foreigners_percentage'] or '',
-                    item_dic['national_team_players'] or '',
-                    quote(item_dic['net_transfer_record']),
-                    item_dic['squad_size'] or '',
-                    quote(item_dic['stadium_name']),
-                    quote(item_dic['stadium_seats']),
-                    quote(item_dic['total_market_value'])
-                  )
-            self.pgcursor.execute(sql)
-            self.pgconn.commit()
-        elif spider.name == 'games':
-            home_club_id = None
-            away_club_id = None
-            if item_dic.get('home_club') and item_dic['home_club'].get('href'):
-                self.pgcursor.execute("select id from club where href='{0}'".format(item_dic['home_club']['href']))
-                result = self.pgcursor.fetchone()
-                home_club_id = result[0] if result else None
-            if item_dic.get('away_club') and item_dic['away_club'].get('href'):
-                self.pgcursor.execute("select id from club where href='{0}'".format(item_dic['away_club']['href']))
-                result = self.pgcursor.fetchone()
-                away_club_id = result[0] if result else None
-
-            sql = "insert into game (href, tm_game_id, home_club_href, home_club_id, home_club_type, home_club_position, home_manager_name" \
-                  ", away_club_href, away_club_id, away_club_type, away_club_position, away_manager_name" \
-                  ", result, matchday, date, stadium, attendance, referee, created_at, updated_at) " \
-                  "values('{0}', '{1}', '{2}', {3}, '{4}', '{5}', '{6}', '{7}', {8}, '{9}', '{10}', '{11}', '{12}', '{13}', '{14}', '{15}', '{16}', '{17}', now(), now()) " \
-                  "on conflict (href) do update " \
-                  "set tm_game_id = excluded.tm_game_id, " \
-                  "home_club_href = excluded.home_club_href, " \
-                  "home_club_id = excluded.home_club_id, " \
-                  "home_club_type = excluded.home_club_type, " \
-                  "home_club_position = excluded.home_club_position, " \
-                  "home_manager_name = excluded.home_manager_name, " \
-                  "away_club_href = excluded.away_club_href, " \
-                  "away_club_id = excluded.away_club_id, " \
-                  "away_club_type = excluded.away_club_type, " \
-                  "away_club_position = excluded.away_club_position, " \
-                  "away_manager_name = excluded.away_manager_name, " \
-                  "result = excluded.result, " \
-                  "matchday = excluded.matchday, " \
-                  "date = excluded.date, " \
-                  "stadium = excluded.stadium, " \
-                  "attendance = excluded.attendance, " \
-                  "referee = excluded.referee, " \
-                  "updated_at = now()".format(
-                quote(item_dic['href']),
-                quote(item_dic['game_id']),
-                quote(item_dic['home_club'].get('href')) if item_dic.get('home_club') else '',
-                home_club_id if home_club_id else 'NULL',
-                quote(item_dic['home_club'].get('type')) if item_dic.get('home_club') else '',
-                quote(item_dic['home_club_position']),
-                quote(item_dic['home_manager'].get('name')) if item_dic.get('home_manager') else '',
-                quote(item_dic['away_club'].get('href')) if item_dic.get('away_club') else '',
-                away_club_id if away_club_id else 'NULL',
-                quote(item_dic['away_club'].get('type')) if item_dic.get('away_club') else '',
-                quote(item_dic['away_club_position']),
-                quote(item_dic['away_manager'].get('name')) if item_dic.get('away_manager') else '',
-                quote(item_dic['result']),
-                quote(item_dic['matchday']),
-                quote(item_dic['date']),
-                quote(item_dic['stadium']),
-                quote(item_dic['attendance']),
-                quote(item_dic['referee'])
-            )
-            self.pgcursor.execute(sql)
-            self.pgconn.commit()
-        elif spider.name == 'players':
-            self.pgcursor.execute("select id from club where href='{0}'".format(item_dic['current_club']['href']))
-            result = self.pgcursor.fetchone()
-            current_club_id = result[0] if result else None
-            sql = "insert into player (href, code, current_club_id, name, last_name, number, name_in_home_country" \
-                  ", date_of_birth, place_of_birth__country, place_of_birth__city, age, height, citizenship, position" \
-                  ", image_url, player_agent__href, player_agent__name, foot, joined, contract_expires" \
-                  ", day_of_last_contract_extension, outfitter, current_market_value, highest_market_value" \
-                  ", highest_market_value_date, market_value_last_change, market_value_details_url, social_media" \
-                  ", transfer_history__fee_sum, transfer_history__formatted_fee_sum, career_stats__total_appearances" \
-                  ", career_stats__total_goals, career_stats__total_assists, career_stats__total_minutes_per_goal, career_stats__total_minutes_played" \
-                  ", created_at, updated_at) " \
-                  "values('{0}', '{1}', {2}, '{3}', '{4}', '{5}', '{6}', '{7}', '{8}', '{9}', '{10}', '{11}', '{12}'" \
-                  ", '{13}', '{14}', '{15}', '{16}', '{17}', '{18}', '{19}', '{20}', '{21}', '{22}', '{23}', '{24}', '{25}'" \
-                  ", '{26}', '{27}', '{28}', '{29}', '{30}', '{31}', '{32}', '{33}', '{34}', now(), now()) " \
-                  "on conflict (href) do update " \
-                  "set code = excluded.code, " \
-                  "current_club_id = excluded.current_club_id, " \
-                  "name = excluded.name, " \
-                  "last_name = excluded.last_name, " \
-                  "number = excluded.number, " \
-                  "name_in_home_country = excluded.name_in_home_country, " \
-                  "date_of_birth = excluded.date_of_birth, " \
-                  "place_of_birth__country = excluded.place_of_birth__country, " \
-                  "place_of_birth__city = excluded.place_of_birth__city, " \
-                  "age = excluded.age, " \
-                  "height = excluded.height, " \
-                  "citizenship = excluded.citizenship, " \
-                  "position = excluded.position, " \
-                  "player_agent__href = excluded.player_agent__href, " \
-                  "player_agent__name = excluded.player_agent__name, " \
-                  "foot = excluded.foot, " \
-                  "joined = excluded.joined, " \
-                  "contract_expires = excluded.contract_expires, " \
-                  "day_of_last_contract_extension = excluded.day_of_last_contract_extension, " \
-                  "outfitter = excluded.outfitter, " \
-                  "current_market_value = excluded.current_market_value, " \
-                  "highest_market_value = excluded.highest_market_value, " \
-                  "highest_market_value_date = excluded.highest_market_value_date, " \
-                  "market_value_last_change = excluded.market_value_last_change, " \
-                  "market_value_details_url = excluded.market_value_details_url, " \
-                  "social_media = excluded.social_media, " \
-                  "transfer_history__fee_sum = excluded.transfer_history__fee_sum, " \
-                  "transfer_history__formatted_fee_sum = excluded.transfer_history__formatted_fee_sum, " \
-                  "career_stats__total_appearances = excluded.career_stats__total_appearances, " \
-                  "career_stats__total_goals = excluded.career_stats__total_goals, " \
-                  "career_stats__total_assists = excluded.career_stats__total_assists, " \
-                  "career_stats__total_minutes_per_goal = excluded.career_stats__total_minutes_per_goal, " \
-                  "career_stats__total_minutes_played = excluded.career_stats__total_minutes_played, " \
-                  "updated_at = now() returning id".format(
-                    quote(item_dic['href']),
-                    quote(item_dic['code']),
-                    current_club_id if current_club_id else 'NULL',
-                    quote(item_dic['name']),
-                    quote(item_dic['last_name']),
-                    quote(item_dic['number']),
-                    quote(item_dic['name_in_home_country']),
-                    quote(item_dic['date_of_birth']),
-                    quote(item_dic['place_of_birth']['country']),
-                    quote(item_dic['place_of_birth']['city']),
-                    quote(item_dic['age']),
-                    quote(item_dic['height']),
-                    quote(item_dic['citizenship']),
-                    quote(item_dic['position']),
-                    quote(item_dic['image_url']),
-                    quote(item_dic['player_agent']['href']),
-                    quote(item_dic['player_agent']['name']),
-                    quote(item_dic['foot']),
-                    quote(item_dic['joined']),
-                    quote(item_dic['contract_expires']),
-                    quote(item_dic['day_of_last_contract_extension']),
-                    quote(item_dic['outfitter']),
-                    quote(item_dic['market_value_history'].get('current')),
-                    quote(item_dic['market_value_history'].get('highest')),
-                    quote(item_dic['market_value_history'].get('highest_date')),
-                    quote(item_dic['market_value_history'].get('last_change')),
-                    quote(item_dic['market_value_history'].get('details_url')),
-                    quote(json.dumps(item_dic['social_media'])) if item_dic.get('social_media') else '',
-                    quote(item_dic['transfer_history'].get('feeSum')),
-                    quote(item_dic['transfer_history'].get('formattedFeeSum')),
-                    item_dic['career_stats']['total']['appearances'] if item_dic['career_stats'].get('total') and item_dic['career_stats']['total'].get('appearances') else '',
-                    item_dic['career_stats']['total']['goals'] if item_dic['career_stats'].get('total') and item_dic['career_stats']['total'].get('goals') else '',
-                    item_dic['career_stats']['total']['assists'] if item_dic['career_stats'].get('total') and item_dic['career_stats']['total'].get('assists') else '',
-                    item_dic['career_stats']['total']['minutes_per_goal'] if item_dic['career_stats'].get('total') and item_dic['career_stats']['total'].get('minutes_per_goal') else '',
-                    item_dic['career_stats']['total']['minutes_played'] if item_dic['career_stats'].get('total') and item_dic['career_stats']['total'].get('minutes_played') else '',
-                  )
-            self.pgcursor.execute(sql)
-            self.pgconn.commit()
-            player_id = self.pgcursor.fetchone()[0]
-
-            for entry in item_dic['market_value_history'].get('list', []):
-                sql = "insert into player_valuations (player_id, x, y, mw, datum_mw, verein, age, wappen, created_at, updated_at) " \
-                      "values({0}, '{1}', '{2}', '{3}', '{4}', '{5}', '{6}', '{7}', now(), now()) " \
-                      "on conflict (player_id, datum_mw) do update " \
-                      "set x = excluded.x, " \
-                      "y = excluded.y, " \
-                      "mw = excluded.mw, " \
-                      "verein = excluded.verein, " \
-                      "age = excluded.age, " \
-                      "wappen = excluded.wappen, " \
-                      "updated_at = now()".format(
-                        player_id,
-                        quote(entry.get('x')),
-                        quote(entry.get('y')),
-                        quote(entry.get('mw')),
-                        quote(entry.get('datum_mw')),
-                        quote(entry.get('verein')),
-                        quote(entry.get('age')),
-                        quote(entry.get('wappen')),
-                      )
-                self.pgcursor.execute(sql)
-
-            for entry in item_dic['transfer_history'].get('transfers', []):
-                sql = "insert into player_transfer_history (player_id, url, from_club_emblem_1x, from_club_emblem_2x, from_club_emblem_mobile" \
-                      ", from_club_name, from_country_flag, from_href, from_is_special, from_latitude, from_longitude" \
-                      ", to_club_emblem_1x, to_club_emblem_2x, to_club_emblem_mobile, to_club_name, to_country_flag, to_href, to_is_special, to_latitude, to_longitude" \
-                      ", future_transfer, date, date_unformatted, upcoming, season, market_value, fee, show_upcoming_header, show_reset_header, created_at, updated_at) " \
-                      "values({0}, '{1}', '{2}', '{3}', '{4}', '{5}', '{6}', '{7}', '{8}', '{9}', '{10}', '{11}', '{12}', '{13}', '{14}', '{15}', '{16}'" \
-                      ", '{17}', '{18}', '{19}', '{20}', '{21}', '{22}', '{23}', '{24}', '{25}', '{26}', '{27}', '{28}', now(), now()) " \
-                      "on conflict (player_id, url) do update " \
-                      "set from_club_emblem_1x = excluded.from_club_emblem_1x, " \
-                      "from_club_emblem_2x = excluded.from_club_emblem_2x, " \
-                      "from_club_emblem_mobile = excluded.from_club_emblem_mobile, " \
-                      "from_club_name = excluded.from_club_name, " \
-                      "from_country_flag = excluded.from_country_flag, " \
-                      "from_href = excluded.from_href, " \
-                      "from_is_special = excluded.from_is_special, " \
-                      "from_latitude = excluded.from_latitude, " \
-                      "from_longitude = excluded.from_longitude, " \
-                      "to_club_emblem_1x = excluded.to_club_emblem_1x, " \
-                      "to_club_emblem_2x = excluded.to_club_emblem_2x, " \
-                      "to_club_emblem_mobile = excluded.to_club_emblem_mobile, " \
-                      "to_club_name = excluded.to_club_name, " \
-                      "to_country_flag = excluded.to_country_flag, " \
-                      "to_href = excluded.to_href, " \
-                      "to_is_special = excluded.to_is_special, " \
-                      "to_latitude = excluded.to_latitude, " \
-                      "to_longitude = excluded.to_longitude, " \
-                      "future_transfer = excluded.future_transfer, " \
-                      "date = excluded.date, " \
-                      "date_unformatted = excluded.date_unformatted, " \
-                      "upcoming = excluded.upcoming, " \
-                      "season = excluded.season, " \
-                      "market_value = excluded.market_value, " \
-                      "fee = excluded.fee, " \
-                      "show_upcoming_header = excluded.show_upcoming_header, " \
-                      "show_reset_header = excluded.show_reset_header, " \
-                      "updated_at = now()".format(
-                        player_id,
-                        quote(entry.get('url')),
-                        quote(entry['from'].get('clubEmblem-1x')) if entry.get('from') else '',
-                        quote(entry['from'].get('clubEmblem-2x')) if entry.get('from') else '',
-                        quote(entry['from'].get('clubEmblemMobile')) if entry.get('from') else '',
-                        quote(entry['from'].get('clubName')) if entry.get('from') else '',
-                        quote(entry['from'].get('countryFlag')) if entry.get('from') else '',
-                        quote(entry['from'].get('href')) if entry.get('from') else '',
-                        quote(entry['from'].get('isSpecial')) if entry.get('from') else '',
-                        quote(entry['from'].get('latitude')) if entry.get('from') else '',
-                        quote(entry['from'].get('longitude')) if entry.get('from') else '',
-                        quote(entry['to'].get('clubEmblem-1x')) if entry.get('to') else '',
-                        quote(entry['to'].get('clubEmblem-2x')) if entry.get('to') else '',
-                        quote(entry['to'].get('clubEmblemMobile')) if entry.get('to') else '',
-                        quote(entry['to'].get('clubName')) if entry.get('to') else '',
-                        quote(entry['to'].get('countryFlag')) if entry.get('to') else '',
-                        quote(entry['to'].get('href')) if entry.get('to') else '',
-                        quote(entry['to'].get('isSpecial')) if entry.get('to') else '',
-                        quote(entry['to'].get('latitude')) if entry.get('to') else '',
-                        quote(entry['to'].get('longitude')) if entry.get('to') else '',
-                        quote(entry.get('futureTransfer')),
-                        quote(entry.get('date')),
-                        quote(entry.get('dateUnformatted')),
-                        quote(entry.get('upcoming')),
-                        quote(entry.get('season')),
-                        quote(entry.get('marketValue')),
-                        quote(entry.get('fee')),
-                        quote(entry.get('showUpcomingHeader')),
-                        quote(entry.get('showResetHeader')),
-                      )
-                self.pgcursor.execute(sql)
-
-            for entry in item_dic['career_stats'].get('list', []):
-                competition_id = None
-                if entry.get('competition') and entry['competition'].get('href'):
-                    self.pgcursor.execute("select id from competition where href='{0}'".format(entry['competition']['href']))
-                    result = self.pgcursor.fetchone()
-                    competition_id = result[0] if result else None
-
-                sql = "insert into player_career_stats (player_id, competition_id, competition_href, appearances_href, appearances_number" \
-                      ", goals, assists, minutes_per_goal, minutes_played, created_at, updated_at) " \
-                      "values({0}, {1}, '{2}', '{3}', '{4}', '{5}', '{6}', '{7}', '{8}', now(), now()) " \
-                      "on conflict (player_id, competition_href) do update " \
-                      "set competition_id = excluded.competition_id, " \
-                      "appearances_href = excluded.appearances_href, " \
-                      "appearances_number = excluded.appearances_number, " \
-                      "goals = excluded.goals, " \
-                      "assists = excluded.assists, " \
-                      "minutes_per_goal = excluded.minutes_per_goal, " \
-                      "minutes_played = excluded.minutes_played, " \
-                      "updated_at = now()".format(
-                        player_id,
-                        competition_id if competition_id else 'NULL',
-                        quote(entry['competition'].get('href')) if entry.get('competition') else '',
-                        quote(entry['appearances'].get('href')) if entry.get('appearances') else '',
-                        quote(entry['appearances'].get('number')) if entry.get('appearances') else '',
-                        quote(entry.get('goals')),
-                        quote(entry.get('assists')),
-                        quote(entry.get('minutes_per_goal')),
-                        quote(entry.get('minutes_played')),
-                      )
-                self.pgcursor.execute(sql)
-
-            for entry in item_dic.get('national_team_career', []):
-                club_id = None
-                if entry.get('nationtal_team') and entry['nationtal_team'].get('club_href'):
-                    self.pgcursor.execute(
-                        "select id from club where href='{0}'".format(entry['nationtal_team']['club_href']))
-                    result = self.pgcursor.fetchone()
-                    club_id = result[0] if result else None
-
-                sql = "insert into player_national_team_career (player_id, club_id, club_href, country_name, country_flag_url" \
-                      ", debut_date, debut_href, matches_number, matches_href, tore_number, tore_href, created_at, updated_at) " \
-                      "values({0}, {1}, '{2}', '{3}', '{4}', '{5}', '{6}', '{7}', '{8}', '{9}', '{10}', now(), now()) " \
-                      "on conflict (player_id, club_href) do update " \
-                      "set club_id = excluded.club_id, " \
-                      "country_name = excluded.country_name, " \
-                      "country_flag_url = excluded.country_flag_url, " \
-                      "debut_date = excluded.debut_date, " \
-                      "debut_href = excluded.debut_href, " \
-                      "matches_number = excluded.matches_number, " \
-                      "matches_href = excluded.matches_href, " \
-                      "tore_number = excluded.tore_number, " \
-                      "tore_href = excluded.tore_href, " \
-                      "updated_at = now()".format(
-                        player_id,
-                        club_id if club_id else 'NULL',
-                        quote(entry['nationtal_team'].get('club_href')) if entry.get('nationtal_team') else '',
-                        quote(entry['nationtal_team'].get('country_name')) if entry.get('nationtal_team') else '',
-                        quote(entry['nationtal_team'].get('country_flag_url')) if entry.get('nationtal_team') else '',
-                        quote(entry['debut'].get('date')) if entry.get('debut') else '',
-                        quote(entry['debut'].get('href')) if entry.get('debut') else '',
-                        quote(entry['matches'].get('number')) if entry.get('matches') else '',
-                        quote(entry['matches'].get('href')) if entry.get('matches') else '',
-                        quote(entry['tore'].get('number')) if entry.get('tore') else '',
-                        quote(entry['tore'].get('href')) if entry.get('tore') else '',
-                      )
-                self.pgcursor.execute(sql)
-            self.pgconn.commit()
+
+        rows = {table.name: {} for table in TABLES}
+        # the rows of the game of the item, which are replaced even when there are none
+        games = {}
+        if spider.name in SPIDER_GAME_TABLES:
+            games[SPIDER_GAME_TABLES[spider.name]] = {item_dic['game_id']: []}
+        for table, key, row in item_rows(spider.name, item_dic):
+            if table in GAME_TABLES:
+                games.setdefault(table, {}).setdefault(key[0], []).append(row)
+                continue
+            rows[table][key] = row
+
+        async with self.pool.acquire() as connection:
+            async with connection.transaction():
+                ids = {}
+                for table in TABLES:
+                    if not rows[table.name] or table.name in GAME_TABLES:
+                        continue
+                    values = []
+                    for row in rows[table.name].values():
+                        for id_column, parent, href_column in FOREIGN_KEYS.get(table.name, []):
+                            row[id_column] = await self.select_id(connection, parent, row[href_column])
+                        if table.name in PLAYER_TABLES:
+                            row['player_id'] = ids['player'][row['player_href']]
+                        row['content_hash'] = row_hash(table, row)
+                        values.append([row[column] for column in table.columns])
+
+                    written = await self.upsert(connection, table, values)
+                    if table.name in ID_TABLES:
+                        # href is the first column of the tables that are referenced by other rows, and the ids
+                        # of the unchanged rows, which the upsert does not return, are selected
+                        ids[table.name] = dict(written)
+                        missing = [row[0] for row in values if row[0] not in ids[table.name]]
+                        if missing:
+                            started = time.monotonic()
+                            ids[table.name].update(await connection.fetch(
+                                "select href, id from {0} where href = any($1::text[])".format(table.name), missing
+                            ))
+                            self.record('lookup', table.name, len(missing), started)
+
+                for table_name, table_games in games.items():
+                    await self.replace_games(connection, TABLES_BY_NAME[table_name], table_games)
+
+        for table in LOOKUP_TABLES:
+            for href, row_id in ids.get(table, {}).items():
+                self.lookup_cache.put(table, href, row_id)
+        return item
+
+    async def upsert(self, connection, table, values):
+        """Upsert the rows of a table, with as few statements as the placeholder limit allows.
+
+        :param table: The table definition
+        :type table: Table
+        :param values: The rows, as lists of column values
+        :type values: typing.List[list]
+        :return: The records returned for the rows written, which leave out the unchanged ones
+        :rtype: list
+        """
+        chunk_size = ASYNC_MAX_ARGUMENTS // len(table.columns)
+        written = []
+        for i in range(0, len(values), chunk_size):
+            chunk = values[i:i + chunk_size]
+            started = time.monotonic()
+            written.extend(await connection.fetch(
+                async_upsert_sql(table, len(chunk), self.skip_unchanged), *[value for row in chunk for value in row]
+            ))
+            self.record('upsert', table.name, len(chunk), started)
+        if len(written) < len(values):
+            self.stats.inc_value('database/skipped/{0}'.format(table.name), len(values) - len(written))
+        return written
+
+    def record(self, statement, table, rows, started):
+        record_statement(self.stats, self.slow_statement_secs, statement, table, rows, started)
+
+    async def replace_games(self, connection, table, games):
+        """Replace the stored rows of some games with new ones, deleting the old rows, as DatabasePipeline does.
+        All the rows of a game carry the hash of the whole game, and games whose stored hash did not change are
+        left untouched.
+
+        :param table: The table definition, of one of GAME_TABLES
+        :type table: Table
+        :param games: The rows of each game, by game id, which are empty for games that have no rows anymore
+        :type games: typing.Dict[int, typing.List[dict]]
+        """
+        for game_rows in games.values():
+            content_hash = game_hash(table, game_rows)
+            for row in game_rows:
+                row['content_hash'] = content_hash
+
+        if self.skip_unchanged:
+            started = time.monotonic()
+            stored = dict(await connection.fetch(
+                "select game_id, content_hash from {0} where game_id = any($1::int[])".format(table.name), list(games)
+            ))
+            self.record('hashes', table.name, len(games), started)
+            unchanged = [
+                game_id for game_id, game_rows in games.items()
+                if stored.get(game_id) == (game_rows[0]['content_hash'] if game_rows else None)
+            ]
+            for game_id in unchanged:
+                self.stats.inc_value('database/skipped/{0}'.format(table.name), len(games.pop(game_id)))
+            if not games:
+                return
+
+        started = time.monotonic()
+        status = await connection.execute(
+            "delete from {0} where game_id = any($1::int[])".format(table.name), list(games)
+        )
+        self.record('delete', table.name, int(status.split()[-1]), started)
+        values = [[row[column] for column in table.columns] for game_rows in games.values() for row in game_rows]
+        started = time.monotonic()
+        await connection.executemany(ASYNC_GAME_INSERTS[table.name], values)
+        self.record('copy', table.name, len(values), started)
+
+    async def select_id(self, connection, table, href):
+        if not href:
+            return None
+        row_id = self.lookup_cache.get(table, href)
+        if row_id is not None:
+            self.stats.inc_value('database/lookup_cache/hits')
+            return row_id
+
+        self.stats.inc_value('database/lookup_cache/misses')
+        started = time.monotonic()
+        row_id = await connection.fetchval("select id from {0} where href = $1".format(table), href)
+        self.record('lookup', table, 1, started)
+        if row_id is not None:
+            self.lookup_cache.put(table, href, row_id)
+        return row_id
+
+
+# parquet tables of each item type, with the child tables that its nested lists of dicts are split into
+PARQUET_TABLES = {
+    'confederation': ('confederations', {}),
+    'competition': ('competitions', {}),
+    'club': ('clubs', {}),
+    'game': ('games', {('events',): 'game_events'}),
+    'player': ('players', {
+        ('market_value_history', 'list'): 'player_valuations',
+        ('transfer_history', 'transfers'): 'player_transfers',
+        ('career_stats', 'list'): 'player_career_stats',
+        ('national_team_career',): 'player_national_team_career',
+    }),
+    'appearance': ('appearances', {}),
+}
+
+# parquet tables of the entities that are not scraped per season, which are written unpartitioned
+SEASONLESS_PARQUET_TABLES = {'confederations', 'competitions'}
+
+def flatten(dic, skip=(), path=()):
+    """Flatten nested dicts into a single row, naming their columns after their path, such as
+    "place_of_birth__country". Lists are kept as values, except for the ones whose path is in `skip`.
+    """
+    row = {}
+    for key, value in dic.items():
+        if path + (key,) in skip:
+            continue
+        if isinstance(value, dict):
+            row.update(flatten(value, skip, path + (key,)))
+        else:
+            row['__'.join(path + (key,))] = value
+    return row
+
+
+def parquet_rows(item_dic):
+    """Map a scraped item to the rows of the parquet tables that store it.
+
+    Nested dicts are flattened into columns, and the nested lists listed in PARQUET_TABLES are split into
+    child tables whose rows reference the item with "<item type>_href". The lineups of both clubs of a
+    "game_lineups" item become rows of the "game_lineups" table, one per player, with the season of the
+    game, which is told by the hrefs of its clubs.
+
+    :param item_dic: The item
+    :type item_dic: dict
+    :return: A generator of (table name, season, row) tuples
+    :rtype: typing.Iterator[tuple]
+    """
+    season = item_season(item_dic)
+    item_type = item_dic.get('type')
+    parent = item_dic.get('parent')
+    parent_href = parent.get('href') if isinstance(parent, dict) else parent
+
+    if item_type == 'game_lineups':
+        if season is None:
+            season = next(filter(None, (
+                url_season((item_dic.get(side + '_club') or {}).get('href') or '') for side in ('home', 'away')
+            )), None)
+        for side in ('home', 'away'):
+            club = item_dic.get(side + '_club') or {}
+            for lineup in ('starting_lineup', 'substitutes'):
+                for player in club.get(lineup) or []:
+                    yield 'game_lineups', season, {
+                        'game_id': item_dic.get('game_id'),
+                        'game_href': parent_href,
+                        'side': side,
+                        'club_href': club.get('href'),
+                        'formation': club.get('formation'),
+                        'starting': lineup == 'starting_lineup',
+                        **flatten(player),
+                    }
+        return
+
+    table, children = PARQUET_TABLES.get(item_type, (item_type, {}))
+    row = flatten({key: value for key, value in item_dic.items() if key != 'parent'}, skip=children)
+    row['parent_href'] = parent_href
+    yield table, season, row
+
+    for path, child_table in children.items():
+        entries = item_dic
+        for key in path:
+            entries = (entries or {}).get(key)
+        for entry in entries or []:
+            yield child_table, season, {
+                '{0}_href'.format(item_type): item_dic.get('href'),
+                **(flatten(entry) if isinstance(entry, dict) else {'value': entry}),
+            }
+
+
+def arrow_table(rows, schema=None):
+    """Build an arrow table out of rows with possibly different columns. Columns get a boolean, integer or
+    float type when all their values have it, and are strings otherwise, with lists encoded as JSON.
+
+    :param rows: The rows
+    :type rows: typing.List[dict]
+    :param schema: The schema of the file the table is written to, whose column order and types are kept
+        where the rows allow it
+    :type schema: pyarrow.Schema
+    :rtype: pyarrow.Table
+    """
+    import pyarrow as pa
+
+    columns = list(schema.names) if schema is not None else []
+    for row in rows:
+        columns.extend(column for column in row if column not in columns)
+
+    arrays = []
+    for column in columns:
+        values = [row.get(column) for row in rows]
+        kinds = {type(value) for value in values if value is not None}
+        if not kinds and schema is not None and column in schema.names:
+            arrays.append(pa.array(values, schema.field(column).type))
+        elif kinds == {bool}:
+            arrays.append(pa.array(values, pa.bool_()))
+        elif kinds and kinds <= {int}:
+            arrays.append(pa.array(values, pa.int64()))
+        elif kinds and kinds <= {int, float}:
+            arrays.append(pa.array(values, pa.float64()))
+        else:
+            arrays.append(pa.array([
+                value if value is None or isinstance(value, str) else
+                json.dumps(value) if isinstance(value, (list, dict)) else str(value)
+                for value in values
+            ], pa.string()))
+    return pa.Table.from_arrays(arrays, names=columns)
+
+
+class ParquetPipeline:
+    """Write items to a parquet dataset, with a table per entity: competitions, clubs, games, game_events,
+    game_lineups, players, player_valuations, player_transfers, player_career_stats,
+    player_national_team_career and appearances (see `parquet_rows`).
+
+    Tables are partitioned by the season they were scraped for, hive style, into
+    PARQUET_DIR/<table>/crawl_season=<season>/ (items with no known season go to the
+    "__HIVE_DEFAULT_PARTITION__" partition), except for the ones in SEASONLESS_PARQUET_TABLES, which are
+    written to PARQUET_DIR/<table>/, and every run writes its own files there. Rows are buffered per
+    partition and written in row groups of PARQUET_ROW_GROUP_SIZE rows. It needs the optional pyarrow package.
+
+    At most PARQUET_MAX_OPEN_FILES files are kept open: the least recently written one is closed when another
+    is needed, and its partition starts a new file the next time it is written. Once PARQUET_MAX_BUFFERED_ROWS
+    rows are buffered across all partitions, the partition with the most rows is written.
+    """
+
+    def __init__(self, stats, parquet_dir='parquet', row_group_size=100000, compression='zstd',
+                 max_open_files=64, max_buffered_rows=500000):
+        self.stats = stats
+        self.parquet_dir = parquet_dir
+        self.row_group_size = row_group_size
+        self.compression = compression
+        self.max_open_files = max_open_files
+        self.max_buffered_rows = max_buffered_rows
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(
+            stats=crawler.stats,
+            parquet_dir=crawler.settings.get("PARQUET_DIR", 'parquet'),
+            row_group_size=crawler.settings.getint("PARQUET_ROW_GROUP_SIZE", 100000),
+            compression=crawler.settings.get("PARQUET_COMPRESSION", 'zstd'),
+            max_open_files=crawler.settings.getint("PARQUET_MAX_OPEN_FILES", 64),
+            max_buffered_rows=crawler.settings.getint("PARQUET_MAX_BUFFERED_ROWS", 500000),
+        )
+
+    def open_spider(self, spider):
+        import pyarrow.parquet  # noqa: F401, fails at start rather than at the first row group
+
+        self.run = "{0}-{1}".format(spider.name, time.strftime('%Y%m%dT%H%M%S'))
+        # rows waiting to be written, and the open file, per (table, season) partition. files are kept in the
+        # order they were last written, least recent first
+        self.buffers = {}
+        self.buffered = 0
+        self.writers = OrderedDict()
+        self.files = 0
+
+    def close_spider(self, spider):
+        try:
+            for partition in list(self.buffers):
+                self.write(partition)
+        finally:
+            for writer in self.writers.values():
+                writer.close()
+
+    def process_item(self, item, spider):
+        for table, season, row in parquet_rows(ItemAdapter(item).asdict()):
+            rows = self.buffers.setdefault((table, season), [])
+            rows.append(row)
+            self.buffered += 1
+            if len(rows) >= self.row_group_size:
+                self.write((table, season))
+            elif self.buffered >= self.max_buffered_rows:
+                self.write(max(self.buffers, key=lambda partition: len(self.buffers[partition])))
         return item
+
+    def write(self, partition):
+        """Write the buffered rows of a partition as a row group of its file. When the rows do not fit the
+        schema of the file, for example because of a new column, the file is closed and a new one is started.
+        """
+        import pyarrow.parquet as pq
+
+        table, season = partition
+        rows = self.buffers.pop(partition)
+        self.buffered -= len(rows)
+        writer = self.writers.get(partition)
+        data = arrow_table(rows, writer.schema if writer else None)
+        if writer is not None and not writer.schema.equals(data.schema):
+            del self.writers[partition]
+            writer.close()
+            writer = None
+
+        if writer is None:
+            if len(self.writers) >= self.max_open_files:
+                _, evicted = self.writers.popitem(last=False)
+                evicted.close()
+                self.stats.inc_value('parquet/evicted_files')
+            path = os.path.join(self.parquet_dir, table)
+            if table not in SEASONLESS_PARQUET_TABLES:
+                path = os.path.join(
+                    path, "crawl_season={0}".format('__HIVE_DEFAULT_PARTITION__' if season is None else season)
+                )
+            os.makedirs(path, exist_ok=True)
+            self.files += 1
+            writer = pq.ParquetWriter(
+                os.path.join(path, "{0}-{1:05d}.parquet".format(self.run, self.files)),
+                data.schema,
+                compression=self.compression
+            )
+            self.writers[partition] = writer
+            self.stats.inc_value('parquet/files')
+        self.writers.move_to_end(partition)
+
+        writer.write_table(data, row_group_size=self.row_group_size)
+        self.stats.inc_value('parquet/rows/{0}'.format(table), len(rows))
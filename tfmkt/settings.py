@@ -3,6 +3,7 @@ BOT_NAME = 'tfmkt'
 
 SPIDER_MODULES = ['tfmkt.spiders']
 NEWSPIDER_MODULE = 'tfmkt.spiders'
+COMMANDS_MODULE = 'tfmkt.commands'
 
 # Obey robots.txt rules
 ROBOTSTXT_OBEY = True
@@ -16,7 +17,9 @@ EXTENSIONS = {
    'scrapy.extensions.closespider.CloseSpider': 500
 }
 DOWNLOADER_MIDDLEWARES = {
-   'scrapy.downloadermiddlewares.httpcache.HttpCacheMiddleware': 500
+   # stores the cached responses that HTTPCACHE_POLICY revalidated again, see tfmkt.httpcache.RevalidatingCacheMiddleware
+   'scrapy.downloadermiddlewares.httpcache.HttpCacheMiddleware': None,
+   'tfmkt.httpcache.RevalidatingCacheMiddleware': 500,
 }
 
 CLOSESPIDER_PAGECOUNT = 0
@@ -27,6 +30,38 @@ LOG_LEVEL = 'ERROR'
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html#httpcache-middleware-settings
 HTTPCACHE_ENABLED = True
 HTTPCACHE_DIR = 'httpcache'
+# cached responses are served as they are for a while, then revalidated with their ETag / Last-Modified, so that
+# unchanged pages are answered with a 304 (and served from the cache). How long depends on the url (see
+# tfmkt.httpcache.UrlRulesPolicy): past seasons and played games never expire, the current season expires after
+# HTTPCACHE_CURRENT_SEASON_REVALIDATE_SECS and any other page after HTTPCACHE_REVALIDATE_SECS (0 for never).
+# HTTPCACHE_REVALIDATE_RULES maps url regular expressions to seconds (0 for never) and is checked first, e.g.
+# {r'/ceapi/marketValueDevelopment/': 30 * 24 * 3600}
+HTTPCACHE_POLICY = 'tfmkt.httpcache.UrlRulesPolicy'
+HTTPCACHE_REVALIDATE_SECS = 7 * 24 * 3600
+HTTPCACHE_CURRENT_SEASON_REVALIDATE_SECS = 24 * 3600
+HTTPCACHE_REVALIDATE_RULES = {}
+# "tfmkt.httpcache.SqliteCacheStorage" keeps the cache of each spider in a single file, HTTPCACHE_DIR/<spider>.sqlite3.
+# "tfmkt.httpcache.SharedCacheStorage" keeps one file per response under HTTPCACHE_DIR/objects/, named after the
+# request fingerprint, and can be shared by all scraper nodes by pointing HTTPCACHE_DIR to a shared directory (NFS)
+# HTTPCACHE_STORAGE = 'tfmkt.httpcache.SqliteCacheStorage'
+# both compress bodies with HTTPCACHE_COMPRESSION: 'zstd' (it needs the zstandard package) or None
+HTTPCACHE_COMPRESSION = 'zstd'
+HTTPCACHE_COMPRESSION_LEVEL = 3
+
+# replay mode (scrapy crawl ... -s HTTPCACHE_REPLAY=True), e.g. to re-extract items after changing a parser: every
+# request is served from the HTTP cache and never downloaded, without robots.txt, delays or per domain limits, and
+# with HTTPCACHE_REPLAY_CONCURRENT_REQUESTS requests at a time, unless the spider or the command line set
+# CONCURRENT_REQUESTS. cached responses need no network wait, and are all parsed in one thread, so a hundred
+# requests in flight keep the crawl busy whatever the number of CPUs. Urls missing from the cache are appended to
+# HTTPCACHE_REPLAY_MISSES
+HTTPCACHE_REPLAY = False
+HTTPCACHE_REPLAY_CONCURRENT_REQUESTS = 100
+HTTPCACHE_REPLAY_MISSES = 'httpcache-misses.txt'
+
+# clubs and players already fetched are remembered in DEDUPE_DIR/<spider>.sqlite3 (if set), and skipped by the
+# next runs for DEDUPE_FRESHNESS_SECS (0 for ever)
+DEDUPE_DIR = None
+DEDUPE_FRESHNESS_SECS = 7 * 24 * 3600
 
 # https://docs.scrapy.org/en/latest/topics/request-response.html?highlight=REQUEST_FINGERPRINTER_IMPLEMENTATION#std-setting-REQUEST_FINGERPRINTER_IMPLEMENTATION
 REQUEST_FINGERPRINTER_IMPLEMENTATION = '2.7'
@@ -38,8 +73,62 @@ ITEM_PIPELINES = {
     "tfmkt.pipelines.DatabasePipeline": 100,
 }
 
+# "tfmkt.pipelines.AsyncDatabasePipeline" writes to the same tables without blocking the crawl. It needs the
+# asyncpg package (poetry install -E async) and the asyncio reactor, which is not the default one, so crawls that
+# enable it must also set TWISTED_REACTOR = 'twisted.internet.asyncioreactor.AsyncioSelectorReactor'. It keeps at
+# most DATABASE_ASYNC_CONCURRENCY connections busy, and does not support the sqlite backend, DATABASE_STAGING,
+# DATABASE_DEFER_FOREIGN_KEYS or DATABASE_PARTITIONING
+DATABASE_ASYNC_CONCURRENCY = 10
+
+# "tfmkt.pipelines.ParquetPipeline" writes items to a parquet dataset under PARQUET_DIR, with a table per entity
+# partitioned by season (<table>/crawl_season=<season>/). It needs the pyarrow package (poetry install -E parquet)
+PARQUET_DIR = 'parquet'
+PARQUET_ROW_GROUP_SIZE = 100000
+PARQUET_COMPRESSION = 'zstd'
+# files open at a time (a partition whose file was closed starts a new one), and rows buffered across partitions
+PARQUET_MAX_OPEN_FILES = 64
+PARQUET_MAX_BUFFERED_ROWS = 500000
+
+# the database written by DatabasePipeline and SpoolingDatabasePipeline: 'postgres', at DATABASE_HOST, or
+# 'sqlite', an embedded database file at DATABASE_SQLITE_PATH (in WAL mode) that needs no server, e.g. for
+# small crawls, CI and benchmarks (scrapy crawl ... -s DATABASE_BACKEND=sqlite)
+DATABASE_BACKEND = 'postgres'
+DATABASE_SQLITE_PATH = 'tfmkt.sqlite3'
+
 DATABASE_HOST = '192.168.10.90'
 DATABASE_PORT = '5432'
 DATABASE_USER = 'postgres'
 DATABASE_PASSWORD = 'Abcd@1234'
 DATABASE_DB = 'postgres'
+
+# DatabasePipeline buffers rows and writes them with one multi-row upsert per table, flushing
+# once DATABASE_BATCH_SIZE rows are buffered or DATABASE_FLUSH_INTERVAL seconds have passed since the last flush
+DATABASE_BATCH_SIZE = 500
+DATABASE_FLUSH_INTERVAL = 5.0
+# maximum number of competition/club href to id mappings kept in memory by DatabasePipeline
+DATABASE_LOOKUP_CACHE_SIZE = 100000
+# every row stores a hash of its content in "content_hash". rows whose hash did not change are not rewritten,
+# which keeps re-crawls from creating dead tuples (their updated_at then marks the last actual change)
+DATABASE_SKIP_UNCHANGED = True
+# for full backfills: copy rows into UNLOGGED "<table>_staging" tables during the crawl, and merge them
+# into their tables with one statement per table when the spider closes (postgres only)
+DATABASE_STAGING = False
+# store only the hrefs of referenced competitions and clubs while crawling, and fill the id columns with one
+# UPDATE ... FROM join per column when the spider closes (or later with "scrapy resolve_foreign_keys")
+DATABASE_DEFER_FOREIGN_KEYS = False
+# create "game" and "player_valuations" range partitioned by season (the season crawled for games, the one of the
+# valuation date for valuations), with a partition per season that is added when its first row is written, and
+# a default partition for the rows whose season is unknown. a game or valuation is still stored once: a row that
+# gets another season is moved to its partition. it only applies to tables that do not exist yet and is not
+# supported by AsyncDatabasePipeline
+DATABASE_PARTITIONING = False
+# the pipelines record the count, rows, time and a latency histogram of their statements per table in the
+# crawl stats ("database/<statement>/<table>/..."), and log a warning for statements slower than this
+DATABASE_SLOW_STATEMENT_SECS = 1.0
+# "tfmkt.pipelines.SpoolingDatabasePipeline" appends items to JSON lines segments under DATABASE_SPOOL_DIR
+# and loads them into the database from a background thread, resuming after a crash from the last committed
+# position. the engine is paused while more than DATABASE_SPOOL_HIGH_WATER_MARK bytes are waiting to be loaded
+DATABASE_SPOOL_DIR = 'spool'
+DATABASE_SPOOL_SEGMENT_SIZE = 64 * 1024 * 1024
+DATABASE_SPOOL_HIGH_WATER_MARK = 256 * 1024 * 1024
+DATABASE_SPOOL_RETRY_DELAY = 5.0
@@ -110,6 +110,8 @@ class AppearancesSpider(BaseSpider):
         yield {
           'type': 'appearance',
           'href': url,
+          # the stats page of the season, as the href leaves its "saison" query out
+          'seasoned_href': response.url,
           'parent': parent,
           'competition_code': competition_name,
           **appearance
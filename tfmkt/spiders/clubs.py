@@ -9,8 +9,6 @@ from scrapy.shell import inspect_response # required for debugging
 class ClubsSpider(BaseSpider):
   name = 'clubs'
 
-  clubs = []
-
   def parse(self, response, parent):
     """Parse competition page. From this page we collect all competition's
     teams urls
@@ -44,8 +42,8 @@ class ClubsSpider(BaseSpider):
           href = extract_team_href(row)
           href_strip_season = re.sub('/saison_id/[0-9]{4}$', '', href)
 
-          if href_strip_season not in self.clubs:
-            self.clubs.append(href_strip_season)
+          if href_strip_season not in self.seen:
+            self.seen.add(href_strip_season)
 
             cb_kwargs = {
               'base' : {
@@ -132,6 +130,8 @@ class ClubsSpider(BaseSpider):
       else:
         attributes[key] = value
 
+    self.seen.fetched(base['href'])
+
     yield {
       **base,
       **attributes
@@ -1,76 +1,390 @@
 import copy
+import hashlib
+import itertools
 import logging
+import queue
+import threading
 from io import BufferedReader
 import scrapy
-from scrapy import Request
+from scrapy import Request, signals
+from scrapy.exceptions import DontCloseSpider
+from scrapy.utils.misc import arg_to_iter
 from scrapy.shell import inspect_response # required for debugging
 
 import os, sys
 import json
+import sqlite3
+import time
+import glob
 import gzip
 import typing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from twisted.internet.task import LoopingCall
+
+from tfmkt.httpcache import apply_replay_settings
+from tfmkt.pipelines import backend_from_settings
+from tfmkt.utils import current_season
 
 default_base_url = 'https://www.transfermarkt.co.uk'
+
+# named queries for "-a parents_query=<name>", selecting parents from the tables written by DatabasePipeline
+PARENTS_QUERIES = {
+  'competitions': "select 'competition' as type, href, country_id, country_name, country_code, competition_type from competition order by id",
+  'clubs': "select 'club' as type, href from club order by id",
+  'players': "select 'player' as type, href from player order by id",
+}
+# parent types whose pages are per season, see BaseSpider.seasonize_entrypoin_href
+SEASONAL_TYPES = ['club', 'competition']
+
 # logging.basicConfig(
 #     filename="log.txt", format="%(levelname)s: %(message)s", level=logging.INFO
 # )
 
-def read_lines(file_name: str, reading_fn: typing.Callable[[str], BufferedReader]) -> typing.List[dict]:
-  """A function that reads JSON lines from a file.
+def read_lines(file_name: str, reading_fn: typing.Callable[[str], BufferedReader]) -> typing.Iterator[dict]:
+  """A function that reads JSON lines from a file, one line at a time. The file is only opened once
+  the first line is asked for.
 
   :param file_name: The name of the file to read from.
   :type file_name: str
   :param reading_fn: A function object to be used for opening the file.
   :type reading_fn: typing.Callable[[str], BufferedReader]
-  :return: A list of json objects (dict)
-  :rtype: typing.List[dict]
+  :return: A generator of json objects (dict)
+  :rtype: typing.Iterator[dict]
   """
   with reading_fn(file_name) as f:
-    lines = f.readlines()
-    parents = [ json.loads(line) for line in lines ]
-  
-  return parents
+    for line in f:
+      if line.strip():
+        yield json.loads(line)
+
+def read_stream(stream: typing.TextIO) -> typing.Iterator[dict]:
+  """Read JSON lines from a stream such as stdin, one line at a time, as they are written to it.
+  """
+  for line in stream:
+    if line.strip():
+      yield json.loads(line)
+
+def zstd_open(file_name: str) -> BufferedReader:
+  """Open a zstd compressed file for reading. zstandard is only needed if .zst parents are used.
+  """
+  import zstandard
+  return zstandard.open(file_name, 'rt', encoding='utf-8')
+
+def open_fn(file_name: str) -> typing.Callable[[str], BufferedReader]:
+  """Choose the function to open a parents file with from its extension (.gz, .zst or none).
+  """
+  extension = file_name.split(".")[-1]
+  if extension == "gz":
+    return gzip.open
+  elif extension == "zst":
+    return zstd_open
+  else: # if no (known) extension, assume the file is not compressed
+    return open
+
+def parents_files(parents: str) -> typing.List[str]:
+  """Expand a "parents" argument, which can be a file, a directory or a glob pattern, to the sorted list of files
+  it refers to. Directories are expanded to the (non hidden) files directly in them.
+
+  :param parents: The "parents" argument
+  :type parents: str
+  :return: A list of file names
+  :rtype: typing.List[str]
+  """
+  if glob.has_magic(parents):
+    paths = sorted(glob.glob(parents))
+  else:
+    paths = [parents]
+
+  files = []
+  for path in paths:
+    if os.path.isdir(path):
+      files.extend(sorted(
+        os.path.join(path, name) for name in os.listdir(path)
+        if not name.startswith('.') and os.path.isfile(os.path.join(path, name))
+      ))
+    else:
+      files.append(path)
+
+  if not files:
+    raise Exception(f"No parents files found for '{parents}'")
+  return files
+
+# the end of the lines of a file, see read_into
+READ_END = object()
+
+def read_into(file_name: str, lines: queue.Queue, stopped: threading.Event):
+  """Read the JSON lines of a file into a bounded queue, from a worker thread, and end them with READ_END (or with the
+  error that stopped the reading). It gives up if `stopped` is set while it waits for room in the queue.
+  """
+  def put(item):
+    while not stopped.is_set():
+      try:
+        lines.put(item, timeout=0.1)
+        return True
+      except queue.Full:
+        pass
+    return False
+
+  try:
+    for line in read_lines(file_name, open_fn(file_name)):
+      if not put(line):
+        return
+  except Exception as e:
+    put(e)
+  else:
+    put(READ_END)
+
+def read_files(file_names: typing.List[str], workers: int, window: int = 1000) -> typing.Iterator[dict]:
+  """Read JSON lines from several (compressed) files, decompressing up to `workers` files concurrently in
+  worker threads. Each worker streams the lines of its file through a queue of `window` lines, which are yielded in
+  the order of the files, so that at most `workers` windows of lines are held in memory at a time.
+
+  :param file_names: The names of the files to read from, in order.
+  :type file_names: typing.List[str]
+  :param workers: The number of files to read concurrently.
+  :type workers: int
+  :param window: The number of lines read ahead per file at most.
+  :type window: int
+  :return: A generator of json objects (dict)
+  :rtype: typing.Iterator[dict]
+  """
+  if workers <= 1 or len(file_names) == 1:
+    for file_name in file_names:
+      yield from read_lines(file_name, open_fn(file_name))
+    return
+
+  pending = iter(file_names)
+  stopped = threading.Event()
+  with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='parents') as executor:
+    def submit(file_name):
+      lines = queue.Queue(window)
+      executor.submit(read_into, file_name, lines, stopped)
+      return lines
+
+    try:
+      files = deque(submit(file_name) for file_name in itertools.islice(pending, workers))
+      while files:
+        lines = files.popleft()
+        # keep the window full while the lines of this file are consumed
+        file_name = next(pending, None)
+        if file_name is not None:
+          files.append(submit(file_name))
+        for line in iter(lines.get, READ_END):
+          if isinstance(line, Exception):
+            raise line
+          yield line
+    finally:
+      # workers of files that will not be consumed stop waiting for room
+      stopped.set()
+
+class ParentsReader:
+  """Read parents in a thread into a bounded queue, so that the reactor never waits for a slow upstream stage, a
+  file to be decompressed or a database cursor: `take` only returns the parents that were already read. The thread
+  waits once `size` parents are queued, so that memory stays flat however many parents there are.
+
+  :param parents: The parents to read
+  :type parents: typing.Iterator[dict]
+  :param size: The number of parents queued at most
+  :type size: int
+  """
+
+  # put at the end of the queue, after the error that stopped the reading if any
+  END = object()
+
+  def __init__(self, parents, size=1000):
+    self.queue = queue.Queue(size)
+    self.stopped = threading.Event()
+    self.error = None
+    self.finished = False
+    self.thread = threading.Thread(target=self.read, args=(parents,), name='parents', daemon=True)
+    self.thread.start()
+
+  def read(self, parents):
+    try:
+      for parent in parents:
+        if not self.put(parent):
+          return
+    except Exception as e:
+      self.error = e
+    self.put(self.END)
+
+  def put(self, item):
+    while not self.stopped.is_set():
+      try:
+        self.queue.put(item, timeout=0.1)
+        return True
+      except queue.Full:
+        pass
+    return False
+
+  def take(self, limit):
+    """The parents read so far, up to `limit`, without waiting for more. Once all parents were taken, `finished`
+    is set.
+
+    :raises Exception: The error that stopped the reading, once the parents read before it were taken
+    """
+    parents = []
+    while len(parents) < limit and not self.finished:
+      try:
+        parent = self.queue.get_nowait()
+      except queue.Empty:
+        break
+      if parent is self.END:
+        self.finished = True
+        if self.error is not None:
+          raise self.error
+      else:
+        parents.append(parent)
+    return parents
+
+  def close(self):
+    self.stopped.set()
+
+class DedupeStore:
+  """The hrefs a spider has already followed, with constant time membership. If given a path, the hrefs that were
+  fetched (see `fetched`) are also kept in a SQLite file, and those fetched less than `freshness_secs` ago (0 for
+  ever) are skipped by the following runs too.
+
+  :param path: The file to persist fetched hrefs to, if any
+  :type path: str
+  :param freshness_secs: For how long persisted hrefs are skipped
+  :type freshness_secs: float
+  """
+
+  # fetched hrefs are committed to the file every so many
+  COMMIT_EVERY = 1000
+
+  def __init__(self, path=None, freshness_secs=0):
+    self.keys = set()
+    self.connection = None
+    self.pending = 0
+    if path is not None:
+      self.connection = sqlite3.connect(path)
+      self.connection.execute('PRAGMA journal_mode=wal')
+      self.connection.execute('create table if not exists fetched (key text primary key, fetched_at real not null)')
+      since = time.time() - freshness_secs if freshness_secs else 0
+      self.keys.update(key for key, in self.connection.execute('select key from fetched where fetched_at >= ?', (since,)))
+
+  def __contains__(self, key):
+    return key in self.keys
+
+  def __len__(self):
+    return len(self.keys)
+
+  def add(self, key):
+    """Remember that a href was followed in this run.
+    """
+    self.keys.add(key)
+
+  def fetched(self, key):
+    """Remember that a href was fetched, also for the next runs if the store is persisted.
+    """
+    self.keys.add(key)
+    if self.connection is not None:
+      self.connection.execute('insert or replace into fetched (key, fetched_at) values (?, ?)', (key, time.time()))
+      self.pending += 1
+      if self.pending >= self.COMMIT_EVERY:
+        self.connection.commit()
+        self.pending = 0
+
+  def close(self):
+    if self.connection is not None:
+      self.connection.commit()
+      self.connection.close()
+      self.connection = None
+
+def parse_shard(shard: str) -> typing.Tuple[int, int]:
+  """Parse a "shard" argument like "0/4" (the first of 4 shards) into a (shard, shards) tuple.
+  """
+  try:
+    index, count = (int(s) for s in shard.split('/'))
+  except ValueError:
+    raise Exception(f"Invalid shard '{shard}', expected '<shard>/<shards>', for example '0/4'")
+  if count < 1 or not 0 <= index < count:
+    raise Exception(f"Invalid shard '{shard}', expected 0 <= shard < shards")
+  return index, count
 
 class BaseSpider(scrapy.Spider):
-  def __init__(self, base_url=None, parents=None, seasons=None):
+  def __init__(self, base_url=None, parents=None, seasons=None, parents_sql=None, parents_query=None, parents_workers=4,
+               shard=None):
 
     if base_url is not None:
       self.base_url = base_url
     else:
       self.base_url = default_base_url
 
-    # identify parents file extension (if any)
-    if parents is not None:
-      extension = parents.split(".")[-1]
-      if extension:
-        self.gzip_compressed = extension == "gz"
-      else: # if no extension, assume the file is not compressed
-        self.gzip_compressed = False
+    # without "-a seasons", the seasons of each entity are discovered from its latest season page (see
+    # discover_seasons), and this range only bounds the discovery
+    if seasons:
+      self.seasons = [int(s.strip()) for s in seasons.split(',') if s.strip()]
+      self.season_discovery = False
     else:
-      self.gzip_compressed = False
-    
-    # load parent objects, either from stdin, a file or a zipped file
+      self.seasons = [s for s in range(current_season(), 1869, -1)]
+      self.season_discovery = True
+
+    # with "-a shard=i/n" only the i-th of n slices of the (parent, season) entrypoints is crawled
+    self.shard = parse_shard(shard) if shard is not None else None
+
+    # hrefs already followed, to not request the same player or club again, see from_crawler for persistence
+    self.seen = DedupeStore()
+
+    # the thread reading the parents and the call scheduling their requests, see start_requests
+    self.reader = None
+    self.feeder = None
+
+    # parents can also be read from the database, which is only connected to once the crawl starts
+    if parents_query is not None:
+      if parents_query not in PARENTS_QUERIES:
+        raise Exception(f"Unknown parents_query '{parents_query}', expected one of: {', '.join(PARENTS_QUERIES)}")
+      parents_sql = PARENTS_QUERIES[parents_query]
+    self.parents_sql = parents_sql
+    if parents_sql is not None:
+      self.entrypoints = None
+      return
+
+    # parent objects are read lazily, either from stdin or from one or many (.gz or .zst compressed) files, so
+    # that requests for the first parents are sent while the rest are still being read (or written by the previous
+    # crawler in a pipe)
     if parents is not None:
-      if self.gzip_compressed:
-        parents = read_lines(parents, gzip.open)
-      else:
-        parents = read_lines(parents, open)
+      parents = read_files(parents_files(parents), int(parents_workers))
     elif not sys.stdin.isatty():
-        parents = [ json.loads(line) for line in sys.stdin ]
+      parents = read_stream(sys.stdin)
     else:
       parents = self.scrape_parents()
 
-    # 2nd level parents are redundat
-    for parent in parents:
-      if parent.get('parent') is not None:
-        del parent['parent']
+    self.entrypoints = parents
 
-    if seasons:
-      self.seasons = [int(s.strip()) for s in seasons.split(',') if s.strip()]
-    else:
-      self.seasons = [s for s in range(2024, 1869, -1)]
+  @classmethod
+  def from_crawler(cls, crawler, *args, **kwargs):
+    spider = super().from_crawler(crawler, *args, **kwargs)
+    # shards keep their own dedupe (and scheduler) state, even if they are given the same JOBDIR. the
+    # subdirectory is set with the priority JOBDIR was given, so a JOBDIR given in the command line is sharded too
+    jobdir = crawler.settings.get('JOBDIR')
+    if spider.shard is not None and jobdir:
+      index, count = spider.shard
+      crawler.settings.set(
+        'JOBDIR', os.path.join(jobdir, f"shard-{index}-of-{count}"), priority=crawler.settings.getpriority('JOBDIR')
+      )
+    if crawler.settings.getbool('HTTPCACHE_REPLAY'):
+      apply_replay_settings(crawler.settings)
 
-    self.entrypoints = parents
+    # each spider (and shard) persists the hrefs it fetched to its own file
+    dedupe_dir = crawler.settings.get('DEDUPE_DIR')
+    if dedupe_dir:
+      os.makedirs(dedupe_dir, exist_ok=True)
+      name = spider.name if spider.shard is None else f"{spider.name}-shard-{spider.shard[0]}-of-{spider.shard[1]}"
+      spider.seen = DedupeStore(
+        os.path.join(dedupe_dir, f"{name}.sqlite3"),
+        crawler.settings.getfloat('DEDUPE_FRESHNESS_SECS')
+      )
+    return spider
+
+  def closed(self, reason):
+    if self.feeder is not None and self.feeder.running:
+      self.feeder.stop()
+    if self.reader is not None:
+      self.reader.close()
+    self.seen.close()
 
   def scrape_parents(self):
     if not os.environ.get('SCRAPY_CHECK'):
@@ -78,25 +392,162 @@ class BaseSpider(scrapy.Spider):
     else:
       return []
 
+  def query_parents(self, sql):
+    """Stream parents from the database configured for DatabasePipeline, fetching them in batches
+    through a server-side cursor.
+
+    :param sql: A query selecting the parents, with at least their "type" and "href"
+    :type sql: str
+    :return: A generator of parents (dict)
+    :rtype: typing.Iterator[dict]
+    """
+    backend = backend_from_settings(self.settings)
+    backend.connect()
+    try:
+      yield from backend.stream(sql)
+    finally:
+      backend.close()
+
+  # parents read ahead of their requests at most, and how often (in seconds) the read parents are scheduled
+  PARENTS_QUEUE_SIZE = 1000
+  FEED_INTERVAL = 0.1
+
   def start_requests(self):
+    """Start reading the parents in a thread (see ParentsReader), whose requests are scheduled as they are read by
+    feed_requests, so that a crawl starts before its parents are all read and the reactor never waits for them.
+    """
+    entrypoints = self.entrypoints if self.parents_sql is None else self.query_parents(self.parents_sql)
+    self.reader = ParentsReader(entrypoints, self.PARENTS_QUEUE_SIZE)
+    self.crawler.signals.connect(self.keep_feeding, signal=signals.spider_idle)
+    self.feeder = LoopingCall(self.feed_requests)
+    self.feeder.start(self.FEED_INTERVAL, now=False)
+    return []
 
-    applicable_items = []
+  def feed_requests(self):
+    """Schedule the requests of the parents read so far. Parents are only taken while the engine has room for more
+    requests and its scheduler has none left, so that they wait in the reader (and upstream) rather than as requests.
+    """
+    engine = self.crawler.engine
+    # both are only public from Scrapy 2.19 on
+    needs_backout = getattr(engine, 'needs_backout', None) or engine._needs_backout
+    scheduler = getattr(engine, 'scheduler', None) or engine.slot.scheduler
+    if needs_backout() or scheduler.has_pending_requests():
+      return
 
-    for item in self.entrypoints:
-      for season in self.seasons:
-        season_item = copy.deepcopy(item)
-        season_item['seasoned_href'] = self.seasonize_entrypoin_href(season_item, season)
-        applicable_items.append(season_item)
+    try:
+      parents = self.reader.take(self.settings.getint('CONCURRENT_REQUESTS'))
+    except Exception:
+      self.logger.exception("Failed to read the parents")
+      parents = []
+    for parent in parents:
+      try:
+        requests = list(self.parent_requests(parent))
+      except Exception:
+        self.logger.exception("Failed to request parent %s", parent)
+        continue
+      for request in requests:
+        engine.crawl(request)
+    if self.reader.finished:
+      self.feeder.stop()
 
-    return [
-      Request(
-        item['seasoned_href'],
-        cb_kwargs={
-          'parent': item
-        }
-      )
-      for item in applicable_items
-    ]
+  def keep_feeding(self, spider):
+    # the spider is idle while it waits for more parents
+    if spider is self and self.feeder.running:
+      raise DontCloseSpider
+
+  def parent_requests(self, item):
+    """The requests for the pages of a parent, in all its seasons.
+    """
+    # 2nd level parents are redundat
+    if item.get('parent') is not None:
+      del item['parent']
+
+    if self.season_discovery and item['type'] in SEASONAL_TYPES:
+      # only the latest season is requested here, the rest are scheduled once it is known which ones exist. all
+      # the seasons of a parent are crawled by the shard that discovers them
+      latest = self.seasons[0]
+      if self.shard is not None and not self.in_shard(item, latest):
+        return
+      yield self.season_request(item, latest, self.discover_seasons, {'season': latest})
+      return
+
+    for season in self.seasons:
+      if self.shard is not None and not self.in_shard(item, season):
+        continue
+      yield self.season_request(item, season)
+
+  def season_request(self, item, season, callback=None, cb_kwargs=None):
+    """A request for the page of a parent in a given season, with a copy of the parent (and its seasoned href)
+    passed on to the callback.
+    """
+    season_item = copy.deepcopy(item)
+    season_item['seasoned_href'] = self.seasonize_entrypoin_href(season_item, season)
+    return Request(
+      season_item['seasoned_href'],
+      callback=callback,
+      cb_kwargs={
+        'parent': season_item,
+        **(cb_kwargs or {})
+      }
+    )
+
+  def season_options(self, response):
+    """The seasons listed in the season selector of a page, latest first.
+    """
+    values = response.css('select[name="saison_id"] option::attr(value)').getall()
+    return sorted({ int(value) for value in values if value.strip().isdigit() }, reverse=True)
+
+  def season_is_empty(self, response):
+    """Whether a season page has nothing to crawl, which is used to stop probing for older seasons when a page
+    has no season selector.
+    """
+    return not response.css('table.items tbody tr')
+
+  def discover_seasons(self, response, parent, season):
+    """Schedule the seasons that exist for a parent, read from the season selector of its latest season page.
+    The page itself is parsed as that season's page rather than requested again. Pages without a selector are
+    probed one season back at a time instead, see probe_season.
+    """
+    item = { key: value for key, value in parent.items() if key != 'seasoned_href' }
+    seasons = [ s for s in self.season_options(response) if s <= self.seasons[0] ]
+    if not seasons:
+      yield from self.probe_season(response, parent, season)
+      return
+
+    self.logger.debug("Discovered %d seasons for %s", len(seasons), item['href'])
+    for discovered in seasons:
+      if discovered == season:
+        yield from arg_to_iter(self.parse(response, parent=parent))
+      else:
+        yield self.season_request(item, discovered)
+
+  def probe_season(self, response, parent, season):
+    """Parse a season page and request the previous season, until the first empty season is found.
+    """
+    if self.season_is_empty(response):
+      return
+
+    item = { key: value for key, value in parent.items() if key != 'seasoned_href' }
+    yield from arg_to_iter(self.parse(response, parent=parent))
+
+    previous = season - 1
+    if previous >= self.seasons[-1]:
+      yield self.season_request(item, previous, self.probe_season, {'season': previous})
+
+  def in_shard(self, item, season):
+    """Whether the entrypoint for a parent and season belongs to this spider's shard. The shard is picked from a
+    stable hash of the parent href, combined with the season for the parents whose pages are per season, so that
+    every node agrees on the split without any coordination. With season discovery the seasons of a parent are
+    only known once its latest season page was fetched, so the shard is picked from the href alone.
+    """
+    if item['type'] in SEASONAL_TYPES and not self.season_discovery:
+      key = f"{item['href']}@{season}"
+    else:
+      key = item['href']
+
+    index, count = self.shard
+    digest = hashlib.md5(key.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % count == index
 
   def seasonize_entrypoin_href(self, item, season):
 
@@ -83,15 +83,39 @@ class CompetitionsSpider(BaseSpider):
             yield response.follow(self.base_url + href, self.parse_seasons, cb_kwargs=cb_kwargs)
 
     def parse_seasons(self, response, base):
-        for season in self.seasons:
-            href = f"/wettbewerbe/national/wettbewerbe/{base['country_id']}/plus/0?saison_id={season}"
-            yield response.follow(
-                self.base_url + href,
-                self.parse_competitions,
-                cb_kwargs={
-                    'base': base
-                }
-            )
+        seasons = self.seasons
+        if self.season_discovery:
+            # only request the seasons in the country's season selector, or probe backwards if there is none
+            seasons = [season for season in self.season_options(response) if season <= self.seasons[0]]
+            if not seasons:
+                yield self.country_season_request(base, self.seasons[0], self.probe_competitions, {'season': self.seasons[0]})
+                return
+
+        for season in seasons:
+            yield self.country_season_request(base, season, self.parse_competitions)
+
+    def country_season_request(self, base, season, callback, cb_kwargs=None):
+        href = f"/wettbewerbe/national/wettbewerbe/{base['country_id']}/plus/0?saison_id={season}"
+        return Request(
+            self.base_url + href,
+            callback,
+            cb_kwargs={
+                'base': base,
+                **(cb_kwargs or {})
+            }
+        )
+
+    def probe_competitions(self, response, base, season):
+        """Parse the competitions of a country in a season and request the previous season, until the first
+        season without competitions.
+        """
+        if self.season_is_empty(response):
+            return
+
+        yield from self.parse_competitions(response, base)
+
+        if season - 1 >= self.seasons[-1]:
+            yield self.country_season_request(base, season - 1, self.probe_competitions, {'season': season - 1})
 
     def parse_competitions(self, response, base):
         """Parse competitions from the country competitions page.
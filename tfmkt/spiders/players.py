@@ -8,8 +8,6 @@ import json
 class PlayersSpider(BaseSpider):
   name = 'players'
 
-  players = []
-
   def parse(self, response, parent):
       """Parse clubs's page to collect all player's urls.
 
@@ -32,8 +30,8 @@ class PlayersSpider(BaseSpider):
       player_hrefs = players_table.xpath('//table[@class="inline-table"]//td[@class="hauptlink"]/a/@href').getall()
 
       for href in player_hrefs:
-        if href not in self.players:
-          self.players.append(href)
+        if href not in self.seen:
+          self.seen.add(href)
 
           cb_kwargs = {
             'base' : {
@@ -147,6 +145,8 @@ class PlayersSpider(BaseSpider):
     """
     Get player's market history
     """
+    self.seen.fetched(base['href'])
+
     yield {
       **base,
       'market_value_history': json.loads(response.text)
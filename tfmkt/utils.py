@@ -1,3 +1,10 @@
+import datetime
+import re
+
+# the season in transfermarkt urls, as in ".../saison_id/2020" or "...?saison_id=2020" in the seasoned_href that
+# BaseSpider gives to parents, or "?saison=2020" in the stats pages of appearances
+SEASON_PATTERN = re.compile(r'saison(?:_id)?[=/](\d{4})')
+
 def uri_params(params, spider):
     """uri_params is used by scrapy to generate additional parameters for URI generation.
 
@@ -49,3 +56,23 @@ def background_position_in_px_to_minute(px_x: int, px_y: int) -> int:
     y = int(y) + y_offset
 
     return matrix[y][x]
+
+def current_season() -> int:
+    """The season being played today. Seasons are named after the year they start in, around July.
+
+    :return: The season
+    :rtype: int
+    """
+    today = datetime.date.today()
+    return today.year if today.month >= 7 else today.year - 1
+
+def url_season(url: str) -> int:
+    """The season a transfermarkt url is for, if it has one.
+
+    :param url: The url
+    :type url: str
+    :return: The season, or None if the url is not for a season
+    :rtype: int
+    """
+    match = SEASON_PATTERN.search(url)
+    return int(match.group(1)) if match else None